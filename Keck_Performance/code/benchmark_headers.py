@@ -0,0 +1,82 @@
+### benchmark_headers.py: Compares reading NIRC2 header keywords with astropy (one file at a time)
+### against the header-only, thread-pooled reader in keck_data_compiler
+### Author: Emily Ramey
+
+import numpy as np
+import pandas as pd
+import tempfile
+import time
+import sys
+import os
+from astropy.io import fits
+import keck_data_compiler as kdc
+
+# Usage Message
+usage = f"Usage: {sys.argv[0]} [n_frames] [image_size]"
+
+n_extra_cards = 300 # NIRC2 headers have a few hundred keywords
+default_frames = 200
+default_size = 1024
+
+def make_frames(directory, n_frames=default_frames, size=default_size, seed=123):
+    """ Writes synthetic NIRC2-like frames to a directory and returns their filenames """
+    rng = np.random.default_rng(seed)
+    image = rng.normal(size=(size, size)).astype(np.float32)
+
+    filenames = []
+    for i in range(n_frames):
+        header = fits.Header()
+        for j in range(n_extra_cards):
+            header[f'EXTRA{j}'] = (float(j), 'Filler keyword')
+        header['AIRMASS'] = 1+rng.random()
+        header['ITIME'] = 2.8
+        header['COADDS'] = 10
+        header['FWINAME'] = 'Kp'
+        header['AZ'] = 360*rng.random()
+        for field in kdc.nirc2_fields[5:]:
+            if rng.random() > 0.1: # Some keywords are missing
+                header[field] = rng.random()
+
+        filename = f"{directory}/c{i:04d}.fits"
+        fits.writeto(filename, image, header, overwrite=True)
+        filenames.append(filename)
+
+    return filenames
+
+def read_astropy(filenames, fields=kdc.nirc2_fields):
+    """ Reads header keywords the old way, opening each file with astropy """
+    data = {field:[] for field in fields}
+    for filename in filenames:
+        with fits.open(filename) as file:
+            header = file[0].header
+        for field in fields:
+            data[field].append(header.get(field, np.nan))
+    return pd.DataFrame.from_dict(data)
+
+def run(n_frames=default_frames, size=default_size):
+    """ Times both header readers on a directory of synthetic frames """
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = make_frames(directory, n_frames, size)
+
+        start = time.perf_counter()
+        old = read_astropy(filenames)
+        t_old = time.perf_counter()-start
+
+        start = time.perf_counter()
+        new = pd.DataFrame(kdc.harvest_headers(filenames))
+        t_new = time.perf_counter()-start
+
+    # Check that both readers agree
+    same = all((old[col].astype(str)==new[col].astype(str)).all() for col in old.columns)
+
+    print(f"{n_frames} frames of {size}x{size}:")
+    print(f"\tastropy: {t_old:.3f} s ({n_frames/t_old:.0f} frames/s)")
+    print(f"\theader-only: {t_new:.3f} s ({n_frames/t_new:.0f} frames/s)")
+    print(f"\tspeedup: {t_old/t_new:.1f}x, identical values: {same}")
+
+if __name__=='__main__':
+    if len(sys.argv) > 3:
+        print(usage)
+        sys.exit()
+    args = [int(arg) for arg in sys.argv[1:]]
+    run(*args)
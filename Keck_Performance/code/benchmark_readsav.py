@@ -0,0 +1,109 @@
+### benchmark_readsav.py: Benchmarks reading synthetic telemetry .sav files (see savwriter.py)
+### with scipy's readsav and the readers in readsav_copy, reporting MB/s, peak memory,
+### and the time spent on each record
+### Author: Emily Ramey
+
+import numpy as np
+import multiprocessing as mp
+import tempfile
+import time
+import sys
+import os
+import savwriter
+
+# Usage Message
+usage = f"Usage: {sys.argv[0]} [n_frames ...]"
+
+default_frames = [1000, 5000, 20000]
+repeats = 3 # Best of
+
+### Readers to compare, by name
+def read_scipy(filename):
+    from scipy.io import readsav
+    return readsav(filename).a.residualrms[0][0]
+
+def read_copy(filename):
+    from readsav_copy import readsav
+    return readsav(filename).a.residualrms[0][0]
+
+def read_memmap(filename):
+    from readsav_copy import readsav
+    return readsav(filename, memmap=True).a.residualrms[0][0]
+
+def read_lazy(filename):
+    from readsav_copy import LazySav
+    return LazySav(filename).a.residualrms[0][0]
+
+readers = {'scipy': read_scipy, 'readsav': read_copy, 'memmap': read_memmap,
+           'lazy (residualrms)': read_lazy}
+
+def time_records():
+    """ Wraps readsav_copy's record reader to time each record, returns the list of timings """
+    import readsav_copy
+    timings = []
+    read_record_at = readsav_copy._read_record_at
+    def timed(f, start, *args, **kwargs):
+        t = time.perf_counter()
+        r = read_record_at(f, start, *args, **kwargs)
+        timings.append((r['rectype'], r.get('varname', ''), time.perf_counter()-t))
+        return r
+    readsav_copy._read_record_at = timed
+    return timings
+
+def memory_status(field):
+    """ Reads a memory field (e.g. VmRSS, VmHWM) of this process from /proc, in MB """
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith(field+':'):
+                return int(line.split()[1])/1024
+
+def reset_peak():
+    """ Resets the peak RSS (VmHWM) of this process to its current RSS (Linux only) """
+    with open('/proc/self/clear_refs', 'w') as file:
+        file.write('5')
+
+def run_reader(name, filename):
+    """
+    Runs one reader (in a fresh process), returns the best time, the increase in
+    peak RSS while reading (MB), and the record timings of the last run
+    """
+    timings = time_records()
+    readers[name](filename) # Warm up (imports, reader plans)
+
+    best, peak = np.inf, 0
+    for i in range(repeats):
+        del timings[:]
+        reset_peak()
+        base_rss = memory_status('VmRSS')
+        start = time.perf_counter()
+        readers[name](filename)
+        best = min(best, time.perf_counter()-start)
+        peak = max(peak, memory_status('VmHWM')-base_rss)
+    return best, peak, list(timings)
+
+def run(frames=default_frames):
+    """ Writes synthetic files of each size (plain and compressed) and times each reader """
+    ctx = mp.get_context('spawn') # So each run starts with a fresh memory footprint
+    with tempfile.TemporaryDirectory() as directory:
+        for n_frames in frames:
+            for compress in [False, True]:
+                filename = f"{directory}/n{n_frames}_{int(compress)}.sav"
+                savwriter.write_telemetry(filename, n_frames, compress=compress)
+                size = os.path.getsize(filename)/2**20
+                kind = "compressed" if compress else "plain"
+                print(f"{n_frames} frames, {kind} ({size:.1f} MB):")
+
+                for name in readers:
+                    with ctx.Pool(1) as pool:
+                        t, rss, timings = pool.apply(run_reader, (name, filename))
+                    print(f"\t{name:>20}: {t:7.3f} s, {size/t:8.1f} MB/s, peak RSS +{rss:.0f} MB")
+                    # Slowest records
+                    for rectype, varname, t_rec in sorted(timings, key=lambda x: -x[2])[:3]:
+                        print(f"\t{'':>22}{rectype} {varname}: {t_rec*1000:.2f} ms")
+
+if __name__=='__main__':
+    if len(sys.argv) > 1 and not all(arg.isdigit() for arg in sys.argv[1:]):
+        print(usage)
+        sys.exit()
+    frames = [int(arg) for arg in sys.argv[1:]] if len(sys.argv) > 1 else default_frames
+    run(frames)
@@ -9,17 +9,27 @@ import numpy as np
 import os
 import re
 import datetime
-import pytz
 import time
 import glob
 import urllib
 import yaml
+import copy
+import io
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from astropy.table import Table
 from astropy.time import Time, TimezoneInfo
 from astropy import units as u, constants as c
 from datetime import datetime, timezone
 from astropy.io import fits
-from scipy.io import readsav
+from readsav_copy import readsav_probe
+import store_util
+import telem_catalog
+import telem_store
+from telem_store import get_telem_mjd
+from time_util import hst_to_mjd_batch
 
 MAX_LEN = 10 # Maximum length of a file
 time_limit = 100 # Minutes between nirc2 and secondaries
@@ -29,12 +39,25 @@ data_dir = '/u/emily_ramey/work/Keck_Performance/data/' # Data directory
 save_dir = data_dir+"combined_data/"
 seeing_dir = data_dir+'seeing_data/' # seeing directory
 weather_dir = data_dir+'weather_data/' # weather directory
+store_dir = data_dir+'mkwc_store/' # binary seeing and weather store
 telem_dir = "/g/lu/data/keck_telemetry/"
+catalog_file = data_dir+'telem_catalog.db' # index of telemetry files
+telem_store_dir = telem_store.store_dir # converted telemetry files
 seeing_url = 'http://mkwc.ifa.hawaii.edu/current/seeing/'
 weather_url = 'http://mkwc.ifa.hawaii.edu/archive/wx/cfht/'
 telem_filenum_match = "c(\d+).fits"
 
+### Download settings
+n_threads = 8 # Maximum number of simultaneous downloads
+n_retries = 3 # Retries per download
+backoff = 0.5 # Seconds to wait before retrying, doubled on each retry
+timeout = 30 # Seconds to wait for the server
+header_threads = 16 # Threads used to read NIRC2 headers
+fits_block = 2880 # Size of a FITS header block, in bytes
+fits_card = 80 # Size of a FITS header card, in bytes
+
 savefile = save_dir+'keck_metadata_all.dat'
+table_dir = save_dir+'keck_metadata_all/' # one file per epoch, plus a manifest
 logfile = save_dir+'keck_metadata_all.log'
 bad_files = save_dir+"keck_bad_files.yaml"
 logstring = ''
@@ -55,6 +78,7 @@ seeing_cols = {s_types[1]: ['dimm'],
                s_types[2]: ['masspro_half', 'masspro_1', 'masspro_2', 'masspro_4', 'masspro_8',
                             'masspro_16', 'masspro']
               }
+weather_source = 'cfht' # Name of weather data in the store
 ### Weather file headers
 weather_cols = ['wind_speed', 'wind_direction',
                 'temperature', 'relative_humidity', 'pressure']
@@ -104,111 +128,205 @@ def mjd_to_ds(mjd_list):
     dateStrings = [f"{d.year}{fmt(d.month)}{fmt(d.day)}" for d in dates]
     return dateStrings if not single else dateStrings[0]
 
-def hst_to_utc(date):
-    """
-    Returns the Universal Coordinated Time calculated from Hawaii Standard Time
-    """
-    tz = pytz.timezone('US/Hawaii')
-    return tz.normalize(tz.localize(date)).astimezone(pytz.utc)
 
+### Program functions:
 
-def hst_to_mjd(daterow):
+def save_csv(data, filename):
     """
-    Returns the Modified Julian Date calculated from HST
+    Saves a dataframe as csv without exposing a partially written file
+    (other processes may be reading the same cache file)
     """
-    row = [int(num) for num in daterow]
-    if len(daterow) == 6:
-        dt = datetime(row[0], row[1], row[2], row[3], row[4], row[5])
-    else:
-        dt = datetime(row[0], row[1], row[2], row[3], row[4])
-    t = Time(hst_to_utc(dt))
-    
-    return t.mjd
+    tmp_file = f"{filename}.{os.getpid()}.tmp"
+    data.to_csv(tmp_file, index=False)
+    os.replace(tmp_file, filename)
 
-
-### Program functions:
-
-def nearest_mjd(mjd, data):
+def match_nearest(mjds, data, cols):
     """
-    Returns the index of the mjd closest to the input in the 'mjd' column of a seeing array
-    mjd: float - the date to match
+    Matches every mjd to the closest measurement in a seeing or weather table at once
+    mjds: array of dates to match (e.g. all NIRC2 frames in an epoch)
     data: a dataframe containing available seeing or weather data, must have an 'mjd' column
+    cols: columns of data to return for each match
+    Returns a dictionary of arrays {'mjd': matched mjds, col: matched values}, with
+        NaNs where there is no measurement within the time limit
     """
+    mjds = np.asarray(mjds, dtype=float)
+    matched = {col: np.full(len(mjds), np.nan) for col in ['mjd']+list(cols)}
+    
     ### Check for bad dates
     if data is None:
-        return
+        return matched
     
     data_clean = data.dropna()
+    if data_clean.empty:
+        return matched
+    
+    ### Sort once (stable, so ties keep their original order like idxmin)
+    data_mjd = data_clean.mjd.to_numpy(dtype=float)
+    order = np.argsort(data_mjd, kind='stable')
+    sorted_mjd = data_mjd[order]
+    
+    ### Closest neighbors on either side of each date
+    right = np.searchsorted(sorted_mjd, mjds, side='left')
+    # First occurrence of the previous value, in case of repeated mjds
+    left = np.searchsorted(sorted_mjd, sorted_mjd[np.clip(right-1, 0, None)], side='left')
+    right = np.clip(right, 0, len(sorted_mjd)-1)
+    dt_left = np.abs(sorted_mjd[left]-mjds)
+    dt_right = np.abs(sorted_mjd[right]-mjds)
+    
+    # Pick the closer one, or the earlier row in the table if equally close
+    use_right = (dt_right < dt_left) | ((dt_right == dt_left) & (order[right] < order[left]))
+    idx = order[np.where(use_right, right, left)]
+    dt = np.where(use_right, dt_right, dt_left)
     
     ### Time limit
-    dt = np.abs(data_clean.mjd-mjd)
-    idx = dt.idxmin()
-    if dt[idx]*24*60 > time_limit: # Compare in minutes
-        return
+    good = dt*24*60 <= time_limit # Compare in minutes
+    
+    ### Save closest measurements
+    for col in matched:
+        matched[col][good] = data_clean[col].to_numpy()[idx[good]]
     
-    ### Return index of closest mjd
-    return idx
+    return matched
 
 def convert_to_mjd(dates):
     """
     Converts time data in a dataframe (HST) into MJD values
-    df: a pandas dataframe, must contain the columns listed in the date_cols array
-    Returns an astropy.Time object with a list of MJDs
+    dates: a pandas dataframe, must contain the columns listed in the date_cols array
+        (or an integer array with those columns, in order)
+    Returns an array of MJDs
     """
+    if isinstance(dates, pd.DataFrame):
+        dates = dates[date_cols].to_numpy()
+    dates = np.asarray(dates, dtype=np.int64).reshape(-1, len(date_cols))
+    
     ### Convert HST to MJD
-    times = []
-    # Input timezone
-    hst = pytz.timezone('US/Hawaii')
-    # Loop over times
-    for i in range(len(dates)):
-        year = int(dates.year[i])
-        
-        # For that one stupid typo in 2013
-        if year == 202013:
-            year = 2013
-        
-        dt = datetime(year, int(dates.month[i]), int(dates.day[i]),
-                      int(dates.hour[i]), int(dates.minute[i]), int(dates.second[i]))
-        dt = hst.normalize(hst.localize(dt)).astimezone(pytz.utc)
-        times.append(dt)
-    # Convert to astropy.Time
-    times = Time(times)
-    # Return array of mjds
-    return times.mjd
+    return hst_to_mjd_batch(*dates.T)
             
             
-def load_nirc2(nirc2_epoch):
+def load_strehl(nirc2_epoch):
     """
-    Loads NIRC2 data from a given observing night as a pandas dataframe
+    Loads the Strehl file from a given observing night as a pandas dataframe
+    Returns None if there is no Strehl file
     """
     nirc2_dir = f'{root_dir}{nirc2_epoch}/clean/kp/'
-    vprint("Message: NIRC2 file found: "+nirc2_dir)
     
     ### Check for Strehl file
     if os.path.isfile(nirc2_dir + 'strehl_source.txt') == True: # Two possible filenames
         strehl_src = pd.read_csv(nirc2_dir + 'strehl_source.txt', delim_whitespace = True, header = None, skiprows = 1)
     elif os.path.isfile(nirc2_dir + 'irs33N.strehl') == True:
         strehl_src = pd.read_csv(nirc2_dir + 'irs33N.strehl', delim_whitespace = True, header = None, skiprows = 1)
-    else: # Exit if not found
-        vprint("\tError: No Strehl file found for epoch "+nirc2_epoch+". Exiting.")
+    else: # Not found
         return
     
     ### Correct column names
     strehl_src.columns = strehl_cols
     strehl_src['epoch'] = nirc2_epoch
+    
+    return strehl_src
+
+def obs_mjds(mjds):
+    """
+    Returns the unique days (MJD at 0h UTC) covered by a list of MJDs, +/- 1 day for padding
+    """
+    mjds = np.asarray(mjds, dtype=float)
+    return np.unique(np.floor(np.concatenate([mjds-1, mjds, mjds+1])))
+
+def obs_dates(mjds):
+    """
+    Returns the unique dates (YYYYMMDD) covered by a list of MJDs, +/- 1 day for padding
+    """
+    return mjd_to_ds(list(obs_mjds(mjds)))
+
+def parse_card_value(text):
+    """
+    Parses the value of a FITS header card (everything after '= ')
+    Returns a string, bool, int, or float, like astropy's header
+    """
+    text = text.strip()
+    
+    ### Quoted strings ('' is an escaped quote)
+    match = re.match(r"'((?:[^']|'')*)'", text)
+    if match:
+        return match[1].replace("''", "'").rstrip()
+    
+    ### Remove comments
+    value = text.split('/')[0].strip()
+    if value == 'T':
+        return True
+    if value == 'F':
+        return False
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace('D', 'E'))
+    except ValueError:
+        return value if value else None
+
+def read_header_cards(filename, fields=nirc2_fields):
+    """
+    Reads keywords from the primary header of a FITS file without touching the image data
+    Header blocks are read one at a time until the END card
+    Returns a dictionary of {field: value} for the fields that were found
+    """
+    values = {}
+    with open(filename, 'rb') as file:
+        block = file.read(fits_block)
+        # Let astropy handle anything that isn't a plain FITS file (e.g. compressed)
+        if not block.startswith(b'SIMPLE'):
+            header = fits.getheader(filename)
+            return {field: header[field] for field in fields if field in header}
+        
+        while len(block) == fits_block:
+            for i in range(0, fits_block, fits_card):
+                card = block[i:i+fits_card]
+                key = card[:8].decode('ascii', 'replace').rstrip()
+                if key == 'END':
+                    return values
+                # The first card wins if a keyword repeats, as with astropy's header[key]
+                if key in fields and key not in values and card[8:10] == b'= ':
+                    values[key] = parse_card_value(card[10:].decode('ascii', 'replace'))
+            block = file.read(fits_block)
+    
+    return values
+
+def column_array(values):
+    """ Converts a list of header values into an int, float, or object array """
+    if all(isinstance(v, (int, np.integer)) and not isinstance(v, bool) for v in values):
+        return np.array(values, dtype=np.int64)
+    if all(isinstance(v, (int, float, np.number)) and not isinstance(v, bool) for v in values):
+        return np.array(values, dtype=np.float64)
+    return np.array(values, dtype=object)
+
+def harvest_headers(filenames, fields=nirc2_fields, threads=header_threads):
+    """
+    Reads keywords from the primary headers of many FITS files on a thread pool
+    Returns a columnar dictionary of {field: array}, in the same order as filenames,
+        with NaN for missing fields
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        headers = list(executor.map(lambda filename: read_header_cards(filename, fields), filenames))
+    
+    return {field: column_array([hdr.get(field, np.nan) for hdr in headers]) for field in fields}
+
+def load_nirc2(nirc2_epoch):
+    """
+    Loads NIRC2 data from a given observing night as a pandas dataframe
+    """
+    nirc2_dir = f'{root_dir}{nirc2_epoch}/clean/kp/'
+    vprint("Message: NIRC2 file found: "+nirc2_dir)
+    
+    ### Check for Strehl file
+    strehl_src = load_strehl(nirc2_epoch)
+    if strehl_src is None: # Exit if not found
+        vprint("\tError: No Strehl file found for epoch "+nirc2_epoch+". Exiting.")
+        return
+    
     # Convert mjds to dateime objects
     mjd_list = Time(strehl_src['mjd'], format = 'mjd')
     
-    ### Set up new dataframe
-    nirc2_data = {field:[] for field in nirc2_fields}
-    
-    ### Loop through fits files
-    for fname in strehl_src['file']:
-        nirc2_file = nirc2_dir+fname
-        with fits.open(nirc2_file) as file:
-            nirc2_hdr = file[0].header
-        for field in nirc2_fields:
-            nirc2_data[field].append(nirc2_hdr.get(field, np.nan))
+    ### Read headers of all fits files
+    nirc2_data = harvest_headers([nirc2_dir+fname for fname in strehl_src['file']])
     
     ### Merge new data with old
     nirc2_data = pd.DataFrame.from_dict(nirc2_data)
@@ -217,53 +335,162 @@ def load_nirc2(nirc2_epoch):
     ### Return final dataframe
     return nirc2_data
 
-def load_seeing(obs_date, s):
+### Downloads
+def make_session(threads=n_threads):
     """
-    Loads seeing file of type s from a given observation date
-    obs_date: string formated as YYMMDD
-    s: Type of seeing file - mass, dimm, or masspro
+    Makes an HTTP session with a pool of reusable connections that retries
+    failed requests with an increasing delay
     """
-    ### TODO: Make a check for if MASS/DIMM was operational based on date
+    retry = Retry(total=n_retries, backoff_factor=backoff, 
+                  status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=threads, pool_maxsize=threads, max_retries=retry)
+    
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetch_url(session, url):
+    """
+    Downloads a single url with the given session
+    Returns the text of the file (or None) and an error message (or None)
+    """
+    try:
+        response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException as err:
+        return None, str(err)
     
-    ### Set destination seeing files
-    date_file = seeing_dir + obs_date[:6] + '/'
-    filename = date_file+obs_date+'.'+s+'.dat'
-        
-    ### Check if previous data exists
-    if os.path.isfile(filename): # seeing files
-        seeing = pd.read_csv(filename, memory_map=True)
-        return seeing
-        
-    ### Otherwise, load the data from the MKWC website
-    url = seeing_url + s + '/' + obs_date + '.' + s + '.dat'
+    return response.text, None
+
+def fetch_urls(urls, threads=n_threads):
+    """
+    Downloads a list of urls concurrently over one pooled session
+    threads: maximum number of simultaneous downloads
+    Returns a dictionary of {url: text}, with None for failed downloads
+    """
+    urls = list(dict.fromkeys(urls)) # Remove duplicates
+    results = {}
+    if len(urls) == 0:
+        return results
+    
+    with make_session(threads) as session, ThreadPoolExecutor(max_workers=threads) as executor:
+        downloads = executor.map(lambda url: fetch_url(session, url), urls)
+        # Log from this thread only
+        for url, (text, err) in zip(urls, downloads):
+            if err is None:
+                vprint('\tMessage: Downloaded data from '+url)
+            else:
+                vprint(f'\tWarning: Could not download {url} ({err})')
+            results[url] = text
     
-    try:
-        seeing = pd.read_csv(url, delim_whitespace = True, header=None)
-    except:
-        return
+    return results
+
+def fetch_missing(datestrings, bad_data, failed=None):
+    """
+    Downloads all seeing and weather files that are missing from the local
+    directories for a set of dates at once, then formats and saves them
+    datestrings: list of dates formatted as YYYYMMDD
+    failed: failures returned by an earlier fetch_missing, which aren't downloaded again
+    Returns the failed downloads (including those in failed) as
+        {'seeing': [type_date, ...], 'weather': [date, ...]}
+    Failures aren't added to bad_data here, but by load_all_seeing and load_all_weather
+    for the epochs that need them, so that each epoch still warns about its missing data
+    """
+    failed = {'seeing': [], 'weather': []} if failed is None else copy.deepcopy(failed)
     
-    vprint('\tMessage: Downloaded data from '+url)
+    ### Gather missing files
+    seeing_urls = {}
+    for s in s_types:
+        for obs_date in datestrings:
+            savestring = s+"_"+obs_date
+            if savestring in bad_data['seeing'] or savestring in failed['seeing'] or \
+               store_util.has_night(store_dir, s, obs_date):
+                continue
+            seeing_urls[savestring] = (obs_date, s, seeing_file_url(obs_date, s))
     
-    ### Format columns
-    seeing.columns = date_cols+seeing_cols[s]
+    # Weather files are yearly, so group the missing nights by year
+    weather_dates = {}
+    for obs_date in datestrings:
+        if obs_date in bad_data['weather'] or obs_date in failed['weather'] or \
+           store_util.has_night(store_dir, weather_source, obs_date):
+            continue
+        weather_dates.setdefault(obs_date[:4], []).append(obs_date)
+    
+    ### Download everything at once
+    urls = [url for _, _, url in seeing_urls.values()]
+    urls += [weather_file_url(year) for year in weather_dates]
+    texts = fetch_urls(urls)
+    
+    ### Format and save files
+    for savestring, (obs_date, s, url) in seeing_urls.items():
+        if texts[url] is None or save_seeing(texts[url], obs_date, s) is None:
+            failed['seeing'].append(savestring)
+    
+    for year, dates in weather_dates.items():
+        text = texts[weather_file_url(year)]
+        nights = save_weather_year(text, year) if text is not None else {}
+        for obs_date in dates:
+            if obs_date not in nights:
+                failed['weather'].append(obs_date)
+    
+    return failed
+
+def seeing_file_url(obs_date, s):
+    """ Returns the MKWC url of the seeing file of type s for an observation date """
+    return seeing_url + s + '/' + obs_date + '.' + s + '.dat'
+
+def save_seeing(text, obs_date, s):
+    """
+    Formats downloaded seeing data of type s and saves it to the seeing store
+    Returns the formatted dataframe, or None if it could not be read
+    """
+    try:
+        seeing = pd.read_csv(io.StringIO(text), delim_whitespace = True, header=None)
+        ### Format columns
+        seeing.columns = date_cols+seeing_cols[s]
+        # Stop malformed downloads (e.g. an html error page) before they reach the store
+        seeing = seeing.apply(pd.to_numeric)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, ValueError) as err:
+        vprint(f'\tWarning: Could not read {s} data for {obs_date} ({err})')
+        return
     
     ### Update and save file
     seeing['mjd'] = convert_to_mjd(seeing[date_cols])
     # Drop old date columns
     seeing = seeing.drop(columns=date_cols)
-    # Make destination file
-    if not os.path.exists(date_file):
-        os.makedirs(date_file)
-    # Save seeing data as csv
-    seeing.to_csv(filename, index=False)
+    # Save seeing data to the store
+    store_util.write_nights(store_dir, s, {obs_date: seeing})
     
     # Return final seeing dataframe
     return seeing
+
+def load_seeing(obs_date, s):
+    """
+    Loads seeing file of type s from a given observation date
+    obs_date: string formated as YYMMDD
+    s: Type of seeing file - mass, dimm, or masspro
+    """
+    ### TODO: Make a check for if MASS/DIMM was operational based on date
+    
+    ### Check if previous data exists
+    seeing = store_util.load_night(store_dir, s, obs_date)
+    if seeing is not None:
+        return seeing
+        
+    ### Otherwise, load the data from the MKWC website
+    url = seeing_file_url(obs_date, s)
+    text = fetch_urls([url])[url]
+    if text is None:
+        return
+    
+    return save_seeing(text, obs_date, s)
     
 
-def load_all_seeing(mjd_list, bad_data):
+def load_all_seeing(mjd_list, bad_data, failed=None):
     """
     Loads all seeing data from dates given in MJD format
+    failed: downloads that already failed (see fetch_missing), which aren't tried again
     Returns: dictionary of dataframes as {mass: mass_df, dimm: dimm_df, masspro: masspro_df}
     """
     ### Format dates
@@ -285,7 +512,10 @@ def load_all_seeing(mjd_list, bad_data):
                 continue
             
             # Load seeing data
-            data = load_seeing(obs_date, s)
+            if failed is not None and savestring in failed['seeing']:
+                data = None
+            else:
+                data = load_seeing(obs_date, s)
             if data is not None:
                 seeing = seeing.append(data, ignore_index=True)
             else:
@@ -308,51 +538,62 @@ def load_all_seeing(mjd_list, bad_data):
     return all_seeing
 
 
+def weather_file_url(obs_date):
+    """ Returns the CFHT url of the yearly weather file for an observation date (or year) """
+    return weather_url + 'cfht-wx.' + obs_date[:4] + '.dat'
+
+def save_weather_year(text, year):
+    """
+    Formats a downloaded yearly CFHT weather file and splits it into nights in the
+    weather store, parsing and converting dates only once
+    text: contents of cfht-wx.{year}.dat
+    Returns a dictionary of {obs_date: dataframe} for every night in the file
+    """
+    try:
+        weather = pd.read_csv(io.StringIO(text), delim_whitespace = True, header=None,
+                             usecols=range(n_weather_cols))
+        ### Format columns
+        weather.columns = date_cols[:-1]+weather_cols # Missing seconds
+        weather = weather.apply(pd.to_numeric)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, ValueError) as err:
+        vprint(f'\tWarning: Could not read weather data for {year} ({err})')
+        return {}
+    
+    weather['second'] = 0 # add seconds
+    weather['mjd'] = convert_to_mjd(weather[date_cols])
+    
+    ### Split into nights and save to the store
+    nights = {}
+    for (month, day), night in weather.groupby(['month', 'day'], sort=False):
+        obs_date = f"{year}{int(month):02d}{int(day):02d}"
+        nights[obs_date] = night.drop(columns=date_cols).reset_index(drop=True)
+    store_util.write_nights(store_dir, weather_source, nights)
+    
+    return nights
+
 def load_weather(obs_date):
     """
     Loads weather from a single observation date as a pandas dataframe
     """
-    ### Set destination weather files
-    yr = obs_date[:4]
-    month = obs_date[4:6]
-    day = obs_date[6:]
-    filename = weather_dir + 'cfht-wx.' + obs_date + '.dat'
-        
     ### Check if previous data exists
-    if os.path.isfile(filename): # seeing files
-        weather = pd.read_csv(filename, memory_map=True)
+    weather = store_util.load_night(store_dir, weather_source, obs_date)
+    if weather is not None:
         return weather
     
     ### Download data from web, if not
-    url = weather_url + 'cfht-wx.' + yr + '.dat'
-    try:
-        weather = pd.read_csv(url, delim_whitespace = True, header=None,
-                             usecols=range(n_weather_cols))
-    except:
-        print(url)
+    url = weather_file_url(obs_date)
+    text = fetch_urls([url])[url]
+    if text is None:
         return
-    vprint('\tMessage: Downloaded data from '+url)
-    
-    ### Format columns
-    weather.columns = date_cols[:-1]+weather_cols # Missing seconds
-    weather = weather[weather.month==int(month)]
-    weather = weather[weather.day==int(day)].reset_index(drop=True) # only keep 1 day's data
-    weather['second'] = 0 # add seconds
-    weather['mjd'] = convert_to_mjd(weather[date_cols])
-    
-    ### Save to file
-    weather = weather.drop(columns=date_cols)
-    if not os.path.exists(weather_dir):
-        os.makedirs(weather_dir)
-    weather.to_csv(filename, index=False)
     
-    ### Return dataframe
-    return weather if not weather.empty else None
+    # Saves every night in the year, so later nights are read from the store
+    return save_weather_year(text, obs_date[:4]).get(obs_date)
     
 
-def load_all_weather(mjd_list, bad_data):
+def load_all_weather(mjd_list, bad_data, failed=None):
     """
     Loads all weather data from cfht files with dates given in MJD format
+    failed: downloads that already failed (see fetch_missing), which aren't tried again
     Returns: pandas dataframe with weather keywords
     """
     ### No data before 1996
@@ -366,7 +607,10 @@ def load_all_weather(mjd_list, bad_data):
     for obs_date in datestrings:
         if obs_date in bad_data['weather']:
             continue
-        data = load_weather(obs_date)
+        if failed is not None and obs_date in failed['weather']:
+            data = None
+        else:
+            data = load_weather(obs_date)
         
         if data is not None:
             all_weather = all_weather.append(data, ignore_index=True)
@@ -385,55 +629,47 @@ def load_all_weather(mjd_list, bad_data):
     
     return all_weather if not all_weather.empty else None
 
-def get_telem_mjd(telem):
-    """ Extracts the Modified Julian Date from the given telemetry data """
-    # Get MJD from telemetry
-    if 'header' in telem.keys():
-        mjd_idx = [i for i in range(len(telem.header)) if 'MJD-OBS' in telem.header[i].decode('utf-8')]
-        if len(mjd_idx)!=1: # No MJD field in header or more than one
-            print(f"Error in file {i} ({filenames[i]}) header: could not retrieve MJD")
-        else: # Save MJD to dataframe
-            mjd_idx = mjd_idx[0]
-            mjd = float(re.findall("\d+\.\d+", telem.header[mjd_idx].decode('utf-8'))[0])
-    elif 'tstamp_str_start' in telem.keys():
-        timestring = telem.tstamp_str_start.decode('utf-8')
-        fmt = "%Y-%m-%dT%H:%M:%S.%f"
-        dt = datetime.strptime(timestring, fmt)
-        t = Time(dt, format='datetime', scale='utc')
-        mjd = t.mjd
-    else:
-        print(f"File {i} ({filenames[i]}) has no header")
-        return
-    
-    return mjd
-
 ### Load telemetry for one NIRC2 file
-def load_telem(datestring, filenum, nirc2_mjd):
-    """ Loads and aggregates telemetry info from one file """
+def load_telem(datestring, filenum, nirc2_mjd, conn):
+    """
+    Loads and aggregates telemetry info from one file
+    conn: connection to the telemetry catalog
+    """
     acceptable_dt = .0001 # precision of mjd match (~10 seconds or so)
     
-    # Telemetry file will match:
-    telem_pattern = f"/g/lu/data/keck_telemetry/{datestring}*/**/n?{filenum}_*.sav"
-    
-    # Get all matching files
-    telem_files = glob.glob(telem_pattern, recursive=True)
+    # Get all matching files from the catalog
+    # (files matching {telem_dir}{datestring}*/**/n?{filenum}_*.sav)
+    telem_files = telem_catalog.find_files(conn, datestring, filenum)
+    if len(telem_files) == 0:
+        # The catalog may be out of date (it's refreshed in update), so check the directory
+        telem_pattern = f"{telem_dir}{datestring}*/**/n?{filenum}_*.sav"
+        if telem_catalog.add_files(conn, telem_dir, glob.glob(telem_pattern, recursive=True)):
+            telem_files = telem_catalog.find_files(conn, datestring, filenum)
     if len(telem_files) == 0: # No matches
         return
     
-    for telem_file in telem_files:
-        # Read telemetry file
-        telem = readsav(telem_file)
+    for telem_file, telem_mjd in telem_files:
+        # Skip files already known not to match
+        if telem_mjd is not None and np.abs(telem_mjd-nirc2_mjd) >= acceptable_dt:
+            continue
         
-        # Get mjd
-        telem_mjd = get_telem_mjd(telem)
+        # Get mjd from the header only, and save it for next time
+        if telem_mjd is None:
+            telem_mjd = get_telem_mjd(readsav_probe(telem_file), vprint)
+            if telem_mjd is None:
+                continue
+            telem_catalog.set_mjd(conn, telem_file, telem_mjd)
         
         if np.abs(telem_mjd-nirc2_mjd) < acceptable_dt:
+            # Read telemetry file (from the store if it's been converted,
+            # otherwise only the fields used below are read)
+            telem = telem_store.open_telem(telem_file, telem_store_dir, telem_dir)
+            
             # Get mean and std of rms residuals
             rms_mean = np.mean(telem.a.residualrms[0][0])
             rms_std = np.std(telem.a.residualrms[0][0])
+            telem.close()
             return telem_file, telem_mjd, rms_mean, rms_std
-            
-        del telem
     
     return None
     
@@ -445,6 +681,7 @@ def load_all_telem(files, mjds, bad_data):
     data = pd.DataFrame(index=range(N), columns=telem_cols)
     
     warn_files = []
+    conn = telem_catalog.connect(catalog_file)
     for i in range(len(files)):
         file, mjd = files[i], mjds[i]
         datestring = mjd_to_ds(mjd)
@@ -456,7 +693,6 @@ def load_all_telem(files, mjds, bad_data):
         
         # Get file number
         filenum = re.search(telem_filenum_match, file)
-        filenum = filenum[1:]
         if not filenum:
             bad_data['telemetry'].append(savestring)
             vprint(f"\tWarning: Couldn't find file number in {datestring}, {file}")
@@ -466,12 +702,13 @@ def load_all_telem(files, mjds, bad_data):
         filenum = filenum[1]
         
         # Load telemetry for file pattern
-        results = load_telem(datestring, filenum, mjd)
+        results = load_telem(datestring, filenum, mjd, conn)
         if results is None:
             bad_data['telemetry'].append(savestring)
             vprint(f"\tWarning: No time matches for {datestring}, {file}")
             warn_files.append(file)
         data.loc[i] = results
+    conn.close()
     
     # Warn about bad data
     nans = data.isna().any(axis=1)
@@ -485,12 +722,13 @@ def load_all_telem(files, mjds, bad_data):
     
     return data
 
-def populate_df(nirc2_epoch, bad_data):
+def populate_df(nirc2_epoch, bad_data, failed=None):
     '''
     This takes in a nirc2 epoch (two digit year, first three letters of month,
     lgs, and a number if there were multiple days, ie. 04jullgs1), looks for and
     downloads all associated cfht and seeing data, and returns the df to be
     appended to a master table
+    failed: downloads that already failed in an earlier fetch_missing
     '''
     ### Load NIRC2 data from a file
     nirc2_data = load_nirc2(nirc2_epoch)
@@ -504,47 +742,88 @@ def populate_df(nirc2_epoch, bad_data):
     
     ### Load seeing data from Mauna Kea website
     # Find unique days in observation, +/- 1 day for padding
-    unique_mjds = np.unique(np.floor(list(nirc2_data.mjd-1)+list(nirc2_data.mjd)+list(nirc2_data.mjd+1)))
+    unique_mjds = obs_mjds(nirc2_data.mjd)
     
     ### Pull seeing and weather data from relevant dates
-    seeing_data = load_all_seeing(unique_mjds, bad_data)
-    weather_data = load_all_weather(unique_mjds, bad_data)
+    # Download all missing files at once
+    failed = fetch_missing(mjd_to_ds(list(unique_mjds)), bad_data, failed)
+    seeing_data = load_all_seeing(unique_mjds, bad_data, failed)
+    weather_data = load_all_weather(unique_mjds, bad_data, failed)
+    
+    ### Match NIRC2 dates with seeing and weather information
+    seeing_match = {s: match_nearest(nirc2_data.mjd, seeing_data[s], seeing_cols[s]) for s in s_types}
+    weather_match = match_nearest(nirc2_data.mjd, weather_data, weather_cols)
     
-    ### Match NIRC2 dates with seeing information
     # Initialize dictionary
-    closest_data = {s+"_mjd":[] for s in s_types}
-    closest_data.update({'cfht_mjd':[]})
+    closest_data = {s+"_mjd": seeing_match[s]['mjd'] for s in s_types}
+    closest_data.update({'cfht_mjd': weather_match['mjd']})
     for s in s_types:
-        closest_data.update({s_col:[] for s_col in seeing_cols[s]})
-    closest_data.update({w_col:[] for w_col in weather_cols})
-    
-    # Loop through NIRC2 dates
-    # Could probably make this shorter if time
-    for nirc2_mjd in nirc2_data.mjd:
-        # Find closest seeing data
-        for s in s_types:
-            seeing = seeing_data[s]
-            # Find closest measurement to NIRC2 observation
-            idx = nearest_mjd(nirc2_mjd, seeing)
-            # Save closest measurements to dictionary
-            closest_data[s+"_mjd"].append(np.nan if idx is None else seeing.iloc[idx]['mjd'])
-            for s_col in seeing_cols[s]:
-                closest_data[s_col].append(np.nan if idx is None else seeing.iloc[idx][s_col])
-        # Find closest weather data
-        idx = nearest_mjd(nirc2_mjd, weather_data)
-        closest_data['cfht_mjd'].append(np.nan if idx is None else weather_data.iloc[idx]['mjd'])
-        for w_col in weather_cols:
-            closest_data[w_col].append(np.nan if idx is None else weather_data.iloc[idx][w_col])
+        closest_data.update({s_col: seeing_match[s][s_col] for s_col in seeing_cols[s]})
+    closest_data.update({w_col: weather_match[w_col] for w_col in weather_cols})
     
     ### Add to NIRC2 data
     closest_data = pd.DataFrame.from_dict(closest_data)
     all_data = nirc2_data.join(closest_data)
     return all_data
 
-def update(savefile=savefile, logfile=logfile, bad_files=bad_files):
+def process_epoch(nirc2_epoch, bad_data, failed=None):
+    """
+    Runs populate_df on a single epoch without touching the caller's state,
+    so it can be run in a worker process
+    Returns the epoch dataframe (or None), the new bad_data entries, and the log text
+    """
+    global logstring
+    saved_log, logstring = logstring, '' # The caller's log buffer, restored below
+    
+    # Work on a private copy of the bad data
+    bad_data = copy.deepcopy(bad_data)
+    n_bad = {key: len(val) for key, val in bad_data.items()}
+    
+    try:
+        data = populate_df(nirc2_epoch, bad_data, failed)
+    finally:
+        # Collect the epoch's log output
+        log, logstring = logstring, saved_log
+    
+    # Collect new bad data
+    new_bad = {key: val[n_bad.get(key, 0):] for key, val in bad_data.items()}
+    
+    return data, new_bad, log
+
+def migrate_cache():
+    """
+    Moves the old csv seeing and weather files into the binary store (only needs to be run once)
+    """
+    counts = store_util.migrate_csv(seeing_dir, weather_dir, store_dir, s_types=s_types,
+                                    weather_source=weather_source)
+    for source, count in counts.items():
+        vprint(f"Message: Migrated {count} nights of {source} data to {store_dir}")
+
+def load_table(table_dir=table_dir, epochs=None):
+    """
+    Reassembles the full datatable (or only some epochs) from the epoch store
+    """
+    return store_util.read_table(table_dir, epochs)
+
+def export_table(savefile=savefile, table_dir=table_dir):
     """
-    Calling this function will backup the old file, automatically seek out new lgs data,
-    and save an updated datatable
+    Writes the full datatable from the epoch store to a single csv file
+    This reads every epoch, so it's a separate step from update()
+    """
+    save_csv(load_table(table_dir), savefile)
+    print(f"data saved to {savefile}")
+
+def update(savefile=savefile, logfile=logfile, bad_files=bad_files, workers=1, table_dir=table_dir,
+           export=False):
+    """
+    Calling this function will backup the old table, automatically seek out new lgs data,
+    and add each new epoch to the datatable
+    savefile: single-file datatable, moved into the store on the first run
+    workers: number of processes used to run epochs in parallel (1 runs them in series)
+    table_dir: epoch store for the datatable, each epoch is saved as it is processed
+        (read it with load_table/store_util.read_table; the manifest lists the epochs)
+    export: also rewrite savefile from the whole store at the end (see export_table),
+        which makes the run's cost grow with the archive
     """
     ### Set up bad files
     if os.path.isfile(bad_files):
@@ -552,56 +831,84 @@ def update(savefile=savefile, logfile=logfile, bad_files=bad_files):
             bad_data = yaml.load(f, Loader=yaml.FullLoader)
     else: bad_data = {'nirc2': [], 'weather': [], 'seeing': [], 'telemetry': []}
     
-    ### If file already exists
-    if os.path.isfile(savefile):
-        # Read in previous file
-        all_data = pd.read_csv(savefile)
-        
-        # Get backup filename
-        now = datetime.now()
-        filename = os.path.basename(savefile)
-        filestub, ext = filename.split('.')[-2:]
-        
-        # Back up past file
-        backup_file = f"{data_dir}{filestub}_backup_{now.strftime('%Y%m%d')}.{ext}"
-        all_data.to_csv(backup_file, index=False)
-        vprint('Previous data backed up as ' + backup_file)
-        
-        epochs = np.unique(all_data['epochs'])
+    ### Move an old single-file table into the store
+    if not store_util.read_manifest(table_dir) and os.path.isfile(savefile):
+        n_epochs = store_util.split_table(savefile, table_dir)
+        vprint(f'Moved {n_epochs} epochs from {savefile} to {table_dir}')
     
-    else: # Initialize new dataframe
-        all_data = pd.DataFrame()
-        epochs = []
+    ### Back up the table (partitions are never overwritten, so only the manifest is copied)
+    now = datetime.now()
+    backup = store_util.snapshot_manifest(table_dir, now.strftime('%Y%m%d'))
+    if backup is not None:
+        vprint('Previous data backed up as ' + table_dir + backup)
+    
+    epochs = list(store_util.read_manifest(table_dir))
     
     with open(logfile, 'w') as _:
             pass # Clear the file
     
     global logstring
-    ### Add new files
-    for file in os.listdir(root_dir):
+    ### Find new files
+    new_epochs = []
+    for file in sorted(os.listdir(root_dir)):
         if file in bad_data['nirc2'] or file in epochs:
             continue
         elif len(file) >= MAX_LEN:
             bad_data['nirc2'].append(file)
             vprint(f"Message: Skipping invalid file: {file}")
-            continue
         else:
-            data = populate_df(file, bad_data)
-            if data is None:
-                bad_data['nirc2'].append(file)
-                continue
-            all_data = all_data.append(data)
+            new_epochs.append(file)
+    
+    ### Index any new telemetry files
+    new, changed, removed = telem_catalog.refresh(catalog_file, telem_dir)
+    vprint(f"Message: Telemetry catalog updated ({new} new, {changed} changed, {removed} removed files)")
+    
+    ### Download missing seeing and weather data for all new epochs at once
+    datestrings = []
+    for file in new_epochs:
+        strehl_src = load_strehl(file)
+        if strehl_src is not None:
+            datestrings.extend(obs_dates(strehl_src.mjd))
+    failed = fetch_missing(sorted(set(datestrings)), bad_data)
+    
+    ### Write log (before the epochs, which log separately)
+    with open(logfile, 'a') as log:
+        log.write(logstring)
+        logstring = ''
+    
+    ### Load new epochs, in parallel if requested
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        # Each worker gets a snapshot of the bad data
+        results = executor.map(process_epoch, new_epochs, [bad_data]*len(new_epochs),
+                               [failed]*len(new_epochs))
+    else:
+        executor = None
+        # In series, each epoch sees the bad data from the ones before it
+        results = (process_epoch(file, bad_data, failed) for file in new_epochs)
+    
+    ### Merge results in order
+    for file, (data, new_bad, log_text) in zip(new_epochs, results):
+        for key, entries in new_bad.items():
+            bad_data.setdefault(key, [])
+            bad_data[key].extend([entry for entry in entries if entry not in bad_data[key]])
+        
+        if data is None:
+            bad_data['nirc2'].append(file)
+        else: # Only writes this epoch
+            store_util.write_epoch(table_dir, file, data)
+        
         ### Write log
         with open(logfile, 'a') as log:
-            log.write(logstring)
-            logstring = ''
+            log.write(log_text)
+    
+    if executor is not None:
+        executor.shutdown()
     
     print(bad_data)
-            
-    ### Write dataframe to file
-    all_data.to_csv(savefile, index=False)
     
-    print(f"data saved to {savefile}")
+    if export:
+        export_table(savefile, table_dir)
     
     with open(bad_files, 'w') as file:
         yaml.dump(bad_data, file)
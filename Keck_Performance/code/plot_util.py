@@ -6,7 +6,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from matplotlib import cm
-from scipy.io import readsav
+import telem_store
+import telem_moments
 from astropy.stats import sigma_clip
 import os
 import copy
@@ -268,8 +269,9 @@ def plot_lenslets(data_file, lnum, shape=None, xlim={}, ylim={},
     """
     Plots centroid offset of a lenslet in the data array
     lnum: integer, subaperture index from 0 to 304
+    data_file: telemetry .sav file, or its directory in the telemetry store
     """
-    data = readsav(data_file)
+    data = telem_store.open_telem(data_file)
     
     # Check on values passed
     if type(lnum) is int:
@@ -298,9 +300,10 @@ def plot_lenslets(data_file, lnum, shape=None, xlim={}, ylim={},
     for i,num in enumerate(lnum):
         ax = axes[i]
         
-        # Mean of x and y offset centroids
-        x_offset = data.a.offsetcentroid[0][:, num*2]
-        y_offset = data.a.offsetcentroid[0][:, num*2+1]
+        # Mean of x and y offset centroids (only this lenslet's columns are read)
+        offsets = data.read_slice('a.offsetcentroid', np.s_[:, num*2:num*2+2])
+        x_offset = offsets[:, 0]
+        y_offset = offsets[:, 1]
         mx = x_offset.mean()
         my = y_offset.mean()
 
@@ -343,19 +346,22 @@ def plot_array(data_file, data_type='offset centroid', map_file=sub_ap_file,
                start=(0.1,0.1), sig_clip=None, size=200, cmap = cm.viridis, 
                figsize=(10, 10), fontsize=18, save=False, filename=None):
     """ Plots an array of lenslets with the standard deviation of their centroid offsets """
-    data = readsav(data_file)
+    telem = telem_store.open_telem(data_file)
     if data_type=="offset centroid":
-        data = data.a.offsetcentroid[0]
+        # Streamed in chunks of frames, so the whole array is never in memory
+        moments = telem_moments.array_moments(telem, 'a.offsetcentroid')
         clabel = "Offset Centroid $\sigma$"
         spacing = 0.2
     elif data_type=="residual wavefront":
-        data = data.a.residualwavefront[0]
+        moments = telem_moments.array_moments(telem, 'a.residualwavefront')
         clabel = "Deformable Mirror $\sigma$ [volt]"
         spacing = 7
     else:
         print("Unrecognized lenslet array")
         return
     
+    telem.close()
+    
     if sig_clip is not None and type(sig_clip) is float:
         sig_clip = [sig_clip]
     
@@ -382,12 +388,12 @@ def plot_array(data_file, data_type='offset centroid', map_file=sub_ap_file,
         # Find standard deviation of offset centroids
         xrange = range(0, len(xx)*2, 2)
         yrange = range(1, len(yy)*2, 2)
-        x_std = np.std(data[:, xrange], axis=0)
-        y_std = np.std(data[:, yrange], axis=0)
+        x_std = moments.std()[xrange]
+        y_std = moments.std()[yrange]
         std_all = np.sqrt(x_std**2 + y_std**2)
     elif data_type=='residual wavefront':
         # Find standard deviation of residual wavefront
-        std_all = np.std(data, axis=0)
+        std_all = moments.std()
         std_all = std_all[range(len(xx))]
     
     # Plot resulting lenslet array
@@ -419,8 +425,9 @@ def plot_array(data_file, data_type='offset centroid', map_file=sub_ap_file,
     
     # Add overall mean & std
     # Is this an ok way to calculate the mean & std? What exactly do we want?
-    mean = np.mean(data)
-    std = np.std(data)
+    pooled = moments.pooled()
+    mean = pooled.mean
+    std = pooled.std()
     plt.annotate(f"Mean={np.format_float_scientific(mean, precision=3)}\n$\sigma$={np.format_float_scientific(std, precision=2)}",
                  xy=(.05,.05), xycoords='axes fraction')
     
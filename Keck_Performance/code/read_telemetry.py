@@ -4,21 +4,64 @@
 ### Date: 10/14/20
 
 import numpy as np
-from scipy.io import readsav
+import telem_store
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import pickle
 import glob
+import sys
+import os
 import re
 
+# Usage Message
+usage = f"Usage: {sys.argv[0]} [scan|update] [workers]"
+
 telem_dir = "/g/lu/data/keck_telemetry/"
 telem_pattern = telem_dir+"**/*.sav"
 lgs_pattern = telem_dir+"**/*LGS*.sav"
 savefile = "../data/telem_statistics.dat"
+failures_file = "../data/telem_failures.dat" # Files that couldn't be read in the last scan
+manifest_file = "../data/telem_manifest.dat" # Files in savefile, for updates
+checkpoint_dir = "../data/telem_statistics_chunks/"
+chunk_size = 500 # Files per checkpointed chunk
 
 colnames = ['filename', 'mjd', 'rms_mean', 'rms_std']
+manifest_cols = ['filename', 'size', 'mtime', 'hash']
 
-def get_rms(filenames, test=False):
+def file_stats(filename, i=0, store_dir=telem_store.store_dir):
+    """ Returns the MJD and the mean and standard deviation of the RMS residuals
+    of one telemetry file (the MJD is NaN if it can't be read from the header)
+    i: index of the file, for messages """
+    # Read telemetry file (variables are read when they're used)
+    telem = telem_store.open_telem(filename, store_dir, telem_dir)
+    
+    # Get MJD
+    mjd = np.nan
+    if 'header' in telem.keys():
+        mjd_idx = [i for i in range(len(telem.header)) if 'MJD-OBS' in str(telem.header[i])]
+        if len(mjd_idx)!=1: # No MJD field in header or more than one
+            print(f"Error in file {i} ({filename}) header: could not retrieve MJD")
+        else:
+            mjd_idx = mjd_idx[0]
+            mjd = float(re.findall("\d+\.\d+", str(telem.header[mjd_idx]))[0])
+    else:
+        print(f"File {i} ({filename}) has no header")
+    
+    # Get mean and std of rms residuals
+    rms = telem.read_slice('a.residualrms', 0) # Only reads residualrms
+    rms_mean, rms_std = np.mean(rms), np.std(rms)
+    
+    # Nudge garbage collector
+    telem.close()
+    del telem
+    
+    return mjd, rms_mean, rms_std
+
+def get_rms(filenames, test=False, store_dir=telem_store.store_dir):
     """ Returns an array with the mean and standard deviation 
-    of the RMS residuals for each telemetry file """
+    of the RMS residuals for each telemetry file
+    Files that have been converted (see telem_store.py) are read from store_dir """
     
     # Make empty dataframe
     N = len(filenames) if not test else 5
@@ -27,38 +70,221 @@ def get_rms(filenames, test=False):
     
     ### Extract telemetry data
     for i in range(N):
-        # Read telemetry file
-        telem = readsav(filenames[i])
-        
-        # Get MJD
-        if 'header' in telem.keys():
-            mjd_idx = [i for i in range(len(telem.header)) if 'MJD-OBS' in str(telem.header[i])]
-            if len(mjd_idx)!=1: # No MJD field in header or more than one
-                print(f"Error in file {i} ({filenames[i]}) header: could not retrieve MJD")
-            else: # Save MJD to dataframe
-                mjd_idx = mjd_idx[0]
-                mjd_i = float(re.findall("\d+\.\d+", str(telem.header[mjd_idx]))[0])
-                data.at[i, 'mjd'] = mjd_i
-        else:
-            print(f"File {i} ({filenames[i]}) has no header")
-        
-        # Get mean and std of rms residuals
-        data.at[i, 'rms_mean'] = np.mean(telem.a.residualrms[0][0])
-        data.at[i, 'rms_std'] = np.std(telem.a.residualrms[0][0])
+        mjd, rms_mean, rms_std = file_stats(filenames[i], i, store_dir)
+        if not np.isnan(mjd): # Save MJD to dataframe
+            data.at[i, 'mjd'] = mjd
+        data.at[i, 'rms_mean'] = rms_mean
+        data.at[i, 'rms_std'] = rms_std
         
         # Log to output
         if i%100==0:
             print("Iteration:", i)
-        # Nudge garbage collector
-        del telem
     
     return data
 
+def get_rms_chunk(filenames, start=0, store_dir=telem_store.store_dir):
+    """ Same as get_rms for a chunk of files, but files that can't be read are
+    recorded (and their rows left empty) instead of stopping the run
+    start: index of the chunk's first file in the full list of files
+    Returns the dataframe and a list of (filename, error) for the files that failed """
+    data = pd.DataFrame(index=range(len(filenames)), columns=colnames)
+    data['filename'] = filenames
+    failed = []
+    
+    for j, filename in enumerate(filenames):
+        try:
+            mjd, rms_mean, rms_std = file_stats(filename, start+j, store_dir)
+        except Exception as e:
+            print(f"Error in file {start+j} ({filename}): {e}")
+            failed.append((filename, f"{type(e).__name__}: {e}"))
+            continue
+        if not np.isnan(mjd):
+            data.at[j, 'mjd'] = mjd
+        data.at[j, 'rms_mean'] = rms_mean
+        data.at[j, 'rms_std'] = rms_std
+        
+        if (start+j)%100==0:
+            print("Iteration:", start+j)
+    
+    return data, failed
+
+### Checkpoints
+def checkpoint_file(checkpoint_dir, k):
+    return f"{checkpoint_dir}chunk_{k:05d}.pkl"
+
+def write_checkpoint(checkpoint_dir, k, filenames, data, failed):
+    """ Saves a finished chunk (written to a temporary file first, so it's never left half-written) """
+    filename = checkpoint_file(checkpoint_dir, k)
+    tmp_file = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as file:
+        pickle.dump({'filenames': list(filenames), 'data': data, 'failed': failed}, file)
+    os.replace(tmp_file, filename)
+
+def read_checkpoint(checkpoint_dir, k, filenames):
+    """ Returns the saved (data, failed) of a chunk, or None if it hasn't been
+    saved or was saved for a different list of files """
+    filename = checkpoint_file(checkpoint_dir, k)
+    if not os.path.isfile(filename):
+        return
+    with open(filename, 'rb') as file:
+        checkpoint = pickle.load(file)
+    if checkpoint['filenames'] != list(filenames):
+        return
+    return checkpoint['data'], checkpoint['failed']
+
+def clear_checkpoints(checkpoint_dir):
+    for filename in glob.glob(checkpoint_dir+"chunk_*.pkl"):
+        os.remove(filename)
+
+def scan(filenames, workers=1, checkpoint_dir=checkpoint_dir, chunk_size=chunk_size,
+         store_dir=telem_store.store_dir):
+    """
+    Computes the same statistics as get_rms, in chunks of files run on a pool of processes
+    Each chunk is saved to checkpoint_dir as soon as it's finished, so if the scan is
+    stopped, running it again only computes the chunks that are missing
+    workers: number of processes (1 runs the chunks in series)
+    Returns get_rms's dataframe (with empty rows for files that failed), and a list
+    of (filename, error) for files that failed
+    """
+    if not filenames:
+        return pd.DataFrame(columns=colnames), []
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    
+    ### Resume from the chunks that are already done
+    chunks = [filenames[i:i+chunk_size] for i in range(0, len(filenames), chunk_size)]
+    results = {}
+    for k, chunk in enumerate(chunks):
+        result = read_checkpoint(checkpoint_dir, k, chunk)
+        if result is not None:
+            results[k] = result
+    todo = [k for k in range(len(chunks)) if k not in results]
+    print(f"{len(filenames)} files in {len(chunks)} chunks, {len(todo)} to compute")
+    
+    ### Compute the rest, saving each chunk when it finishes
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(get_rms_chunk, chunks[k], k*chunk_size, store_dir): k
+                       for k in todo}
+            for future in as_completed(futures):
+                k = futures[future]
+                results[k] = future.result()
+                write_checkpoint(checkpoint_dir, k, chunks[k], *results[k])
+    else:
+        for k in todo:
+            results[k] = get_rms_chunk(chunks[k], k*chunk_size, store_dir)
+            write_checkpoint(checkpoint_dir, k, chunks[k], *results[k])
+    
+    ### Combine chunks in order
+    data = pd.concat([results[k][0] for k in range(len(chunks))], ignore_index=True)
+    failed = [entry for k in range(len(chunks)) for entry in results[k][1]]
+    
+    return data, failed
+
+### Incremental updates
+def file_hash(filename, block_size=2**20):
+    """ Returns the SHA-1 hash of a file's contents """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def read_manifest(manifest_file=manifest_file):
+    """ Returns the manifest as {filename: (size, mtime, hash)} (empty if there isn't one) """
+    if not os.path.isfile(manifest_file):
+        return {}
+    manifest = pd.read_csv(manifest_file)
+    return {row.filename: (row.size, row.mtime, row.hash) for row in manifest.itertuples()}
+
+def write_csv(data, filename):
+    """ Writes a csv file through a temporary file, so it's never left half-written """
+    tmp_file = f"{filename}.{os.getpid()}.tmp"
+    data.to_csv(tmp_file, index=False)
+    os.replace(tmp_file, filename)
+
+def update(filenames, workers=1, savefile=savefile, manifest_file=manifest_file,
+           checkpoint_dir=checkpoint_dir, store_dir=telem_store.store_dir):
+    """
+    Updates savefile in place, only computing statistics for files that are new or have changed
+    since the last update, and dropping rows for files that are no longer in filenames
+    Files are compared to the manifest (filename, size, mtime, hash) kept next to savefile;
+    files whose size or mtime changed are only recomputed if their contents did too
+    workers: number of processes (see scan)
+    Returns the updated dataframe, the files that were recomputed, and a list of
+    (filename, error) for files that failed
+    """
+    manifest = read_manifest(manifest_file)
+    if os.path.isfile(savefile) and manifest:
+        # Kept as text, so rows that aren't recomputed are written back unchanged
+        old = pd.read_csv(savefile, dtype=str, keep_default_na=False).set_index('filename')
+    else:
+        old = pd.DataFrame(columns=colnames).set_index('filename')
+    
+    ### Compare files to the manifest
+    stats = {filename: os.stat(filename) for filename in filenames}
+    entries = {}
+    for filename in filenames:
+        if filename in manifest and filename in old.index and \
+                manifest[filename][:2] == (stats[filename].st_size, stats[filename].st_mtime):
+            entries[filename] = manifest[filename]
+    to_hash = [filename for filename in filenames if filename not in entries]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            hashes = list(executor.map(file_hash, to_hash, chunksize=16))
+    else:
+        hashes = [file_hash(filename) for filename in to_hash]
+    
+    todo = []
+    for filename, digest in zip(to_hash, hashes):
+        entries[filename] = (stats[filename].st_size, stats[filename].st_mtime, digest)
+        # Touched or copied, but not changed
+        if filename in manifest and filename in old.index and manifest[filename][2] == digest:
+            continue
+        todo.append(filename)
+    print(f"{len(filenames)} files: {len(todo)} new or changed, "+
+          f"{len(set(old.index)-set(filenames))} removed")
+    
+    ### Compute the new and changed files
+    new, failed = scan(todo, workers, checkpoint_dir, store_dir=store_dir)
+    new = new.set_index('filename')
+    
+    ### Merge, in the order of filenames
+    data = pd.concat([old.drop(index=[file for file in old.index if file in new.index]), new])
+    data = data.loc[filenames].reset_index()
+    
+    # Files that failed aren't added to the manifest, so they're tried again next time
+    failed_files = {filename for filename, error in failed}
+    manifest = pd.DataFrame([(filename,)+entries[filename] for filename in filenames
+                             if filename not in failed_files], columns=manifest_cols)
+    write_csv(data, savefile)
+    write_csv(manifest, manifest_file)
+    clear_checkpoints(checkpoint_dir)
+    
+    return data, todo, failed
+
 if __name__=='__main__':
+    args = sys.argv[1:]
+    if len(args) > 2 or (args and args[0] not in ['scan', 'update']) or \
+            (len(args) == 2 and not args[1].isdigit()):
+        print(usage)
+        sys.exit()
+    mode = args[0] if args else None
+    workers = int(args[1]) if len(args) == 2 else 1
     # Get relevant filenames
     filenames = glob.glob(lgs_pattern, recursive=True)
     #Extract data
-    data = get_rms(filenames)
+    if mode is None:
+        data = get_rms(filenames)
+    elif mode == 'scan':
+        data, failed = scan(filenames, workers)
+    else: # Saves the data itself
+        data, todo, failed = update(filenames, workers)
+    if mode is not None:
+        pd.DataFrame(failed, columns=['filename', 'error']).to_csv(failures_file, index=False)
+        print(f"{len(failed)} files could not be read, see {failures_file}")
     # Save to file
-    data.to_csv(savefile, index=False)
-    print(f"Data saved to {savefile}")
\ No newline at end of file
+    if mode != 'update':
+        data.to_csv(savefile, index=False)
+    print(f"Data saved to {savefile}")
+    if mode == 'scan': # Finished, so the next scan starts over
+        clear_checkpoints(checkpoint_dir)
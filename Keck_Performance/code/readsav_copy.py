@@ -27,14 +27,14 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
-__all__ = ['readsav']
+__all__ = ['readsav', 'readsav_probe', 'readsav_slice', 'LazySav']
 
 import struct
 import numpy as np
 from numpy.compat import asstr
-import tempfile
 import zlib
 import warnings
+import mmap
 
 # Define the different data types that can be found in an IDL save file
 DTYPE_DICT = {1: '>u1',
@@ -69,9 +69,15 @@ RECTYPE_DICT = {0: "START_MARKER",
                 19: "NOTICE",
                 20: "DESCRIPTION"}
 
+RECTYPE_DICT_INV = {name: code for code, name in RECTYPE_DICT.items()}
+
 # Define a dictionary to contain structure definitions
 STRUCT_DICT = {}
 
+# Reader plans for each structure layout in this process, keyed by the
+# fingerprint of the structure descriptor (see _structure_plan)
+PLAN_CACHE = {}
+
 
 def _align_32(f):
     '''Align to the next 32-bit position in a file'''
@@ -84,10 +90,126 @@ def _align_32(f):
 
 def _skip_bytes(f, n):
     '''Skip `n` bytes'''
-    f.read(n)
+    f.seek(n, 1)
     return
 
 
+class _MappedFile(object):
+    '''
+    Read-only file interface to a memory-mapped .sav file, so that arrays can
+    be returned as views into the file instead of being copied into memory
+    '''
+
+    def __init__(self, file_name):
+        with open(file_name, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pos = 0
+
+    def read(self, n=-1):
+        start = self.pos
+        self.pos = len(self.map) if n < 0 else min(start + n, len(self.map))
+        return self.map[start:self.pos]
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += len(self.map)
+        self.pos = pos
+        return pos
+
+    def tell(self):
+        return self.pos
+
+    def view(self, dtype, count):
+        '''
+        Return the next `count` values of type `dtype` as a read-only array
+        backed by the map. Pages are only read when the array is used.
+        '''
+        array = np.frombuffer(self.map, dtype=dtype, count=count,
+                              offset=self.pos)
+        self.pos += array.nbytes
+        return array
+
+    def close(self):
+        # The map itself stays open until no arrays refer to it
+        return
+
+
+class _InflatedRecord(object):
+    '''
+    File-like view of one record of a compressed .sav file, which is only
+    decompressed (into memory) as far as it is read. Positions are relative
+    to the start of the record, and the same object is reused for each record.
+    '''
+
+    chunk = 2**16  # Compressed bytes read from the file at a time
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = bytearray()
+
+    def reset(self, rectype, start, nextrec):
+        '''Start reading the record between `start` and `nextrec` in the file'''
+        self.end = nextrec
+        self.fpos = start + 16
+        self.inflater = zlib.decompressobj()
+        # Uncompressed size (and so NEXTREC) is unknown until the end is read,
+        # so NEXTREC is left as zero
+        del self.buffer[:]
+        self.buffer += struct.pack('>lIIl', rectype, 0, 0, 0)
+        self.offset = 0  # Position of the start of the buffer
+        self.pos = 0
+
+    def _inflate(self, size):
+        '''Decompress until the buffer reaches `size` bytes, or the record ends'''
+        while len(self.buffer) < size and not self.inflater.eof:
+            data = self.inflater.unconsumed_tail
+            if not data:
+                if self.fpos >= self.end:
+                    break
+                self.f.seek(self.fpos)
+                data = self.f.read(min(self.chunk, self.end - self.fpos))
+                self.fpos += len(data)
+            self.buffer += self.inflater.decompress(
+                data, max(size - len(self.buffer), self.chunk))
+
+    def read(self, n):
+        start = self.pos - self.offset
+        if start < 0:
+            raise ValueError("Cannot read backwards in a compressed record")
+        # Data that was seeked past is decompressed and dropped as it goes,
+        # so skipping far ahead doesn't hold the skipped data in memory
+        while start > len(self.buffer):
+            start -= len(self.buffer)
+            del self.buffer[:]
+            self._inflate(min(start, self.chunk))
+            if not self.buffer:
+                break  # End of the record
+        self._inflate(start + n)
+        with memoryview(self.buffer) as view:
+            data = bytes(view[start:start + n])  # Only one copy
+        self.pos += len(data)
+        # Data that has been read is not needed again
+        del self.buffer[:start + len(data)]
+        self.offset = self.pos
+        return data
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        self.pos = pos
+        return pos
+
+    def tell(self):
+        return self.pos
+
+    def at_end(self):
+        '''Check whether the whole record has been read'''
+        self._inflate(self.pos - self.offset + 1)
+        return len(self.buffer) <= self.pos - self.offset
+
+
 def _read_bytes(f, n):
     '''Read the next `n` bytes'''
     return f.read(n)
@@ -222,17 +344,147 @@ def _read_data(f, dtype):
         raise Exception("Unknown IDL type: %i - please report this" % dtype)
 
 
-def _read_structure(f, array_desc, struct_desc):
+# Number of bytes taken up by a scalar of each type (strings are variable)
+DATA_SIZES = {1: 8, 2: 4, 3: 4, 4: 4, 5: 8, 6: 8, 9: 16, 10: 4, 11: 4,
+              12: 4, 13: 4, 14: 8, 15: 8}
+
+
+def _skip_data(f, dtype):
+    '''Skip a variable with a specified data type, without reading it'''
+    if dtype == 7:
+        length = _read_long(f)
+        if length > 0:
+            _skip_bytes(f, _read_long(f))
+            _align_32(f)
+    elif dtype in DATA_SIZES:
+        _skip_bytes(f, DATA_SIZES[dtype])
+    else:
+        raise Exception("Unknown IDL type: %i - please report this" % dtype)
+
+
+def _skip_array(f, typecode, array_desc):
+    '''Skip an array of type `typecode`, without reading it'''
+
+    if typecode in [1, 3, 4, 5, 6, 9, 13, 14, 15]:
+        if typecode == 1:
+            _skip_bytes(f, 4)
+        _skip_bytes(f, array_desc['nbytes'])
+    elif typecode in [2, 12]:
+        _skip_bytes(f, array_desc['nbytes']*2)
+    else:
+        for i in range(array_desc['nelements']):
+            _skip_data(f, typecode)
+
+    _align_32(f)
+
+
+def _skip_structure(f, array_desc, struct_desc):
+    '''Skip a structure, without reading it'''
+
+    for i in range(array_desc['nelements']):
+        for col in struct_desc['tagtable']:
+            if col['structure']:
+                _skip_structure(f, struct_desc['arrtable'][col['name']],
+                                struct_desc['structtable'][col['name']])
+            elif col['array']:
+                _skip_array(f, col['typecode'],
+                            struct_desc['arrtable'][col['name']])
+            else:
+                _skip_data(f, col['typecode'])
+
+
+def _select_columns(columns):
     '''
-    Read a structure, with the array and structure descriptors given as
-    `array_desc` and `structure_desc` respectively.
+    Convert a list of variable names, which can include structure fields
+    (e.g. ['header', 'a.residualrms']), into a nested dictionary of the
+    selected names. A value of None selects everything under a name.
     '''
 
-    nrows = array_desc['nelements']
-    columns = struct_desc['tagtable']
+    selection = {}
+    for column in columns:
+        names = column.lower().split('.')
+        level = selection
+        for name in names[:-1]:
+            if name in level and level[name] is None:
+                break  # Everything under this name is already selected
+            level = level.setdefault(name, {})
+        else:
+            level[names[-1]] = None
+
+    return selection
+
+
+# Position and size (in bytes) of scalars of each type within the 4-byte
+# aligned blocks they are stored in
+SCALAR_LAYOUT = {1: (4, 8), 2: (2, 4), 3: (0, 4), 4: (0, 4), 5: (0, 8),
+                 6: (0, 8), 9: (0, 16), 12: (2, 4), 13: (0, 4), 14: (0, 8),
+                 15: (0, 8)}
+
+
+def _array_shape(array_desc):
+    '''Shape of an array with the array descriptor `array_desc`'''
+    if array_desc['ndims'] > 1:
+        dims = array_desc['dims'][:int(array_desc['ndims'])]
+        return tuple(reversed(dims))
+    return (array_desc['nelements'], )
+
+
+def _packed_dtype(struct_desc):
+    '''
+    Build a big-endian numpy dtype matching the layout of one row of a
+    structure in the file, so that all rows can be decoded at once.
+    Returns None if the structure has tags that are not fixed-size (strings,
+    pointers, or nested structures).
+    '''
+
+    names, formats, offsets = [], [], []
+    offset = 0
+
+    for col in struct_desc['tagtable']:
+        typecode = col['typecode']
+        if col['structure'] or typecode not in SCALAR_LAYOUT:
+            return None
+
+        names.append(col['name'])
+        if col['array']:
+            array_desc = struct_desc['arrtable'][col['name']]
+            if typecode == 1:
+                offset += 4  # Number of bytes is repeated before the data
+            if typecode in [2, 12]:
+                # 2 byte types are padded to 4 bytes
+                formats.append((DTYPE_DICT[typecode],
+                                (array_desc['nelements']*2, )))
+                nbytes = array_desc['nbytes']*2
+            else:
+                formats.append((DTYPE_DICT[typecode],
+                                (array_desc['nelements'], )))
+                nbytes = array_desc['nbytes']
+            offsets.append(offset)
+            offset += nbytes + (-nbytes) % 4
+        else:
+            start, size = SCALAR_LAYOUT[typecode]
+            formats.append(DTYPE_DICT[typecode])
+            offsets.append(offset + start)
+            offset += size
+
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                     'itemsize': offset})
+
+
+def _structure_plan(struct_desc):
+    '''
+    Get the reader plan for a structure layout: the dtype of the structure,
+    the packed dtype of one row in the file (None unless all tags are
+    fixed-size), and the shape of each array tag. Plans are built once per
+    layout and cached for the rest of the process.
+    '''
+
+    key = struct_desc['fingerprint']
+    if key in PLAN_CACHE:
+        return PLAN_CACHE[key]
 
     dtype = []
-    for col in columns:
+    for col in struct_desc['tagtable']:
         if col['structure'] or col['array']:
             dtype.append(((col['name'].lower(), col['name']), np.object_))
         else:
@@ -243,15 +495,91 @@ def _read_structure(f, array_desc, struct_desc):
                 raise Exception("Variable type %i not implemented" %
                                                             col['typecode'])
 
+    plan = {'dtype': dtype,
+            'packed': _packed_dtype(struct_desc),
+            'shapes': {col['name']: _array_shape(
+                           struct_desc['arrtable'][col['name']])
+                       for col in struct_desc['tagtable'] if col['array']},
+            'padded': [col['name'] for col in struct_desc['tagtable']
+                       if col['array'] and col['typecode'] in [2, 12]],
+            'pointers': [col['name'] for col in struct_desc['tagtable']
+                         if col['typecode'] in [10, 11] or (col['structure']
+                         and _structure_plan(struct_desc['structtable']
+                                             [col['name']])['pointers'])]}
+
+    PLAN_CACHE[key] = plan
+    return plan
+
+
+def _read_packed_structure(f, nrows, plan):
+    '''
+    Read all rows of a structure with fixed-size tags at once, using the
+    packed dtype in the structure's plan
+    '''
+
+    packed = plan['packed']
+    if isinstance(f, _MappedFile):
+        rows = f.view(packed, nrows)
+    else:
+        rows = np.frombuffer(f.read(nrows * packed.itemsize), dtype=packed,
+                             count=nrows)
+
+    structure = np.recarray((nrows, ), dtype=plan['dtype'])
+
+    for (name, title), dtype in plan['dtype']:
+        values = rows[title]
+        if title in plan['shapes']:
+            if title in plan['padded']:
+                values = values[:, 1::2]
+            values = values.reshape((nrows, ) + plan['shapes'][title])
+            for i in range(nrows):
+                structure[title][i] = values[i]
+        else:
+            structure[title] = values
+
+    return structure
+
+
+def _read_structure(f, array_desc, struct_desc, fields=None):
+    '''
+    Read a structure, with the array and structure descriptors given as
+    `array_desc` and `structure_desc` respectively. If `fields` is given,
+    only the selected fields are read, and all others are skipped.
+    '''
+
+    nrows = array_desc['nelements']
+    plan = _structure_plan(struct_desc)
+
+    # Structures with only fixed-size tags are read all at once
+    if fields is None and plan['packed'] is not None:
+        structure = _read_packed_structure(f, nrows, plan)
+        if array_desc['ndims'] > 1:
+            structure = structure.reshape(_array_shape(array_desc))
+        return structure
+
+    dtype = plan['dtype']
+    if fields is not None:
+        dtype = [col for col in dtype if col[0][0] in fields]
+
     structure = np.recarray((nrows, ), dtype=dtype)
 
     for i in range(nrows):
-        for col in columns:
+        for col in struct_desc['tagtable']:
             dtype = col['typecode']
-            if col['structure']:
+            if fields is not None and col['name'].lower() not in fields:
+                if col['structure']:
+                    _skip_structure(f, struct_desc['arrtable'][col['name']],
+                                    struct_desc['structtable'][col['name']])
+                elif col['array']:
+                    _skip_array(f, dtype, struct_desc['arrtable'][col['name']])
+                else:
+                    _skip_data(f, dtype)
+            elif col['structure']:
                 structure[col['name']][i] = _read_structure(f,
                                       struct_desc['arrtable'][col['name']],
-                                      struct_desc['structtable'][col['name']])
+                                      struct_desc['structtable'][col['name']],
+                                      None if fields is None else
+                                      fields[col['name'].lower()])
             elif col['array']:
                 structure[col['name']][i] = _read_array(f, dtype,
                                       struct_desc['arrtable'][col['name']])
@@ -280,16 +608,22 @@ def _read_array(f, typecode, array_desc):
             if nbytes != array_desc['nbytes']:
                 warnings.warn("Not able to verify number of bytes from header")
 
-        # Read bytes as numpy array
-        array = np.frombuffer(f.read(array_desc['nbytes']),
-                              dtype=DTYPE_DICT[typecode])
+        # Read bytes as numpy array (or a view into a memory-mapped file)
+        dtype = np.dtype(DTYPE_DICT[typecode])
+        if isinstance(f, _MappedFile):
+            array = f.view(dtype, array_desc['nbytes'] // dtype.itemsize)
+        else:
+            array = np.frombuffer(f.read(array_desc['nbytes']), dtype=dtype)
 
     elif typecode in [2, 12]:
 
         # These are 2 byte types, need to skip every two as they are not packed
 
-        array = np.frombuffer(f.read(array_desc['nbytes']*2),
-                              dtype=DTYPE_DICT[typecode])[1::2]
+        if isinstance(f, _MappedFile):
+            array = f.view(DTYPE_DICT[typecode], array_desc['nbytes'])[1::2]
+        else:
+            array = np.frombuffer(f.read(array_desc['nbytes']*2),
+                                  dtype=DTYPE_DICT[typecode])[1::2]
 
     else:
 
@@ -314,39 +648,184 @@ def _read_array(f, typecode, array_desc):
     return array
 
 
-def _read_record(f, columns=None):
-    '''Function to read in a full record'''
+def _slab_indices(key, shape):
+    '''
+    Convert an index into an array of shape `shape` (ints, slices, ranges or
+    lists for each axis, and Ellipsis) into the selected indices along each
+    axis. Returns the indices and the axes that were indexed by an int.
+    '''
+
+    if not isinstance(key, tuple):
+        key = (key, )
+    if Ellipsis in key:
+        i = key.index(Ellipsis)
+        key = key[:i] + (slice(None), )*(len(shape) - len(key) + 1) + key[i+1:]
+    if len(key) > len(shape):
+        raise IndexError("Too many indices for array of shape %s" % (shape, ))
+    key = key + (slice(None), )*(len(shape) - len(key))
+
+    indices, squeeze = [], []
+    for axis, (k, dim) in enumerate(zip(key, shape)):
+        if isinstance(k, (int, np.integer)):
+            squeeze.append(axis)
+        if isinstance(k, range):
+            k = list(k)
+        indices.append(np.atleast_1d(np.arange(dim)[k]))
+
+    return indices, squeeze
+
+
+def _read_hyperslab(f, typecode, array_desc, key):
+    '''
+    Read part of an array of type `typecode`, starting at the current
+    position, without reading the rest of it. The positions of the selected
+    elements are computed from the array descriptor: in uncompressed files,
+    only those elements are read (through a memory map, so only the pages
+    holding them are read from disk); in compressed files, the record is only
+    decompressed from the first selected element to the last.
+    '''
+
+    if typecode not in SCALAR_LAYOUT:
+        raise ValueError("Can only read part of a numeric array")
+
+    shape = _array_shape(array_desc)
+    dtype = np.dtype(DTYPE_DICT[typecode])
+    step = 2 if typecode in [2, 12] else 1  # 2 byte types are padded
+    if typecode == 1:
+        _skip_bytes(f, 4)  # Number of bytes is repeated before the data
+
+    # Position of each selected element in the array (C order)
+    indices, squeeze = _slab_indices(key, shape)
+    strides = np.cumprod((1, ) + shape[:0:-1])[::-1]
+    grid = np.ix_(*indices)
+    flat = sum(idx*stride for idx, stride in zip(grid, strides))
+    flat = np.broadcast_to(flat, [len(idx) for idx in indices])
+
+    if flat.size == 0:
+        array = np.empty(flat.shape, dtype=dtype)
+    elif isinstance(f, _InflatedRecord):
+        first, last = flat.min(), flat.max()
+        _skip_bytes(f, first*step*dtype.itemsize)
+        data = np.frombuffer(f.read((last - first + 1)*step*dtype.itemsize),
+                             dtype=dtype)
+        array = data[(flat - first)*step + step - 1]
+    else:
+        if isinstance(f, _MappedFile):
+            file_map = f.map
+        else:
+            file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = np.frombuffer(file_map, dtype=dtype,
+                             count=array_desc['nelements']*step,
+                             offset=f.tell())
+        array = data[flat*step + step - 1]  # Copies only the selection
+        del data
+
+    return array.squeeze(axis=tuple(squeeze)) if squeeze else array
+
+
+def _seek_field(f, typedesc, field, row=0):
+    '''
+    Move from the start of the data of a structure variable to the data of
+    one field in row `row`, skipping everything before it. Returns the tag
+    descriptor of the field.
+    '''
+
+    array_desc, struct_desc = typedesc['array_desc'], typedesc['struct_desc']
+    if not 0 <= row < array_desc['nelements']:
+        raise IndexError("Row %i is out of range" % row)
+
+    tags = [col['name'].lower() for col in struct_desc['tagtable']]
+    if field.lower() not in tags:
+        raise KeyError(field)
+    tag = struct_desc['tagtable'][tags.index(field.lower())]
+
+    packed = _structure_plan(struct_desc)['packed']
+    if packed is not None:
+        # Rows are fixed-size, so the position is known
+        offset = packed.fields[tag['name']][1]
+        if tag['array'] and tag['typecode'] == 1:
+            offset -= 4  # Back to the number of bytes
+        _skip_bytes(f, row*packed.itemsize + offset)
+        return tag
+
+    rows = {'nelements': row}
+    _skip_structure(f, rows, struct_desc)
+    for col in struct_desc['tagtable']:
+        if col is tag:
+            break
+        if col['structure']:
+            _skip_structure(f, struct_desc['arrtable'][col['name']],
+                            struct_desc['structtable'][col['name']])
+        elif col['array']:
+            _skip_array(f, col['typecode'],
+                        struct_desc['arrtable'][col['name']])
+        else:
+            _skip_data(f, col['typecode'])
+
+    return tag
+
+
+def _read_record_header(f):
+    '''Read the type and the position of the next record'''
 
-    record = {'rectype': _read_long(f)}
+    rectype = _read_long(f)
 
     nextrec = _read_uint32(f)
     nextrec += _read_uint32(f) * 2**32
 
     _skip_bytes(f, 4)
 
-    if not record['rectype'] in RECTYPE_DICT:
-        raise Exception("Unknown RECTYPE: %i" % record['rectype'])
+    if not rectype in RECTYPE_DICT:
+        raise Exception("Unknown RECTYPE: %i" % rectype)
 
-    record['rectype'] = RECTYPE_DICT[record['rectype']]
+    return RECTYPE_DICT[rectype], nextrec
+
+
+def _read_record(f, columns=None, defer_heap=False):
+    '''
+    Function to read in a full record
+    columns: nested dictionary of selected variables (see _select_columns),
+        or None to read all variables
+    defer_heap: if True, heap data is not read, only its position
+    '''
+
+    rectype, nextrec = _read_record_header(f)
+
+    record = {'rectype': rectype}
 
     if record['rectype'] in ["VARIABLE", "HEAP_DATA"]:
 
+        fields = None
+        skip = False
+
         if record['rectype'] == "VARIABLE":
             record['varname'] = _read_string(f)
-            
+
             # Skip all records that don't match columns
-#             if columns is not None and record['varname'] not in columns:
-#                 return {'end':False, 'data':None}
-            
+            if columns is not None:
+                skip = record['varname'].lower() not in columns
+                if not skip:
+                    fields = columns[record['varname'].lower()]
+
         else:
             record['heap_index'] = _read_long(f)
+            skip = defer_heap
             _skip_bytes(f, 4)
 
+        # The type descriptor is always read, since it can define
+        # structures that later records refer to
         rectypedesc = _read_typedesc(f)
+        record['typedesc'] = rectypedesc
+        record['data_start'] = f.tell()  # Position of VARSTART
+
+        if skip:
 
-        if rectypedesc['typecode'] == 0:
+            record['skipped'] = True
 
-            if nextrec == f.tell():
+        elif rectypedesc['typecode'] == 0:
+
+            if nextrec == f.tell() or (isinstance(f, _InflatedRecord) and
+                                       f.at_end()):
                 record['data'] = None  # Indicates NULL value
             else:
                 raise ValueError("Unexpected type code: 0")
@@ -359,7 +838,8 @@ def _read_record(f, columns=None):
 
             if rectypedesc['structure']:
                 record['data'] = _read_structure(f, rectypedesc['array_desc'],
-                                                    rectypedesc['struct_desc'])
+                                                    rectypedesc['struct_desc'],
+                                                    fields)
             elif rectypedesc['array']:
                 record['data'] = _read_array(f, rectypedesc['typecode'],
                                                 rectypedesc['array_desc'])
@@ -428,6 +908,26 @@ def _read_record(f, columns=None):
     return record
 
 
+def _read_record_at(f, start, record=None, columns=None, defer_heap=False):
+    '''
+    Read the record that starts at `start`, and leave the file at the next
+    record. For compressed files, `record` is the _InflatedRecord used to
+    decompress it.
+    '''
+
+    f.seek(start)
+    if record is None:
+        r = _read_record(f, columns=columns, defer_heap=defer_heap)
+    else:
+        rectype, nextrec = _read_record_header(f)
+        record.reset(RECTYPE_DICT_INV[rectype], start, nextrec)
+        r = _read_record(record, columns=columns, defer_heap=defer_heap)
+        f.seek(nextrec)
+    r['start'] = start
+
+    return r
+
+
 def _read_typedesc(f):
     '''Function to read in a type descriptor'''
 
@@ -537,6 +1037,8 @@ def _read_structdesc(f):
             structdesc['supclasstable'] = [
                 _read_structdesc(f) for _ in range(structdesc['nsupclasses'])]
 
+        structdesc['fingerprint'] = _fingerprint(structdesc)
+
         STRUCT_DICT[structdesc['name']] = structdesc
 
     else:
@@ -549,6 +1051,26 @@ def _read_structdesc(f):
     return structdesc
 
 
+def _fingerprint(structdesc):
+    '''
+    Layout of a structure (tag names, types, and array shapes) as a tuple,
+    which is the same for all files that share the structure
+    '''
+
+    layout = [structdesc['name']]
+    for tag in structdesc['tagtable']:
+        layout.append((tag['name'], int(tag['typecode']), bool(tag['array']),
+                       bool(tag['structure'])))
+        if tag['array']:
+            arr = structdesc['arrtable'][tag['name']]
+            layout.append((int(arr['nbytes']), int(arr['nelements']),
+                           int(arr['ndims']), tuple(int(d) for d in arr['dims'])))
+        if tag['structure']:
+            layout.append(structdesc['structtable'][tag['name']]['fingerprint'])
+
+    return tuple(layout)
+
+
 def _read_tagdesc(f):
     '''Function to read in a tag descriptor'''
 
@@ -568,70 +1090,113 @@ def _read_tagdesc(f):
     return tagdesc
 
 
-def _replace_heap(variable, heap):
-
-    if isinstance(variable, Pointer):
+def _has_pointers(typedesc):
+    '''Check whether data with a type descriptor can contain pointers'''
+    if typedesc['structure']:
+        return len(_structure_plan(typedesc['struct_desc'])['pointers']) > 0
+    return typedesc['typecode'] in [10, 11]
 
-        while isinstance(variable, Pointer):
 
-            if variable.index == 0:
-                variable = None
-            else:
-                if variable.index in heap:
-                    variable = heap[variable.index]
-                else:
-                    warnings.warn("Variable referenced by pointer not found "
-                                  "in heap: variable will be set to None")
-                    variable = None
+def _dereference(pointer, heap):
+    '''
+    Follow a pointer (and any pointers it points to) to its heap data
+    Returns the data and its type descriptor (None for null pointers)
+    '''
 
-        replace, new = _replace_heap(variable, heap)
+    typedesc = None
+    while isinstance(pointer, Pointer):
+        if pointer.index == 0:
+            return None, None
+        if pointer.index in heap:
+            pointer, typedesc = heap[pointer.index], heap.typedescs[pointer.index]
+        else:
+            warnings.warn("Variable referenced by pointer not found "
+                          "in heap: variable will be set to None")
+            return None, None
 
-        if replace:
-            variable = new
+    return pointer, typedesc
 
-        return True, variable
 
-    elif isinstance(variable, np.core.records.recarray):
+def _replace_heap(variable, typedesc, heap):
+    '''
+    Replace the pointers in a variable with the heap data they point to, and
+    return the new variable. The type descriptors are used to only visit the
+    parts of the variable that can hold pointers, and nested data is handled
+    with a stack instead of recursion.
+    '''
 
-        # Loop over records
-        for ir, record in enumerate(variable):
+    if not _has_pointers(typedesc):
+        return variable
 
-            replace, new = _replace_heap(record, heap)
+    # Stack of (container, key, type descriptor) for values to resolve
+    holder = [variable]
+    stack = [(holder, 0, typedesc)]
 
-            if replace:
-                variable[ir] = new
+    while len(stack) > 0:
 
-        return False, variable
+        container, key, typedesc = stack.pop()
+        value = container[key]
 
-    elif isinstance(variable, np.core.records.record):
+        if value is None or not _has_pointers(typedesc):
+            continue
 
-        # Loop over values
-        for iv, value in enumerate(variable):
+        if typedesc['structure']:
 
-            replace, new = _replace_heap(value, heap)
+            # Only tags that can hold pointers
+            struct_desc = typedesc['struct_desc']
+            tags = {tag['name']: tag for tag in struct_desc['tagtable']}
+            for name in _structure_plan(struct_desc)['pointers']:
+                if name not in value.dtype.fields:
+                    continue  # Tag wasn't read
+                tag = tags[name]
+                tagdesc = {'typecode': tag['typecode'], 'array': tag['array'],
+                           'structure': tag['structure']}
+                if tag['structure']:
+                    tagdesc['struct_desc'] = struct_desc['structtable'][name]
+                column = value[name]
+                for index in np.ndindex(column.shape):
+                    stack.append((column, index, tagdesc))
 
-            if replace:
-                variable[iv] = new
+        elif isinstance(value, np.ndarray):
 
-        return False, variable
+            # Array of pointers
+            elementdesc = dict(typedesc, array=False)
+            for index in np.ndindex(value.shape):
+                stack.append((value, index, elementdesc))
 
-    elif isinstance(variable, np.ndarray):
+        else:
 
-        # Loop over values if type is np.object_
-        if variable.dtype.type is np.object_:
+            new, newdesc = _dereference(value, heap)
+            container[key] = new
+            if newdesc is not None:
+                stack.append((container, key, newdesc))
 
-            for iv in range(variable.size):
+    return holder[0]
 
-                replace, new = _replace_heap(variable.item(iv), heap)
 
-                if replace:
-                    variable.itemset(iv, new)
+class _Heap(dict):
+    '''
+    Heap that only reads a HEAP_DATA record from the file the first time a
+    pointer refers to it
+    '''
 
-        return False, variable
+    def __init__(self, f, starts, record=None):
+        dict.__init__(self)
+        self.f = f
+        self.starts = starts
+        self.record = record  # _InflatedRecord, for compressed files
+        self.typedescs = {}
 
-    else:
+    def __contains__(self, index):
+        return dict.__contains__(self, index) or index in self.starts
 
-        return False, variable
+    def __missing__(self, index):
+        pos = self.f.tell()
+        r = _read_record_at(self.f, self.starts[index], self.record)
+        self.f.seek(pos)
+        self[index] = r['data']
+        self.typedescs[index] = r['typedesc']
+        return r['data']
 
 
 class AttrDict(dict):
@@ -666,7 +1231,7 @@ class AttrDict(dict):
 
 def readsav(file_name, idict=None, python_dict=False,
             uncompressed_file_name=None, verbose=False,
-            columns=None):
+            columns=None, memmap=False):
     """
     Read an IDL .sav file.
     Parameters
@@ -683,13 +1248,24 @@ def readsav(file_name, idict=None, python_dict=False,
     uncompressed_file_name : str, optional
         This option only has an effect for .sav files written with the
         /compress option. If a file name is specified, compressed .sav
-        files are uncompressed to this file. Otherwise, readsav will use
-        the `tempfile` module to determine a temporary filename
-        automatically, and will remove the temporary file upon successfully
-        reading it in.
+        files are uncompressed to this file. Otherwise, each record is
+        decompressed in memory when it is read, and records that are
+        skipped (see `columns`) are only decompressed as far as their
+        type descriptors.
     verbose : bool, optional
         Whether to print out information about the save file, including
         the records read, and available variables.
+    columns : list of str, optional
+        Names of the variables to read (case-insensitive). Structure fields
+        can be selected with a dot, e.g. 'a.residualrms'. All other
+        variables and fields are skipped without being read, and heap data
+        is only read if a selected variable points to it. By default, all
+        variables are read.
+    memmap : bool, optional
+        For uncompressed files, memory-map the file and return numeric
+        arrays as read-only views into it, instead of copying them into
+        memory. Data is then only read from disk when the arrays are used.
+        Has no effect on compressed files.
     Returns
     -------
     idl_dict : AttrDict or dict
@@ -741,18 +1317,29 @@ def readsav(file_name, idict=None, python_dict=False,
     # files, and '\x00\x06' for compressed .sav files.
     recfmt = _read_bytes(f, 2)
 
+    # Compressed records are decompressed in memory as they are read
+    record = None
+
     if recfmt == b'\x00\x04':
-        pass
+
+        if memmap:
+            f.close()
+            f = _MappedFile(file_name)
+            f.seek(4)
+
+    elif recfmt == b'\x00\x06' and not uncompressed_file_name:
+
+        if verbose:
+            print("IDL Save file is compressed")
+
+        record = _InflatedRecord(f)
 
     elif recfmt == b'\x00\x06':
 
         if verbose:
             print("IDL Save file is compressed")
 
-        if uncompressed_file_name:
-            fout = open(uncompressed_file_name, 'w+b')
-        else:
-            fout = tempfile.NamedTemporaryFile(suffix='.sav')
+        fout = open(uncompressed_file_name, 'w+b')
 
         if verbose:
             print(" -> expanding to %s" % fout.name)
@@ -806,31 +1393,31 @@ def readsav(file_name, idict=None, python_dict=False,
     else:
         raise Exception("Invalid RECFMT: %s" % recfmt)
 
+    if columns is not None:
+        columns = _select_columns(columns)
+
     # Loop through records, and add them to the list
     while True:
-        r = _read_record(f, columns=columns)
+        r = _read_record_at(f, f.tell(), record, columns=columns,
+                            defer_heap=True)
         records.append(r)
         if 'end' in r:
             if r['end']:
                 break
 
-    # Close the file
-    f.close()
-
-    # Find heap data variables
-    heap = {}
-    for r in records:
-        if r['rectype'] == "HEAP_DATA":
-            heap[r['heap_index']] = r['data']
+    # Find heap data variables, which are read when a pointer reaches them
+    heap = _Heap(f, {r['heap_index']: r['start'] for r in records
+                     if r['rectype'] == "HEAP_DATA"}, record)
 
     # Find all variables
     for r in records:
-        if r['rectype'] == "VARIABLE":
-            replace, new = _replace_heap(r['data'], heap)
-            if replace:
-                r['data'] = new
+        if r['rectype'] == "VARIABLE" and not r.get('skipped'):
+            r['data'] = _replace_heap(r['data'], r['typedesc'], heap)
             variables[r['varname'].lower()] = r['data']
 
+    # Close the file
+    f.close()
+
     if verbose:
 
         # Print out timestamp info about the file
@@ -891,4 +1478,341 @@ def readsav(file_name, idict=None, python_dict=False,
             idict[var] = variables[var]
         return idict
     else:
-        return variables
\ No newline at end of file
+        return variables
+
+
+def readsav_probe(file_name, varnames=['header', 'tstamp_str_start'],
+                  python_dict=False):
+    """
+    Read only a few (small) variables from an IDL .sav file.
+    All other records are skipped using their offsets, so large arrays are
+    never read or decompressed.
+    Parameters
+    ----------
+    file_name : str
+        Name of the IDL save file.
+    varnames : list of str, optional
+        Names of the variables to read (case-insensitive). By default, the
+        telemetry header and start timestamp.
+    python_dict : bool, optional
+        Return a standard Python dictionary instead of an AttrDict.
+    Returns
+    -------
+    idl_dict : AttrDict or dict
+        The variables that were found in the file.
+    """
+
+    varnames = [name.lower() for name in varnames]
+    variables = {} if python_dict else AttrDict()
+
+    with open(file_name, 'rb') as f:
+
+        signature = _read_bytes(f, 2)
+        if signature != b'SR':
+            raise Exception("Invalid SIGNATURE: %s" % signature)
+
+        recfmt = _read_bytes(f, 2)
+        if recfmt not in [b'\x00\x04', b'\x00\x06']:
+            raise Exception("Invalid RECFMT: %s" % recfmt)
+        # Compressed records are only decompressed as far as they are read
+        record = _InflatedRecord(f) if recfmt == b'\x00\x06' else None
+
+        while len(variables) < len(varnames):
+
+            start = f.tell()
+            rectype, nextrec = _read_record_header(f)
+
+            if rectype == "END_MARKER":
+                break
+
+            if rectype == "VARIABLE":
+
+                if record is not None:
+                    # Only inflate enough of the record to get the name
+                    record.reset(RECTYPE_DICT_INV[rectype], start, nextrec)
+                    record.seek(16)
+                    varname = _read_string(record).lower()
+                else:
+                    varname = _read_string(f).lower()
+
+                if varname in varnames:
+                    r = _read_record_at(f, start, record)
+                    variables[varname] = r['data']
+
+            f.seek(nextrec)
+
+    return variables
+
+
+def readsav_slice(file_name, path, key=Ellipsis, row=0):
+    """
+    Read part of an array from an IDL .sav file, without reading the rest of
+    the array (or any other variable). The positions of the selected elements
+    are computed from the array's descriptor, so that in uncompressed files
+    only those elements are read from disk, and compressed files are only
+    decompressed as far as the last selected element.
+    Parameters
+    ----------
+    file_name : str
+        Name of the IDL save file.
+    path : str
+        Name of an array variable, or of an array field of a structure
+        variable (e.g. 'a.offsetcentroid').
+    key : index, optional
+        Index into the array: ints, slices, ranges or lists for each axis, and
+        Ellipsis. For example, readsav_slice(file_name, 'a.offsetcentroid',
+        np.s_[:, 10:12]) is readsav(file_name).a.offsetcentroid[0][:, 10:12]
+    row : int, optional
+        Row of the structure, for fields of structures.
+    Returns
+    -------
+    array : numpy.ndarray
+        The selected part of the array.
+    """
+
+    with LazySav(file_name) as sav:
+        return sav.read_slice(path, key, row)
+
+
+class LazySav(object):
+    """
+    Read-only view of an IDL .sav file that only reads variables when they
+    are used. Variables are accessed like the AttrDict returned by readsav
+    (sav['a'], sav.a, sav('A')), but on opening only the positions of the
+    records are indexed. Each variable is read the first time it is accessed,
+    and the fields of structures are read one at a time, so that
+    sav.a.residualrms[0][0] reads only the residualrms field of `a`.
+    Parameters
+    ----------
+    file_name : str
+        Name of the IDL save file.
+    memmap : bool, optional
+        Memory-map uncompressed files (see readsav).
+    """
+
+    def __init__(self, file_name, memmap=False):
+
+        f = open(file_name, 'rb')
+
+        signature = _read_bytes(f, 2)
+        if signature != b'SR':
+            raise Exception("Invalid SIGNATURE: %s" % signature)
+
+        recfmt = _read_bytes(f, 2)
+        record = None
+        if recfmt == b'\x00\x04':
+            if memmap:
+                f.close()
+                f = _MappedFile(file_name)
+                f.seek(4)
+        elif recfmt == b'\x00\x06':
+            record = _InflatedRecord(f)
+        else:
+            raise Exception("Invalid RECFMT: %s" % recfmt)
+
+        # Index variable and heap records, without reading their data
+        starts, typedescs, data_starts, heap_starts = {}, {}, {}, {}
+        while True:
+            r = _read_record_at(f, f.tell(), record, columns={},
+                                defer_heap=True)
+            if r.get('end'):
+                break
+            if r['rectype'] == "VARIABLE":
+                starts[r['varname'].lower()] = r['start']
+                typedescs[r['varname'].lower()] = r['typedesc']
+                data_starts[r['varname'].lower()] = r['data_start']
+            elif r['rectype'] == "HEAP_DATA":
+                heap_starts[r['heap_index']] = r['start']
+
+        self.__dict__.update(file_name=file_name, _f=f, _record=record,
+                             _starts=starts, _typedescs=typedescs,
+                             _data_starts=data_starts,
+                             _heap=_Heap(f, heap_starts, record),
+                             _variables={}, _fields={})
+
+    def _read(self, varname, fields=None):
+        '''Read a variable (or only some fields, for structures)'''
+        columns = {varname: fields}
+        r = _read_record_at(self._f, self._starts[varname], self._record,
+                            columns=columns)
+        return _replace_heap(r['data'], r['typedesc'], self._heap)
+
+    def _variable(self, varname):
+        '''Get a whole variable, reading it on first access'''
+        if varname not in self._variables:
+            self._variables[varname] = self._read(varname)
+        return self._variables[varname]
+
+    def _field(self, varname, field):
+        '''Get one field of a structure, reading it on first access'''
+        if varname in self._variables:
+            return self._variables[varname][field]
+        if (varname, field) not in self._fields:
+            self._fields[varname, field] = self._read(
+                varname, {field: None})[field]
+        return self._fields[varname, field]
+
+    def _locate(self, path, row=0, record=None):
+        '''
+        Move to the data of an array variable, or of an array field in row
+        `row` of a structure. For compressed files, `record` is the
+        _InflatedRecord to read it with (by default, the shared one).
+        Returns the file (or record) and the array's typecode and descriptor
+        '''
+        names = path.lower().split('.')
+        varname = names[0]
+        if varname not in self._starts:
+            raise KeyError(varname)
+        typedesc = self._typedescs[varname]
+        if len(names) > 2 or (len(names) == 2) != typedesc['structure']:
+            raise ValueError("%s is not an array or a field of a structure"
+                             % path)
+
+        f = self._f
+        if self._record is not None:
+            record = self._record if record is None else record
+            start = self._starts[varname]
+            f.seek(start)
+            rectype, nextrec = _read_record_header(f)
+            record.reset(RECTYPE_DICT_INV[rectype], start, nextrec)
+            f = record
+        f.seek(self._data_starts[varname] + 4)  # After VARSTART
+
+        if typedesc['structure']:
+            tag = _seek_field(f, typedesc, names[1], row)
+            if not tag['array'] or tag['structure']:
+                raise ValueError("%s is not an array" % path)
+            typecode = tag['typecode']
+            array_desc = typedesc['struct_desc']['arrtable'][tag['name']]
+        elif typedesc['array']:
+            typecode, array_desc = typedesc['typecode'], typedesc['array_desc']
+        else:
+            raise ValueError("%s is not an array" % path)
+
+        return f, typecode, array_desc
+
+    def read_slice(self, path, key=Ellipsis, row=0):
+        '''
+        Read part of an array variable, or of an array field of a structure,
+        without reading the rest of it (see readsav_slice)
+        '''
+        f, typecode, array_desc = self._locate(path, row)
+        return _read_hyperslab(f, typecode, array_desc, key)
+
+    def iter_rows(self, path, n_rows=4096, row=0):
+        '''
+        Read an array (see read_slice) `n_rows` rows (along its first axis)
+        at a time, so that the whole array is never in memory. Compressed
+        records are decompressed as the rows are read.
+        '''
+        record = None if self._record is None else _InflatedRecord(self._f)
+        f, typecode, array_desc = self._locate(path, row, record)
+        if typecode not in SCALAR_LAYOUT:
+            raise ValueError("Can only read rows of a numeric array")
+
+        shape = _array_shape(array_desc)
+        dtype = np.dtype(DTYPE_DICT[typecode])
+        step = 2 if typecode in [2, 12] else 1  # 2 byte types are padded
+        if typecode == 1:
+            _skip_bytes(f, 4)
+        row_size = int(np.prod(shape[1:]))*step
+        start = f.tell()
+
+        for i in range(0, shape[0], n_rows):
+            n = min(n_rows, shape[0] - i)
+            if record is None:
+                # The file may have been used in between
+                f.seek(start + i*row_size*dtype.itemsize)
+            data = np.frombuffer(f.read(n*row_size*dtype.itemsize),
+                                 dtype=dtype)
+            yield data[step - 1::step].reshape((n, ) + shape[1:])
+
+    def __getitem__(self, name):
+        name = name.lower()
+        if name not in self._starts:
+            raise KeyError(name)
+        if self._typedescs[name]['structure']:
+            return _LazyStructure(self, name)
+        return self._variable(name)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    __call__ = __getitem__
+
+    def __contains__(self, name):
+        return name.lower() in self._starts
+
+    def __iter__(self):
+        return iter(self._starts)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def keys(self):
+        return self._starts.keys()
+
+    def values(self):
+        return [self[name] for name in self._starts]
+
+    def items(self):
+        return [(name, self[name]) for name in self._starts]
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def close(self):
+        '''Close the file (variables that were already read can still be used)'''
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _LazyStructure(object):
+    '''
+    Structure variable in a LazySav. Fields accessed as attributes or by name
+    are read one at a time; anything else (rows, dtype, ...) reads the whole
+    structure.
+    '''
+
+    def __init__(self, sav, varname):
+        self.__dict__.update(_sav=sav, _varname=varname,
+            _tags=[tag['name'].lower() for tag in
+                   sav._typedescs[varname]['struct_desc']['tagtable']])
+
+    def _data(self):
+        '''The whole structure'''
+        return self._sav._variable(self._varname)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name.lower() in self._tags:
+            return self._sav._field(self._varname, name.lower())
+        return getattr(self._data(), name)
+
+    def __getitem__(self, key):
+        if isinstance(key, str) and key.lower() in self._tags:
+            return self._sav._field(self._varname, key.lower())
+        return self._data()[key]
+
+    def __len__(self):
+        return len(self._data())
+
+    def __iter__(self):
+        return iter(self._data())
+
+    def __array__(self, dtype=None):
+        return np.asarray(self._data(), dtype=dtype)
+
+    def __repr__(self):
+        return repr(self._data())
@@ -0,0 +1,185 @@
+### savwriter.py: Writes simple IDL .sav files (plain or compressed), including synthetic
+### files shaped like the Keck AO telemetry, for testing and benchmarking readsav_copy
+### Author: Emily Ramey
+
+import numpy as np
+import struct
+import zlib
+import time
+
+# IDL type codes for numpy types
+idl_types = {np.dtype('u1'): 1, np.dtype('i2'): 2, np.dtype('i4'): 3, np.dtype('f4'): 4,
+             np.dtype('f8'): 5, np.dtype('c8'): 6, np.dtype('c16'): 9, np.dtype('u2'): 12,
+             np.dtype('u4'): 13, np.dtype('i8'): 14, np.dtype('u8'): 15}
+string_type = 7
+rectypes = {'VARIABLE': 2, 'END_MARKER': 6, 'TIMESTAMP': 10, 'VERSION': 14}
+
+# Shape of the telemetry arrays (per frame)
+n_subaps = 304 # Subaperture intensities, two centroid offsets each
+n_actuators = 352 # Residual wavefront
+tstamp_fmt = "%Y-%m-%dT%H:%M:%S.%f"
+
+### Encoding helpers
+def pad(data):
+    """ Pads bytes to a multiple of 4 """
+    return data + b'\x00'*(-len(data) % 4)
+
+def long(value):
+    return struct.pack('>l', value)
+
+def string(value):
+    """ Encodes a string (names, etc.) """
+    data = value.encode() if isinstance(value, str) else value
+    return long(len(data)) + pad(data)
+
+def string_data(value):
+    """ Encodes a string variable (length is specified twice) """
+    if isinstance(value, np.ndarray):
+        value = value.item()
+    data = value.encode() if isinstance(value, str) else value
+    if len(data) == 0:
+        return long(0)
+    return long(len(data)) + long(len(data)) + pad(data)
+
+def type_code(value):
+    """ IDL type code of a scalar or array """
+    value = np.asarray(value)
+    if value.dtype.kind in 'SUO':
+        return string_type
+    dtype = value.dtype.newbyteorder('=')
+    if dtype not in idl_types:
+        raise ValueError(f"No IDL type for {value.dtype}")
+    return idl_types[dtype]
+
+def array_desc(value):
+    """ Encodes an array descriptor """
+    value = np.asarray(value)
+    typecode = type_code(value)
+    if typecode == string_type:
+        nbytes = sum(len(string_data(x)) for x in value.ravel())
+    elif typecode in [2, 12]:
+        nbytes = value.size*2
+    else:
+        nbytes = value.nbytes
+    dims = list(value.shape[::-1]) + [1]*(8-value.ndim)
+    return struct.pack('>9l', 8, 0, nbytes, value.size, value.ndim, 0, 0, 8, dims[0]) + \
+           struct.pack('>7l', *dims[1:])
+
+def scalar_data(value):
+    """ Encodes a scalar """
+    typecode = type_code(value)
+    if typecode == string_type:
+        return string_data(value)
+    data = np.asarray(value).astype(np.asarray(value).dtype.newbyteorder('>')).tobytes()
+    if typecode == 1:
+        return long(1) + pad(data)
+    if typecode in [2, 12]:
+        return b'\x00\x00' + data
+    return data
+
+def array_data(value):
+    """ Encodes the data of an array """
+    value = np.asarray(value)
+    typecode = type_code(value)
+    if typecode == string_type:
+        return b''.join(string_data(x) for x in value.ravel())
+    big = value.dtype.newbyteorder('>')
+    if typecode in [2, 12]:
+        # 2-byte types are padded to 4 bytes
+        padded = np.zeros(value.size*2, dtype=big)
+        padded[1::2] = value.ravel()
+        return padded.tobytes()
+    data = np.ascontiguousarray(value, dtype=big).tobytes()
+    if typecode == 1:
+        return long(value.size) + pad(data)
+    return pad(data)
+
+def struct_desc(name, fields):
+    """ Encodes a structure descriptor for a dictionary of {tag: value} """
+    tags = [(tag.upper(), np.asarray(value)) for tag, value in fields.items()]
+    desc = long(9) + string(name) + long(0) + long(len(tags)) + long(0)
+    offset = 0
+    for tag, value in tags:
+        desc += long(offset) + long(type_code(value)) + long(4 if value.ndim > 0 else 0)
+        offset += 8 if value.ndim > 0 else value.itemsize
+    for tag, value in tags:
+        desc += string(tag)
+    for tag, value in tags:
+        if value.ndim > 0:
+            desc += array_desc(value)
+    return desc
+
+def variable(name, value):
+    """ Encodes a variable record body, as a list of byte strings """
+    if isinstance(value, dict): # Structure (one row)
+        chunks = [string(name.upper()), long(8), long(36), array_desc(np.zeros(1, 'i4')),
+                  struct_desc(name.upper(), value), long(7)]
+        for field in value.values():
+            field = np.asarray(field)
+            chunks.append(array_data(field) if field.ndim > 0 else scalar_data(field))
+        return chunks
+    value = np.asarray(value) if not isinstance(value, (str, bytes)) else value
+    if isinstance(value, np.ndarray) and value.ndim > 0:
+        return [string(name.upper()), long(type_code(value)), long(4), array_desc(value),
+                long(7), array_data(value)]
+    return [string(name.upper()), long(type_code(value)), long(0), long(7), scalar_data(value)]
+
+### Writer
+def write_sav(filename, variables, compress=False):
+    """
+    Writes an IDL .sav file
+    variables: dictionary of {name: value}, where values are numpy scalars or arrays
+        (numeric or strings), strings, or dictionaries of {tag: value} for structures
+    compress: whether to write a compressed (/compress) file
+    Returns the size of each record in the file, as a list of (rectype, name, bytes)
+    """
+    records = [('TIMESTAMP', '', [b'\x00'*1024, string(time.ctime()), string('synthetic'),
+                                  string('localhost')]),
+               ('VERSION', '', [long(9), string('x86_64'), string('linux'), string('8.0')])]
+    for name, value in variables.items():
+        records.append(('VARIABLE', name, variable(name, value)))
+
+    sizes = []
+    with open(filename, 'wb') as file:
+        file.write(b'SR\x00\x06' if compress else b'SR\x00\x04')
+        for rectype, name, chunks in records:
+            if compress:
+                chunks = [zlib.compress(b''.join(chunks))]
+            nbytes = sum(len(chunk) for chunk in chunks)
+            nextrec = file.tell() + 16 + nbytes
+            file.write(struct.pack('>lIIl', rectypes[rectype], nextrec % 2**32, nextrec // 2**32, 0))
+            for chunk in chunks:
+                file.write(chunk)
+            sizes.append((rectype, name, 16+nbytes))
+        file.write(struct.pack('>lIIl', rectypes['END_MARKER'], 0, 0, 0))
+
+    return sizes
+
+def telemetry_data(n_frames, mjd=58973.5, seed=0):
+    """
+    Makes synthetic data shaped like a Keck telemetry file: the header of the matching
+    NIRC2 frame, a start timestamp, and an 'a' structure of per-frame arrays
+    """
+    rng = np.random.default_rng(seed)
+    start = np.datetime64('1858-11-17') + np.timedelta64(int(round(mjd*86400e6)), 'us')
+    header = np.array([f"{'SIMPLE':8}= {'T':>20} / Tape is in Fits format",
+                       f"{'MJD-OBS':8}= {mjd:>20.8f} / Modified Julian date",
+                       f"{'ITIME':8}= {2.8:>20.3f} / Integration time per coadd",
+                       "END"], dtype=object)
+    a = {'timestamp': np.arange(n_frames, dtype=np.uint32),
+         'subapintensity': rng.random((n_frames, n_subaps), dtype=np.float32),
+         'offsetcentroid': rng.normal(0, 0.3, (n_frames, n_subaps*2)).astype(np.float32),
+         'residualwavefront': rng.normal(0, 0.1, (n_frames, n_actuators)).astype(np.float32),
+         'residualrms': rng.random((1, n_frames), dtype=np.float32)*300,
+        }
+    tstamp = start.astype(object).strftime(tstamp_fmt)
+    return {'header': header, 'tstamp_str_start': tstamp, 'a': a}
+
+def write_telemetry(filename, n_frames, compress=False, mjd=58973.5, seed=0):
+    """
+    Writes a synthetic telemetry file with n_frames frames
+    Returns the data written (see telemetry_data)
+    """
+    data = telemetry_data(n_frames, mjd, seed)
+    write_sav(filename, data, compress)
+    return data
@@ -0,0 +1,230 @@
+### store_util.py: Storage for seeing/weather data and the combined metadata table
+### Seeing and weather data are partitioned by source (mass, dimm, masspro, cfht) and month,
+### one .npz file each, with float64 MJDs and float32 values
+### The metadata table is stored as one csv file per epoch, plus a manifest
+### Author: Emily Ramey
+
+import numpy as np
+import pandas as pd
+import os
+import glob
+import fcntl
+import time
+import yaml
+
+mjd_col = 'mjd'
+night_col = 'night' # Observation date (YYYYMMDD) of each row
+nights_key = 'nights' # All observation dates stored in a partition (including empty ones)
+lock_name = 'store.lock' # One lock file per store, held while partitions are written
+
+# Partitions already read in, as {filename: (file stats, arrays)}, oldest first
+_partitions = {}
+max_cached = 24 # Partitions kept in _partitions (a source's nights are read a month at a time)
+
+def partition_file(store_dir, source, month):
+    """ Returns the partition file for a source and month (YYYYMM) """
+    return f"{store_dir}{source}/{month}.npz"
+
+def read_partition(store_dir, source, month):
+    """
+    Reads one partition as a dictionary of arrays
+    Returns None if the partition does not exist
+    """
+    filename = partition_file(store_dir, source, month)
+    if not os.path.isfile(filename):
+        return
+
+    ### Reuse partitions that haven't changed since they were last read
+    stats = os.stat(filename)
+    stats = (stats.st_mtime_ns, stats.st_size)
+    cached = _partitions.pop(filename, None)
+    if cached is not None and cached[0] == stats:
+        _partitions[filename] = cached # Most recently used last
+        return cached[1]
+
+    with np.load(filename) as file:
+        arrays = {key: file[key] for key in file.files}
+    _partitions[filename] = (stats, arrays)
+    while len(_partitions) > max_cached: # Drop the least recently used
+        del _partitions[next(iter(_partitions))]
+
+    return arrays
+
+def to_frame(arrays, mask=None):
+    """ Converts partition arrays (or a subset of rows) to a dataframe of values and mjds """
+    cols = [key for key in arrays if key not in [night_col, nights_key, mjd_col]]+[mjd_col]
+    if mask is None:
+        return pd.DataFrame({col: arrays[col] for col in cols})
+    return pd.DataFrame({col: arrays[col][mask] for col in cols})
+
+def write_nights(store_dir, source, nights):
+    """
+    Adds nights of data to the store, replacing any rows already stored for those nights
+    nights: dictionary of {obs_date: dataframe}, each with an 'mjd' column and value columns
+    Each monthly partition is rewritten once
+    Raises a ValueError (before anything is written) if a column isn't numeric
+    """
+    ### Check the columns can be stored
+    for obs_date, data in nights.items():
+        bad_cols = [col for col in data.columns if not pd.api.types.is_numeric_dtype(data[col])]
+        if bad_cols:
+            raise ValueError(f"Non-numeric {source} columns for {obs_date}: {', '.join(bad_cols)}")
+
+    ### Group nights by month
+    months = {}
+    for obs_date, data in nights.items():
+        months.setdefault(obs_date[:6], {})[obs_date] = data
+
+    os.makedirs(store_dir+source, exist_ok=True)
+    # Lock the store so other processes don't overwrite new nights
+    with open(store_dir+lock_name, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for month, month_nights in months.items():
+            filename = partition_file(store_dir, source, month)
+
+            old = read_partition(store_dir, source, month)
+            new_dates = np.array([int(obs_date) for obs_date in month_nights], dtype=np.int32)
+
+            ### Combine old data with new nights
+            frames = []
+            stored = []
+            if old is not None:
+                keep = ~np.isin(old[night_col], new_dates)
+                frames.append(to_frame(old, keep).assign(**{night_col: old[night_col][keep]}))
+                stored.append(old[nights_key])
+            for obs_date, data in month_nights.items():
+                frames.append(data.assign(**{night_col: int(obs_date)}))
+            stored.append(new_dates)
+            data = pd.concat(frames, ignore_index=True)
+
+            ### Typed columns
+            arrays = {col: data[col].to_numpy(dtype=np.float32) for col in data.columns
+                      if col not in [night_col, mjd_col]}
+            arrays[mjd_col] = data[mjd_col].to_numpy(dtype=np.float64)
+            arrays[night_col] = data[night_col].to_numpy(dtype=np.int32)
+            arrays[nights_key] = np.unique(np.concatenate(stored)).astype(np.int32)
+
+            ### Write to a temporary file, then swap it in
+            tmp_file = f"{filename}.{os.getpid()}.tmp"
+            with open(tmp_file, 'wb') as file:
+                np.savez(file, **arrays)
+            os.replace(tmp_file, filename)
+
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+def has_night(store_dir, source, obs_date):
+    """ Checks whether a night (YYYYMMDD) is in the store """
+    arrays = read_partition(store_dir, source, obs_date[:6])
+    return arrays is not None and int(obs_date) in arrays[nights_key]
+
+def load_night(store_dir, source, obs_date):
+    """
+    Loads one night (YYYYMMDD) of data from the store as a dataframe
+    Returns None if the night is not in the store
+    """
+    arrays = read_partition(store_dir, source, obs_date[:6])
+    if arrays is None or int(obs_date) not in arrays[nights_key]:
+        return
+
+    return to_frame(arrays, arrays[night_col]==int(obs_date))
+
+def migrate_csv(seeing_dir, weather_dir, store_dir, s_types=['mass', 'dimm', 'masspro'],
+                weather_source='cfht'):
+    """
+    One-time migration of the csv seeing files (seeing_dir/YYYYMM/YYYYMMDD.{s}.dat)
+    and weather files (weather_dir/cfht-wx.YYYYMMDD.dat) into the store
+    Returns the number of nights migrated for each source
+    """
+    counts = {}
+
+    ### Seeing files
+    for s in s_types:
+        files = glob.glob(f"{seeing_dir}*/*.{s}.dat")
+        nights = {os.path.basename(file).split('.')[0]: pd.read_csv(file) for file in sorted(files)}
+        write_nights(store_dir, s, nights)
+        counts[s] = len(nights)
+
+    ### Weather files
+    files = glob.glob(f"{weather_dir}cfht-wx.????????.dat") # Skips yearly files, if any
+    nights = {os.path.basename(file).split('.')[1]: pd.read_csv(file) for file in sorted(files)}
+    write_nights(store_dir, weather_source, nights)
+    counts[weather_source] = len(nights)
+
+    return counts
+
+### Epoch store for the combined metadata table: one csv partition per epoch,
+### plus a manifest of the epochs that have been processed
+manifest_name = 'manifest.yaml'
+
+def read_manifest(table_dir, manifest=manifest_name):
+    """
+    Reads the manifest of an epoch store as {epoch: {'file': partition, 'rows': nrows}}
+    Returns an empty dictionary if there is no manifest
+    """
+    filename = table_dir+manifest
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as file:
+        entries = yaml.load(file, Loader=yaml.FullLoader)
+    return entries if entries else {}
+
+def write_manifest(table_dir, entries, manifest=manifest_name):
+    """ Writes the manifest of an epoch store, without exposing a partially written file """
+    filename = table_dir+manifest
+    tmp_file = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as file:
+        yaml.dump(entries, file, sort_keys=False)
+    os.replace(tmp_file, filename)
+
+def write_epoch(table_dir, epoch, data):
+    """
+    Adds one epoch's data to the store as a new partition and records it in the manifest
+    Partitions are never overwritten, so older manifests stay valid
+    """
+    os.makedirs(table_dir, exist_ok=True)
+    partition = f"{epoch}.{time.strftime('%Y%m%d%H%M%S')}.csv"
+    data.to_csv(table_dir+partition, index=False)
+
+    entries = read_manifest(table_dir)
+    entries[epoch] = {'file': partition, 'rows': len(data)}
+    write_manifest(table_dir, entries)
+
+def snapshot_manifest(table_dir, label):
+    """
+    Backs up the current state of an epoch store by copying its manifest
+    Returns the name of the backup manifest, or None if the store is empty
+    """
+    entries = read_manifest(table_dir)
+    if len(entries) == 0:
+        return
+    backup = f"manifest_backup_{label}.yaml"
+    write_manifest(table_dir, entries, manifest=backup)
+    return backup
+
+def iter_epochs(table_dir, epochs=None, manifest=manifest_name):
+    """
+    Yields the data for each epoch in a store (in the order they were added), one at a time
+    epochs: list of epochs to read (all epochs by default)
+    manifest: manifest (or backup manifest) to read from
+    """
+    for epoch, entry in read_manifest(table_dir, manifest).items():
+        if epochs is not None and epoch not in epochs:
+            continue
+        yield pd.read_csv(table_dir+entry['file'])
+
+def read_table(table_dir, epochs=None, manifest=manifest_name):
+    """ Reassembles the full table (or some epochs) from an epoch store """
+    frames = list(iter_epochs(table_dir, epochs, manifest))
+    if len(frames) == 0:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+def split_table(filename, table_dir, epoch_col='epoch'):
+    """
+    One-time migration of a single csv table into an epoch store
+    Returns the number of epochs written
+    """
+    data = pd.read_csv(filename)
+    for epoch, epoch_data in data.groupby(epoch_col, sort=False):
+        write_epoch(table_dir, epoch, epoch_data)
+    return data[epoch_col].nunique()
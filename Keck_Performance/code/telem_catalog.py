@@ -0,0 +1,104 @@
+### telem_catalog.py: Keeps a SQLite catalog of the telemetry archive, so telemetry files
+### can be looked up by date and file number without searching the directory tree
+### Author: Emily Ramey
+
+import sqlite3
+import os
+import re
+
+# Telemetry files look like {telem_dir}/{date}*/**/n?{filenum}_*.sav
+telem_name_match = r"^n.(\d+)_.*\.sav$"
+
+def connect(db_file):
+    """ Opens (and sets up, if needed) the catalog database """
+    db_dir = os.path.dirname(db_file)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(db_file, timeout=60)
+    conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                        path TEXT PRIMARY KEY,
+                        date TEXT,
+                        filenum TEXT,
+                        size INTEGER,
+                        mtime REAL,
+                        mjd REAL)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS file_match ON files (date, filenum)")
+    conn.commit()
+    return conn
+
+def file_entry(telem_dir, path):
+    """
+    Catalog row (path, date, filenum, size, mtime) for a file in the telemetry directory
+    Returns None if the path isn't a telemetry file in a night directory
+    """
+    # Top-level directory starts with the date
+    night_dir = os.path.relpath(os.path.dirname(path), telem_dir).split(os.sep)[0]
+    match = re.match(telem_name_match, os.path.basename(path))
+    if not match or night_dir in ['.', '..']:
+        return
+    stats = os.stat(path)
+    return (path, night_dir[:8], match[1], stats.st_size, stats.st_mtime)
+
+def refresh(db_file, telem_dir):
+    """
+    Updates the catalog with one walk of the telemetry directory
+    New files are added, files whose size or modification time changed are
+    reset (their MJD will be extracted again), and deleted files are removed
+    Returns the number of new, changed, and removed files
+    """
+    conn = connect(db_file)
+    known = {path: (size, mtime) for path, size, mtime in
+             conn.execute("SELECT path, size, mtime FROM files")}
+
+    ### Walk the telemetry directory
+    new, changed = [], []
+    found = set()
+    for root, dirs, files in os.walk(telem_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            entry = file_entry(telem_dir, path)
+            if entry is None:
+                continue
+            found.add(path)
+
+            if path not in known:
+                new.append(entry)
+            elif known[path] != entry[3:]:
+                changed.append(entry)
+
+    removed = [(path,) for path in known if path not in found]
+
+    ### Update the database
+    conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, NULL)", new)
+    conn.executemany("""UPDATE files SET date=?, filenum=?, size=?, mtime=?, mjd=NULL
+                        WHERE path=?""", [entry[1:]+entry[:1] for entry in changed])
+    conn.executemany("DELETE FROM files WHERE path=?", removed)
+    conn.commit()
+    conn.close()
+
+    return len(new), len(changed), len(removed)
+
+def find_files(conn, datestring, filenum):
+    """
+    Looks up the telemetry files for a date (YYYYMMDD) and NIRC2 file number
+    Returns a list of (path, mjd), with mjd None if it hasn't been extracted yet
+    """
+    rows = conn.execute("SELECT path, mjd FROM files WHERE date=? AND filenum=? ORDER BY path",
+                        (datestring, filenum))
+    return rows.fetchall()
+
+def add_files(conn, telem_dir, paths):
+    """
+    Adds telemetry files found since the last refresh to the catalog
+    (files already in it are reset, as in refresh)
+    """
+    entries = [entry for entry in (file_entry(telem_dir, path) for path in paths)
+               if entry is not None]
+    conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, NULL)", entries)
+    conn.commit()
+    return len(entries)
+
+def set_mjd(conn, path, mjd):
+    """ Saves the MJD extracted from a telemetry file """
+    conn.execute("UPDATE files SET mjd=? WHERE path=?", (mjd, path))
+    conn.commit()
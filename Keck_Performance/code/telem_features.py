@@ -0,0 +1,181 @@
+### telem_features.py: Computes per-subaperture centroid statistics and per-actuator wavefront
+### statistics for every telemetry file, stored as float32 (files x channels) matrices that can
+### be memory-mapped, so queries across nights are array slices
+### Author: Emily Ramey
+
+import numpy as np
+import pandas as pd
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import telem_store
+import telem_moments
+
+# Usage Message
+usage = f"Usage: {sys.argv[0]} [telem_dir] [feature_dir] [workers]"
+
+telem_dir = "/g/lu/data/keck_telemetry/"
+feature_dir = "/g/lu/data/keck_telemetry_features/"
+index_name = 'index.csv' # Row index of the matrices: filename, mjd, done, error
+
+n_subaps = 304 # Centroid offsets have an x and y column for each subaperture
+n_actuators = 352 # Residual wavefront columns
+# Features, with their number of channels
+features = {'x_mean': n_subaps, 'x_std': n_subaps, 'y_mean': n_subaps, 'y_std': n_subaps,
+            'wf_std': n_actuators}
+
+### Feature extraction
+def file_features(filename, store_dir=telem_store.store_dir):
+    """
+    Computes the features of one telemetry file: mean and standard deviation of the x and y
+    centroid offsets of each subaperture, and standard deviation of each actuator's residual
+    wavefront
+    Returns the file's MJD and a dictionary of {feature: float32 array}
+    """
+    telem = telem_store.open_telem(filename, store_dir, telem_dir)
+    mjd = telem_store.get_telem_mjd(telem)
+
+    # Streamed in chunks of frames, so the whole arrays are never in memory
+    offsets = telem_moments.array_moments(telem, 'a.offsetcentroid')
+    if len(offsets.mean) != n_subaps*2:
+        raise ValueError(f"offsetcentroid has {len(offsets.mean)} columns, expected {n_subaps*2}")
+    values = {'x_mean': offsets.mean[0::2], 'x_std': offsets.std()[0::2],
+              'y_mean': offsets.mean[1::2], 'y_std': offsets.std()[1::2]}
+
+    wavefront = telem_moments.array_moments(telem, 'a.residualwavefront')
+    if len(wavefront.mean) != n_actuators:
+        raise ValueError(f"residualwavefront has {len(wavefront.mean)} columns, expected {n_actuators}")
+    values['wf_std'] = wavefront.std()
+    telem.close()
+
+    return mjd, {name: value.astype(np.float32) for name, value in values.items()}
+
+def try_features(filename, store_dir=telem_store.store_dir):
+    """ Runs file_features, returns (mjd, values, error) with error None if it worked """
+    try:
+        mjd, values = file_features(filename, store_dir)
+    except Exception as e:
+        return None, None, f"{type(e).__name__}: {e}"
+    return mjd, values, None
+
+### Storage
+def matrix_file(feature_dir, name):
+    return f"{feature_dir}{name}.npy"
+
+def write_index(feature_dir, index):
+    """ Writes the row index (through a temporary file, so it's never left half-written) """
+    filename = feature_dir+index_name
+    tmp_file = f"{filename}.{os.getpid()}.tmp"
+    index.to_csv(tmp_file, index=False)
+    os.replace(tmp_file, filename)
+
+def load(feature_dir=feature_dir, mode='r'):
+    """
+    Opens the feature matrices
+    Returns the row index (a dataframe of filename, mjd, done, error) and a dictionary
+    of {feature: memory-mapped (files x channels) matrix}, or None, None if there are none
+    e.g. the x centroid sigma of subaperture 100 in every file is matrices['x_std'][:, 100]
+    """
+    if not os.path.isfile(feature_dir+index_name):
+        return None, None
+    index = pd.read_csv(feature_dir+index_name, keep_default_na=False, na_values={'mjd': ['']},
+                        dtype={'filename': str, 'error': str})
+    matrices = {name: np.load(matrix_file(feature_dir, name), mmap_mode=mode)
+                for name in features}
+    return index, matrices
+
+def resize(feature_dir, filenames):
+    """
+    Sets up the matrices for a list of files, keeping the rows of files that are already done
+    (rows of files that aren't in filenames are dropped)
+    Returns the row index and the matrices, opened for writing
+    """
+    old_index, old = load(feature_dir)
+    if old_index is not None and list(old_index['filename']) == list(filenames):
+        del old
+        return load(feature_dir, mode='r+')
+
+    index = pd.DataFrame({'filename': filenames, 'mjd': np.nan, 'done': False, 'error': ''})
+    new_rows, old_rows = [], []
+    if old_index is not None:
+        old_row = {filename: i for i, filename in enumerate(old_index['filename'])
+                   if old_index['done'][i]}
+        new_rows = [i for i, filename in enumerate(filenames) if filename in old_row]
+        old_rows = [old_row[filenames[i]] for i in new_rows]
+        index.loc[new_rows, ['mjd', 'done']] = old_index.loc[old_rows, ['mjd', 'done']].values
+
+    ### Write the new matrices next to the old ones, then replace them
+    for name, width in features.items():
+        tmp_file = f"{matrix_file(feature_dir, name)}.{os.getpid()}.tmp.npy"
+        matrix = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32,
+                                           shape=(len(filenames), width))
+        matrix[:] = np.nan
+        if new_rows:
+            matrix[new_rows] = old[name][old_rows]
+        matrix.flush()
+        del matrix
+        os.replace(tmp_file, matrix_file(feature_dir, name))
+    del old
+    write_index(feature_dir, index)
+
+    return load(feature_dir, mode='r+')
+
+def build(filenames, feature_dir=feature_dir, workers=1, store_dir=telem_store.store_dir,
+          save_every=100):
+    """
+    Computes the features of every file that isn't done yet (resumable)
+    The matrices have one row per file, in the order of filenames; rows of files that
+    failed are left as NaN, and the error is saved in the index
+    workers: number of processes to read files with
+    save_every: number of files between saves of the index
+    Returns the number of files computed, and a list of (filename, error) for files that failed
+    """
+    os.makedirs(feature_dir, exist_ok=True)
+    index, matrices = resize(feature_dir, filenames)
+    todo = [i for i in range(len(index)) if not index['done'][i]]
+    print(f"{len(filenames)} telemetry files, {len(todo)} to compute")
+
+    files = [filenames[i] for i in todo]
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(try_features, files, [store_dir]*len(files), chunksize=4)
+    else:
+        executor = None
+        results = (try_features(file, store_dir) for file in files)
+
+    ### Save each file's row as it comes in
+    failed = []
+    for n, (i, (mjd, values, error)) in enumerate(zip(todo, results)):
+        if error is None:
+            for name, value in values.items():
+                matrices[name][i] = value
+            index.loc[i, ['mjd', 'done', 'error']] = [mjd, True, '']
+        else:
+            print(f"Could not read {filenames[i]}: {error}")
+            index.loc[i, 'error'] = error
+            failed.append((filenames[i], error))
+        if (n+1)%save_every==0: # Rows are saved before the index that marks them done
+            for matrix in matrices.values():
+                matrix.flush()
+            write_index(feature_dir, index)
+
+    if executor is not None:
+        executor.shutdown()
+    for matrix in matrices.values():
+        matrix.flush()
+    write_index(feature_dir, index)
+
+    return len(todo)-len(failed), failed
+
+if __name__=='__main__':
+    if len(sys.argv) > 4:
+        print(usage)
+        sys.exit()
+    args = sys.argv[1:]
+    telem_dir = args[0] if len(args) > 0 else telem_dir
+    feature_dir = args[1] if len(args) > 1 else feature_dir
+    workers = int(args[2]) if len(args) > 2 else 1
+    filenames = sorted(glob.glob(telem_dir+"**/*.sav", recursive=True))
+    computed, failed = build(filenames, feature_dir, workers)
+    print(f"Computed features for {computed} files ({len(failed)} failed), saved to {feature_dir}")
@@ -0,0 +1,174 @@
+### telem_moments.py: One-pass statistics (mean, variance, min/max, and optional quantiles) of each
+### channel of telemetry arrays, computed from chunks of frames so the whole array never has to be
+### in memory. Partial results merge exactly, so files or time ranges can be reduced across workers
+### Author: Emily Ramey
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import telem_store
+
+telem_dir = "/g/lu/data/keck_telemetry/"
+time_chunk = 4096 # Frames read at a time
+sketch_size = 512 # Values kept per level of a quantile sketch
+
+class QuantileSketch(object):
+    """
+    Mergeable quantile sketch of each channel, made of levels of compactors (as in the KLL
+    sketch): values are added to level 0, and when a level has more than `size` values, they
+    are sorted and every other one (starting from a random one of the first two) moves up to
+    the next level, where each value stands for twice as many frames
+    Quantiles are accurate to roughly log2(frames/size)/size in rank
+    """
+    def __init__(self, size=sketch_size, seed=None):
+        self.size = size
+        self.levels = [] # Values (values x channels) at each level, with weight 2**level
+        self.rng = np.random.default_rng(seed)
+
+    def _push(self, level, values):
+        """ Adds values to a level, compacting it into the next level if it's full """
+        while len(self.levels) <= level:
+            self.levels.append(None)
+        if self.levels[level] is not None:
+            values = np.concatenate([self.levels[level], values])
+        if len(values) <= self.size:
+            self.levels[level] = values
+            return
+        values = np.sort(values, axis=0)
+        keep = len(values)%2 # With an odd number, the largest values stay on this level
+        self.levels[level] = values[len(values)-keep:] if keep else None
+        self._push(level+1, values[self.rng.integers(2):len(values)-keep:2])
+
+    def add(self, values):
+        """ Adds a chunk of frames (frames x channels) """
+        self._push(0, np.asarray(values, dtype=np.float32))
+        return self
+
+    def merge(self, other):
+        """ Adds the values of another sketch of the same channels """
+        for level, values in enumerate(other.levels):
+            if values is not None:
+                self._push(level, values)
+        return self
+
+    def quantile(self, q):
+        """ Returns the q-th quantile(s) of each channel (q between 0 and 1) """
+        levels = [(level, values) for level, values in enumerate(self.levels) if values is not None]
+        values = np.concatenate([values for level, values in levels])
+        weights = np.concatenate([np.full(len(values), 2.**level) for level, values in levels])
+
+        ### Weighted rank of each channel's sorted values
+        order = np.argsort(values, axis=0)
+        values = np.take_along_axis(values, order, axis=0)
+        ranks = np.cumsum(weights[order], axis=0)
+        index = [np.argmax(ranks >= qi*ranks[-1], axis=0) for qi in np.atleast_1d(q)]
+        result = np.array([np.take_along_axis(values, i[None], axis=0)[0] for i in index])
+        return result if np.ndim(q) else result[0]
+
+class Moments(object):
+    """
+    Streaming statistics of each channel (column) of a sequence of (frames x channels) chunks
+    Each chunk's mean and sum of squared deviations are merged into the totals with the parallel
+    form of Welford's algorithm, and other Moments (of other chunks, files, or workers) can be
+    merged the same way, with the same result as computing the statistics of everything at once
+    quantiles: whether to keep a quantile sketch as well
+    """
+    def __init__(self, quantiles=False, sketch_size=sketch_size, seed=None):
+        self.count = 0
+        self.mean = self.m2 = self.min = self.max = None
+        self.sketch = QuantileSketch(sketch_size, seed) if quantiles else None
+
+    def _combine(self, count, mean, m2, lo, hi):
+        """ Merges the statistics of another part of the data """
+        if self.count == 0:
+            self.count, self.mean, self.m2, self.min, self.max = count, mean, m2, lo, hi
+            return
+        total = self.count+count
+        delta = mean-self.mean
+        self.mean = self.mean+delta*(count/total)
+        self.m2 = self.m2+m2+delta**2*(self.count*count/total)
+        self.min = np.minimum(self.min, lo)
+        self.max = np.maximum(self.max, hi)
+        self.count = total
+
+    def add(self, chunk):
+        """ Adds a chunk of frames (frames x channels, or frames for one channel) """
+        chunk = np.asarray(chunk)
+        if len(chunk) == 0:
+            return self
+        mean = np.mean(chunk, axis=0, dtype=np.float64)
+        m2 = np.sum((chunk-mean)**2, axis=0)
+        self._combine(len(chunk), mean, m2, chunk.min(axis=0), chunk.max(axis=0))
+        if self.sketch is not None:
+            self.sketch.add(chunk.reshape(len(chunk), -1))
+        return self
+
+    def merge(self, other):
+        """ Adds the statistics of another Moments (e.g. from another worker) """
+        if other.count > 0:
+            self._combine(other.count, other.mean, other.m2, other.min, other.max)
+        if self.sketch is not None and other.sketch is not None:
+            self.sketch.merge(other.sketch)
+        return self
+
+    def pooled(self):
+        """
+        Returns the Moments of all channels together (without quantiles)
+        With no data added, its count is 0 and its statistics are NaN
+        """
+        pooled = Moments()
+        if self.count == 0:
+            pooled.mean = pooled.m2 = pooled.min = pooled.max = np.float64(np.nan)
+            return pooled
+        means = np.ravel(self.mean)
+        m2 = np.sum(self.m2)+self.count*np.sum((means-means.mean())**2)
+        pooled._combine(self.count*len(means), means.mean(), m2, np.min(self.min), np.max(self.max))
+        return pooled
+
+    def variance(self, ddof=0):
+        return self.m2/(self.count-ddof)
+
+    def std(self, ddof=0):
+        return np.sqrt(self.variance(ddof))
+
+    def quantile(self, q):
+        """ Approximate q-th quantile(s) of each channel, from the sketch """
+        if self.sketch is None:
+            raise ValueError("Quantiles weren't kept (use quantiles=True)")
+        result = self.sketch.quantile(q)
+        return result.reshape(result.shape[:-1]+np.shape(self.mean))
+
+### Telemetry files
+def array_moments(telem, path, quantiles=False, n_rows=time_chunk):
+    """
+    Streams an array of an open telemetry file (see telem_store.open_telem), e.g.
+    'a.offsetcentroid', n_rows frames at a time, returns its Moments
+    """
+    moments = Moments(quantiles)
+    for chunk in telem.iter_rows(path, n_rows):
+        moments.add(chunk)
+    return moments
+
+def file_moments(filename, path, quantiles=False, store_dir=telem_store.store_dir):
+    """ Returns the Moments of an array in one telemetry file """
+    telem = telem_store.open_telem(filename, store_dir, telem_dir)
+    moments = array_moments(telem, path, quantiles)
+    telem.close()
+    return moments
+
+def reduce_files(filenames, path, quantiles=False, workers=1, store_dir=telem_store.store_dir):
+    """
+    Returns the Moments of an array over all frames of many telemetry files, computing
+    each file on a pool of processes and merging the results
+    """
+    n = len(filenames)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(file_moments, filenames, [path]*n, [quantiles]*n,
+                                        [store_dir]*n))
+    else:
+        results = [file_moments(filename, path, quantiles, store_dir) for filename in filenames]
+
+    moments = Moments(quantiles)
+    for result in results:
+        moments.merge(result)
+    return moments
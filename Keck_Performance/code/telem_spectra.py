@@ -0,0 +1,239 @@
+### telem_spectra.py: Temporal power spectra of the telemetry (residual wavefront, centroid offsets,
+### and tip-tilt centroids), with vibration peaks found above the noise floor, summarized into
+### one row per telemetry file that can be joined to the metadata table
+### Author: Emily Ramey
+
+import numpy as np
+import pandas as pd
+import glob
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
+import telem_store
+
+# Usage Message
+usage = f"Usage: {sys.argv[0]} [telem_dir] [savefile] [workers]"
+
+telem_dir = "/g/lu/data/keck_telemetry/"
+savefile = "../data/telem_spectra.dat"
+
+# Channel groups: {name: (variable, columns)}, columns None for all of them
+groups = {'wavefront': ('a.residualwavefront', None),
+          'centroid': ('a.offsetcentroid', None),
+          'tiptilt_x': ('b.dttcentroids', 0),
+          'tiptilt_y': ('b.dttcentroids', 1)}
+
+### Spectrum settings
+default_rate = 1000. # WFS frame rate (Hz) if the header has no WSFRRT (with a warning)
+nperseg = 1024 # Frames per Welch segment
+overlap = 0.5 # Fraction of each segment overlapping the next
+batch_bytes = 2**26 # Memory used for the segments transformed at once
+band_edges = [0, 1, 10, 100, np.inf] # Frequency bands (Hz) to sum the power in
+
+### Peak settings
+floor_width = 31 # Frequency bins in the running median used as the noise floor
+peak_snr = 5. # Minimum ratio of a peak to the noise floor
+n_peaks = 3 # Peaks saved per channel group
+
+def welch(data, rate, nperseg=nperseg, overlap=overlap):
+    """
+    Welch-averaged power spectral density of each channel (column) of data (frames x channels)
+    Segments have their mean removed and a Hann window applied, and batches of segments are
+    transformed for all channels at once with one real FFT
+    Returns the frequencies (Hz) and the one-sided PSD (frequencies x channels, units^2/Hz)
+    """
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data[:, None]
+    nperseg = min(nperseg, len(data))
+    step = max(nperseg-int(nperseg*overlap), 1)
+    starts = np.arange(0, len(data)-nperseg+1, step)
+    window = 0.5-0.5*np.cos(2*np.pi*np.arange(nperseg)/nperseg) # Periodic Hann
+
+    ### Sum the power of each segment, a batch of segments at a time
+    segments = sliding_window_view(data, nperseg, axis=0) # segments x channels x frames
+    batch = max(batch_bytes // (data.shape[1]*nperseg*8), 1)
+    power = np.zeros((data.shape[1], nperseg//2+1))
+    for i in range(0, len(starts), batch):
+        chunk = segments[starts[i:i+batch]].astype(np.float64)
+        chunk -= chunk.mean(axis=-1, keepdims=True)
+        chunk *= window
+        power += (np.abs(np.fft.rfft(chunk, axis=-1))**2).sum(axis=0)
+
+    ### Scale to a one-sided density
+    psd = power.T/(len(starts)*rate*(window**2).sum())
+    psd[1:-1 if nperseg%2==0 else None] *= 2
+    freqs = np.fft.rfftfreq(nperseg, 1/rate)
+
+    return freqs, psd
+
+def noise_floor(psd, width=floor_width):
+    """ Noise floor of a 1D PSD: its running median over `width` frequency bins """
+    width = min(width, len(psd)) | 1 # Odd, so it's centered
+    padded = np.pad(psd, width//2, mode='edge')
+    return np.median(sliding_window_view(padded, width), axis=1)
+
+def find_peaks(freqs, psd, snr=peak_snr, width=floor_width):
+    """
+    Finds peaks of a 1D PSD that stand out above its noise floor
+    Returns a list of (frequency, power, ratio to the floor), highest ratio first
+    """
+    floor = noise_floor(psd, width)
+    ratio = np.divide(psd, floor, out=np.zeros_like(psd), where=floor>0)
+    # Local maxima, leaving out the constant (0 Hz) bin
+    inside = np.arange(2, len(psd)-1)
+    is_peak = (ratio[inside] > ratio[inside-1]) & (ratio[inside] >= ratio[inside+1]) & \
+              (ratio[inside] > snr)
+    peaks = inside[is_peak]
+    peaks = peaks[np.argsort(-ratio[peaks])]
+    return [(freqs[i], psd[i], ratio[i]) for i in peaks]
+
+def band_power(freqs, psd, edges=band_edges):
+    """ Power (variance) in each frequency band of a 1D PSD """
+    df = freqs[1]-freqs[0]
+    return [psd[(freqs >= lo) & (freqs < hi)].sum()*df for lo, hi in zip(edges[:-1], edges[1:])]
+
+### Telemetry files
+def get_frame_rate(telem):
+    """
+    Reads the frame rate of the wavefront sensor (WSFRRT) from the telemetry header
+    Returns None if the header doesn't have it
+    """
+    if 'header' in telem.keys():
+        for line in telem.header:
+            line = line.decode('utf-8') if isinstance(line, bytes) else str(line)
+            if line.startswith('WSFRRT'):
+                return float(line.split('=')[1].split('/')[0].strip(" '"))
+    return None
+
+def frame_times(telem, struct):
+    """ Timestamps of a structure's frames (as floats), or None if it has none """
+    try:
+        return np.ravel(telem.read_slice(f"{struct}.timestamp")).astype(np.float64)
+    except (KeyError, ValueError, AttributeError):
+        return None
+
+def sample_rate(telem, path, wfs_rate, n_frames, n_wfs_frames):
+    """
+    Sampling rate (Hz) of an array of n_frames frames
+    Arrays in the 'a' structure are recorded every WFS frame (WSFRRT), but other structures
+    (e.g. the DTT tip-tilt centroids in 'b') come from a separate loop that doesn't have to run
+    at the WFS rate, so their rate is scaled from the WFS rate by the spacing of their
+    timestamps, or without timestamps, by their number of frames over the same recording
+    Returns the rate, and whether it could be checked against the WFS frames
+    """
+    struct = path.split('.')[0]
+    if struct == 'a':
+        return wfs_rate, True
+
+    ### Compare the frame spacing of both structures (the timestamps share one clock)
+    times, wfs_times = frame_times(telem, struct), frame_times(telem, 'a')
+    if times is not None and wfs_times is not None and len(times) > 1 and len(wfs_times) > 1:
+        spacing = (times[-1]-times[0])/(len(times)-1)
+        wfs_spacing = (wfs_times[-1]-wfs_times[0])/(len(wfs_times)-1)
+        if spacing > 0 and wfs_spacing > 0:
+            return wfs_rate*wfs_spacing/spacing, True
+
+    ### Otherwise compare the number of frames
+    if n_wfs_frames:
+        return wfs_rate*n_frames/n_wfs_frames, True
+    return wfs_rate, False
+
+def group_summary(name, freqs, psd):
+    """ Summary columns of one channel group, from its channel-averaged PSD """
+    mean_psd = psd.mean(axis=1)
+    summary = {f"{name}_power": mean_psd.sum()*(freqs[1]-freqs[0])}
+    for (lo, hi), power in zip(zip(band_edges[:-1], band_edges[1:]), band_power(freqs, mean_psd)):
+        band = f"{lo:g}_{hi:g}hz" if np.isfinite(hi) else f"{lo:g}hz_up"
+        summary[f"{name}_power_{band}"] = power
+    peaks = find_peaks(freqs, mean_psd)
+    for k in range(n_peaks):
+        freq, power, ratio = peaks[k] if k < len(peaks) else (np.nan, np.nan, np.nan)
+        summary[f"{name}_peak{k+1}_freq"] = freq
+        summary[f"{name}_peak{k+1}_snr"] = ratio
+    return summary
+
+def file_spectra(filename, store_dir=telem_store.store_dir, frame_rate=None):
+    """
+    Computes the PSDs of one telemetry file
+    frame_rate: WFS frame rate (Hz), read from the header by default
+    Returns the file's MJD, the WFS frame rate, and a dictionary of {group: (freqs, psd)}
+    (groups that aren't in the file are left out); groups outside the 'a' structure have
+    their own rate (see sample_rate), which sets the range of their freqs
+    """
+    telem = telem_store.open_telem(filename, store_dir, telem_dir)
+    mjd = telem_store.get_telem_mjd(telem)
+    rate = get_frame_rate(telem) if frame_rate is None else frame_rate
+    if rate is None:
+        print(f"Warning: no WSFRRT in the header of {filename}, assuming {default_rate:g} Hz")
+        rate = default_rate
+
+    spectra, arrays, rates = {}, {}, {}
+    for name, (path, columns) in groups.items():
+        if path not in arrays:
+            try:
+                arrays[path] = telem.read_slice(path)
+            except (KeyError, ValueError, AttributeError): # Not in this file
+                arrays[path] = None
+                continue
+            wfs_frames = [len(array) for key, array in arrays.items()
+                          if key.startswith('a.') and array is not None]
+            rates[path], checked = sample_rate(telem, path, rate, len(arrays[path]),
+                                               wfs_frames[0] if wfs_frames else None)
+            if not checked:
+                print(f"Warning: could not check the sampling rate of {path} in {filename}, "
+                      f"assuming the WFS rate ({rate:g} Hz)")
+        if arrays[path] is None:
+            continue
+        data = arrays[path] if columns is None else arrays[path][:, columns]
+        spectra[name] = welch(data, rates[path])
+    telem.close()
+
+    return mjd, rate, spectra
+
+def file_summary(filename, store_dir=telem_store.store_dir):
+    """ Returns the summary row of one telemetry file, with an error if it couldn't be read """
+    row = {'filename': filename, 'error': ''}
+    try:
+        mjd, rate, spectra = file_spectra(filename, store_dir)
+    except Exception as e:
+        row['error'] = f"{type(e).__name__}: {e}"
+        return row
+    row.update(mjd=mjd, frame_rate=rate)
+    for name, (freqs, psd) in spectra.items():
+        row.update(group_summary(name, freqs, psd))
+    return row
+
+def summarize(filenames, workers=1, store_dir=telem_store.store_dir):
+    """
+    Computes the spectral summary of each telemetry file, on a pool of processes
+    Returns a dataframe with one row per file (filename, mjd, frame_rate, and the power and
+    peaks of each channel group); files that couldn't be read have an error instead
+    """
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            rows = list(executor.map(file_summary, filenames, [store_dir]*len(filenames),
+                                     chunksize=4))
+    else:
+        rows = [file_summary(filename, store_dir) for filename in filenames]
+
+    for row in rows:
+        if row['error']:
+            print(f"Could not read {row['filename']}: {row['error']}")
+
+    data = pd.DataFrame(rows)
+    first = [col for col in ['filename', 'mjd', 'frame_rate'] if col in data.columns]
+    return data[first+[col for col in data.columns if col not in first+['error']]+['error']]
+
+if __name__=='__main__':
+    if len(sys.argv) > 4:
+        print(usage)
+        sys.exit()
+    args = sys.argv[1:]
+    telem_dir = args[0] if len(args) > 0 else telem_dir
+    savefile = args[1] if len(args) > 1 else savefile
+    workers = int(args[2]) if len(args) > 2 else 1
+    filenames = sorted(glob.glob(telem_dir+"**/*LGS*.sav", recursive=True))
+    data = summarize(filenames, workers)
+    data.to_csv(savefile, index=False)
+    print(f"Data saved to {savefile}")
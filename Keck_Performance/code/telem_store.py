@@ -0,0 +1,396 @@
+### telem_store.py: Converts telemetry .sav files into a chunked, compressed array store,
+### so they don't need to be parsed again, and reads them back with slice-level access
+### Each .sav file becomes a directory with an attrs.yaml (file metadata and array layout)
+### and one directory of zlib-compressed chunks per array, split along time x subaperture
+### Author: Emily Ramey
+
+import numpy as np
+import glob
+import os
+import re
+import sys
+import zlib
+import yaml
+from concurrent.futures import ProcessPoolExecutor
+from readsav_copy import readsav, LazySav
+from time_util import mjd_epoch
+
+# Usage Message
+usage = f"Usage: {sys.argv[0]} [telem_dir] [store_dir] [workers]"
+
+telem_dir = "/g/lu/data/keck_telemetry/"
+store_dir = "/g/lu/data/keck_telemetry_store/"
+telem_name_match = r"^n.(\d+)_.*\.sav$" # Same as telem_catalog
+attrs_name = 'attrs.yaml' # Written last, so a group with attrs is complete
+
+time_chunk = 4096 # Frames per chunk
+subap_chunk = 64 # Subapertures (or actuators) per chunk
+level = 1 # zlib compression level
+
+### Writing
+def group_dir(sav_file, telem_dir=telem_dir, store_dir=store_dir):
+    """ Returns the store directory for a telemetry file (mirrors the archive layout) """
+    rel_path = os.path.relpath(sav_file, telem_dir)
+    return os.path.join(store_dir, os.path.splitext(rel_path)[0])+'/'
+
+def file_info(sav_file, telem_dir=telem_dir):
+    """ Date, file number, and mode (LGS/NGS) of a telemetry file, from its path """
+    name = os.path.basename(sav_file)
+    match = re.match(telem_name_match, name)
+    night_dir = os.path.relpath(sav_file, telem_dir).split(os.sep)[0]
+    return {'date': night_dir[:8] if night_dir != name else None,
+            'filenum': match[1] if match else None,
+            'mode': 'LGS' if 'LGS' in name else 'NGS'}
+
+def chunk_shape(shape, n_frames):
+    """ Chunks run along time (axes with n_frames entries) and subapertures (all other axes) """
+    return [min(dim, time_chunk) if dim == n_frames else min(dim, subap_chunk) for dim in shape]
+
+def chunk_name(index):
+    return '.'.join(map(str, index))
+
+def write_array(directory, array, n_frames):
+    """ Writes an array as compressed chunks, returns its layout for the attrs """
+    array = np.asarray(array)
+    dtype = array.dtype.newbyteorder('<')
+    chunks = chunk_shape(array.shape, n_frames)
+    os.makedirs(directory, exist_ok=True)
+
+    counts = [int(np.ceil(dim/chunk)) for dim, chunk in zip(array.shape, chunks)]
+    for index in np.ndindex(*counts):
+        block = array[tuple(slice(i*c, (i+1)*c) for i, c in zip(index, chunks))]
+        data = np.ascontiguousarray(block, dtype=dtype).tobytes()
+        with open(directory+chunk_name(index), 'wb') as file:
+            file.write(zlib.compress(data, level))
+
+    return {'shape': list(array.shape), 'dtype': dtype.str, 'chunks': chunks}
+
+def to_attr(value):
+    """ Converts IDL strings and scalars into values that can be saved in yaml """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, np.ndarray):
+        return [to_attr(x) for x in value.tolist()]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def get_telem_mjd(telem, log=print):
+    """
+    Extracts the Modified Julian Date from the given telemetry data
+    (only needs the header or tstamp_str_start variables, see readsav_probe)
+    log: function to report errors with (e.g. keck_data_compiler.vprint)
+    """
+    # Get MJD from telemetry
+    if 'header' in telem.keys():
+        header = [line.decode('utf-8') if isinstance(line, bytes) else str(line)
+                  for line in telem.header]
+        mjd_idx = [i for i in range(len(header)) if 'MJD-OBS' in header[i]]
+        if len(mjd_idx)!=1: # No MJD field in header or more than one
+            log("\tError in telemetry header: could not retrieve MJD")
+            return
+        mjd = float(re.findall(r"\d+\.\d+", header[mjd_idx[0]])[0])
+    elif 'tstamp_str_start' in telem.keys():
+        timestring = telem.tstamp_str_start
+        if isinstance(timestring, bytes):
+            timestring = timestring.decode('utf-8')
+        # UTC, e.g. 2020-06-01T06:00:00.000000
+        time = np.datetime64(timestring.strip(), 'us')
+        mjd = (time - mjd_epoch).astype(np.float64) / 86400e6
+    else:
+        log("\tError: telemetry file has no header")
+        return
+    
+    return mjd
+
+def convert_file(sav_file, telem_dir=telem_dir, store_dir=store_dir):
+    """
+    Converts one telemetry file into the store
+    Numeric arrays (including the fields of the 'a' structure) are stored as chunked
+    arrays, and strings and scalars as attributes, along with the file's MJD, date,
+    file number, and mode
+    Returns the group directory
+    """
+    group = group_dir(sav_file, telem_dir, store_dir)
+    stats = os.stat(sav_file)
+    telem = readsav(sav_file, memmap=True)
+
+    ### Number of frames (the time axis), from the timestamps or centroids
+    fields = [name.lower() for name in telem['a'].dtype.names] if 'a' in telem else []
+    if 'timestamp' in fields:
+        n_frames = np.asarray(telem['a'].timestamp[0]).shape[-1]
+    elif 'offsetcentroid' in fields:
+        n_frames = telem['a'].offsetcentroid[0].shape[0]
+    else:
+        n_frames = None
+
+    ### Arrays and attributes
+    attrs = {'source': sav_file, 'size': stats.st_size, 'mtime': stats.st_mtime}
+    attrs.update(file_info(sav_file, telem_dir))
+    attrs['mjd'] = get_telem_mjd(telem)
+    attrs['n_frames'] = n_frames
+    arrays, values = {}, {}
+
+    def add(name, value):
+        if isinstance(value, np.ndarray) and value.dtype.kind in 'biufc':
+            arrays[name] = write_array(group+name+'/', value, n_frames)
+        else:
+            values[name] = to_attr(value)
+
+    for varname, value in telem.items():
+        if isinstance(value, np.recarray):
+            if len(value) != 1:
+                raise ValueError(f"Structure {varname} has {len(value)} rows (expected 1)")
+            for field in value.dtype.names:
+                add(f"{varname}.{field.lower()}", value[field][0])
+        else:
+            add(varname, value)
+
+    attrs['arrays'] = arrays
+    attrs['values'] = values
+
+    ### Write attributes last, without exposing a partial file
+    tmp_file = f"{group}{attrs_name}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as file:
+        yaml.dump(attrs, file, sort_keys=False)
+    os.replace(tmp_file, group+attrs_name)
+
+    return group
+
+def read_attrs(group):
+    """ Reads the attributes of a converted file, or None if it isn't (fully) converted """
+    filename = os.path.join(group, attrs_name)
+    if not os.path.isfile(filename):
+        return
+    with open(filename) as file:
+        return yaml.load(file, Loader=yaml.FullLoader)
+
+def is_converted(sav_file, telem_dir=telem_dir, store_dir=store_dir):
+    """ Checks whether a file is in the store and hasn't changed since it was converted """
+    attrs = read_attrs(group_dir(sav_file, telem_dir, store_dir))
+    if attrs is None:
+        return False
+    if not os.path.isfile(sav_file):
+        return True # Keep using the store if the archive is gone
+    stats = os.stat(sav_file)
+    return attrs['size'] == stats.st_size and attrs['mtime'] == stats.st_mtime
+
+def try_convert(sav_file, telem_dir=telem_dir, store_dir=store_dir):
+    """ Converts a file, returns (file, error message or None) """
+    try:
+        convert_file(sav_file, telem_dir, store_dir)
+        return sav_file, None
+    except Exception as e:
+        return sav_file, f"{type(e).__name__}: {e}"
+
+def convert_archive(telem_dir=telem_dir, store_dir=store_dir, workers=1, pattern="**/*.sav"):
+    """
+    Converts all telemetry files that aren't already in the store (resumable)
+    workers: number of processes to convert files with
+    Returns the number of files converted and skipped, and a list of (file, error)
+    for files that failed
+    """
+    files = sorted(glob.glob(telem_dir+pattern, recursive=True))
+    todo = [file for file in files if not is_converted(file, telem_dir, store_dir)]
+    print(f"{len(files)} telemetry files, {len(todo)} to convert")
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(try_convert, todo, [telem_dir]*len(todo),
+                                        [store_dir]*len(todo), chunksize=4))
+    else:
+        results = [try_convert(file, telem_dir, store_dir) for file in todo]
+
+    failed = [(file, error) for file, error in results if error is not None]
+    for file, error in failed:
+        print(f"Could not convert {file}: {error}")
+
+    return len(todo)-len(failed), len(files)-len(todo), failed
+
+### Reading
+class ChunkedArray(object):
+    """
+    Array in the store, read from disk one chunk at a time
+    Indexing (ints, slices, lists/ranges) only reads the chunks that are needed;
+    using it as a numpy array reads everything
+    """
+    def __init__(self, directory, layout):
+        self.directory = directory
+        self.shape = tuple(layout['shape'])
+        self.dtype = np.dtype(layout['dtype'])
+        self.chunks = tuple(layout['chunks'])
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read_chunk(self, index):
+        """ Reads one chunk as an array """
+        start = [i*c for i, c in zip(index, self.chunks)]
+        shape = [min(c, dim-s) for c, dim, s in zip(self.chunks, self.shape, start)]
+        with open(self.directory+chunk_name(index), 'rb') as file:
+            data = zlib.decompress(file.read())
+        return np.frombuffer(data, dtype=self.dtype).reshape(shape)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),)*(self.ndim-len(key)+1) + key[i+1:]
+        key = key + (slice(None),)*(self.ndim-len(key))
+
+        ### Selected indices along each axis
+        indices, squeeze = [], []
+        for axis, (k, dim) in enumerate(zip(key, self.shape)):
+            if isinstance(k, (int, np.integer)):
+                squeeze.append(axis)
+            indices.append(np.atleast_1d(np.arange(dim)[k if not isinstance(k, range)
+                                                        else list(k)]))
+
+        ### Copy each needed chunk into the output
+        out = np.empty([len(idx) for idx in indices], dtype=self.dtype)
+        needed = [np.unique(idx//c) for idx, c in zip(indices, self.chunks)]
+        for index in np.ndindex(*[len(n) for n in needed]):
+            chunk_index = [n[i] for n, i in zip(needed, index)]
+            out_pos, chunk_pos = [], []
+            for idx, c, ci in zip(indices, self.chunks, chunk_index):
+                inside = np.nonzero(idx//c == ci)[0]
+                out_pos.append(inside)
+                chunk_pos.append(idx[inside]-ci*c)
+            out[np.ix_(*out_pos)] = self.read_chunk(chunk_index)[np.ix_(*chunk_pos)]
+
+        return out.squeeze(axis=tuple(squeeze)) if squeeze else out
+
+    def __array__(self, dtype=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+class _StoredRow(object):
+    """ The row of a structure in the store, fields are the arrays (e.g. a[0].residualrms) """
+    def __init__(self, telem, varname):
+        self._telem = telem
+        self._varname = varname
+
+    def __getitem__(self, name):
+        return self._telem[f"{self._varname}.{name.lower()}"]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+class _StoredStructure(object):
+    """
+    Structure in the store, accessed like readsav's: fields by name (a.residualrms[0] or
+    a['residualrms'][0]), or rows by index (a[0].residualrms, a[:1])
+    """
+    def __init__(self, telem, varname):
+        self._telem = telem
+        self._varname = varname
+
+    def __len__(self):
+        return 1
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return [self._telem[f"{self._varname}.{key.lower()}"]] # One row
+        return [_StoredRow(self._telem, self._varname)][key]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+class StoredTelem(object):
+    """
+    A converted telemetry file, with the same access as readsav/LazySav:
+    telem.header, telem['tstamp_str_start'], telem.a.offsetcentroid[0][:, 10:12], ...
+    attrs: the file's metadata (mjd, date, filenum, mode, ...)
+    """
+    def __init__(self, group):
+        self.group = group
+        self.attrs = read_attrs(group)
+        if self.attrs is None:
+            raise FileNotFoundError(f"{group} is not a converted telemetry file")
+        names = list(self.attrs['arrays'])+list(self.attrs['values'])
+        self._structs = sorted({name.split('.')[0] for name in names if '.' in name})
+
+    def keys(self):
+        return [name for name in list(self.attrs['arrays'])+list(self.attrs['values'])
+                if '.' not in name]+self._structs
+
+    def __contains__(self, name):
+        return name.lower() in self.keys()
+
+    def __getitem__(self, name):
+        name = name.lower()
+        if name in self._structs:
+            return _StoredStructure(self, name)
+        if name in self.attrs['arrays']:
+            return ChunkedArray(self.group+name+'/', self.attrs['arrays'][name])
+        if name in self.attrs['values']:
+            value = self.attrs['values'][name]
+            # Strings come back as bytes, like readsav's
+            if isinstance(value, str):
+                return value.encode()
+            if isinstance(value, list):
+                return np.array([x.encode() if isinstance(x, str) else x for x in value],
+                                dtype=object)
+            return value
+        raise KeyError(name)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def read_slice(self, path, key=Ellipsis, row=0):
+        """ Reads part of an array, like LazySav.read_slice (structures have one row) """
+        if row != 0:
+            raise IndexError(f"Row {row} is out of range")
+        return self[path][key]
+
+    def iter_rows(self, path, n_rows=time_chunk, row=0):
+        """ Reads an array n_rows rows at a time, like LazySav.iter_rows """
+        if row != 0:
+            raise IndexError(f"Row {row} is out of range")
+        array = self[path]
+        for i in range(0, len(array), n_rows):
+            yield array[i:i+n_rows]
+
+    def close(self):
+        return
+
+def open_telem(filename, store_dir=None, telem_dir=telem_dir):
+    """
+    Opens a telemetry file for reading
+    filename: a .sav file, or a converted file's directory in the store
+    store_dir: if given, .sav files that have been converted are read from the store
+    Returns a StoredTelem, or a LazySav for files that aren't in the store
+    """
+    if os.path.isdir(filename):
+        return StoredTelem(filename if filename.endswith('/') else filename+'/')
+    if store_dir is not None and is_converted(filename, telem_dir, store_dir):
+        return StoredTelem(group_dir(filename, telem_dir, store_dir))
+    return LazySav(filename, memmap=True)
+
+if __name__=='__main__':
+    if len(sys.argv) > 4:
+        print(usage)
+        sys.exit()
+    args = sys.argv[1:]
+    telem_dir = args[0] if len(args) > 0 else telem_dir
+    store_dir = args[1] if len(args) > 1 else store_dir
+    workers = int(args[2]) if len(args) > 2 else 1
+    converted, skipped, failed = convert_archive(telem_dir, store_dir, workers)
+    print(f"Converted {converted} files ({skipped} already converted, {len(failed)} failed)")
@@ -0,0 +1,7 @@
+### conftest.py: Lets the tests import the scripts in code/ by name, as they import each other
+### Author: Emily Ramey
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,248 @@
+### test_keck_data_compiler.py: Checks parts of the metadata compiler against the code they replaced
+### Author: Emily Ramey
+
+import os
+import glob
+import functools
+import http.server
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+from astropy.io import fits
+import savwriter
+import keck_data_compiler as kdc
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data')
+metadata_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..',
+                             'keck_ao_metadata.dat')
+
+### Matching NIRC2 frames to seeing and weather
+def nearest_mjd(mjd, data):
+    """ The per-frame match that match_nearest replaced """
+    if data is None:
+        return
+    data_clean = data.dropna()
+    dt = np.abs(data_clean.mjd-mjd)
+    idx = dt.idxmin()
+    if dt[idx]*24*60 > kdc.time_limit:
+        return
+    return idx
+
+def loop_match(mjds, data, cols):
+    """ The loop over NIRC2 frames from the old populate_df """
+    matched = {col: [] for col in ['mjd']+list(cols)}
+    for mjd in mjds:
+        idx = nearest_mjd(mjd, data)
+        for col in matched:
+            matched[col].append(np.nan if idx is None else data.iloc[idx][col])
+    return matched
+
+def check_match(mjds, data, cols):
+    expected = loop_match(mjds, data, cols)
+    matched = kdc.match_nearest(mjds, data, cols)
+    for col in expected:
+        assert np.array_equal(matched[col], np.array(expected[col], dtype=float),
+                              equal_nan=True), col
+
+def test_match_random():
+    rng = np.random.default_rng(0)
+    for trial in range(20):
+        n = rng.integers(1, 60)
+        mjds = np.round(58000+rng.uniform(0, 2, n), 3) # Rounded, so there are repeats and ties
+        data = pd.DataFrame({'mjd': np.round(58000+rng.uniform(-0.2, 2.2, n), 3),
+                             'dimm': rng.uniform(0.2, 2, n)})
+        data.loc[rng.random(n) < 0.1, 'dimm'] = np.nan # Rows dropped before matching
+        frames = np.concatenate([rng.uniform(57999.5, 58002.5, 200), data.mjd[:10],
+                                 (data.mjd[:-1].to_numpy()+data.mjd[1:].to_numpy())/2])
+        check_match(frames, data, ['dimm'])
+
+def test_match_empty():
+    mjds = np.array([58000.1, 58000.2])
+    check_match(mjds, None, ['dimm'])
+    matched = kdc.match_nearest(mjds, pd.DataFrame({'mjd': [np.nan], 'dimm': [1.]}), ['dimm'])
+    assert np.isnan(matched['dimm']).all() and np.isnan(matched['mjd']).all()
+
+def load_saved(pattern):
+    files = sorted(glob.glob(os.path.join(data_dir, pattern)))
+    return pd.concat([pd.read_csv(file) for file in files], ignore_index=True) if files else None
+
+@pytest.mark.parametrize('pattern, cols', [('seeing_data/*/*.dimm.dat', ['dimm']),
+                                           ('seeing_data/*/*.mass.dat', ['mass']),
+                                           ('seeing_data/*/*.masspro.dat', kdc.seeing_cols['masspro']),
+                                           ('weather_data/*.dat', kdc.weather_cols)])
+def test_match_saved(pattern, cols):
+    """ NIRC2 frames of the metadata table, against the saved seeing and weather tables """
+    data = load_saved(pattern)
+    if data is None or not os.path.isfile(metadata_file):
+        pytest.skip("No saved tables")
+    mjds = pd.read_csv(metadata_file, usecols=['mjd'])['mjd'].dropna().to_numpy()
+    days = np.floor(data.mjd.dropna().to_numpy())
+    mjds = mjds[np.isin(np.floor(mjds), np.concatenate([days-1, days, days+1]))][:500]
+    check_match(mjds, data, cols)
+
+### Downloads, from a local server standing in for MKWC and CFHT
+nights = ['20100503', '20100504', '20100505']
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """
+    Serves mass and dimm files and a yearly weather file for nights, but no masspro files
+    Returns the list of paths requested
+    """
+    root = tmp_path/'www'
+    for s, value in [('mass', 0.5), ('dimm', 0.7)]:
+        os.makedirs(root/'seeing'/s)
+        for night in nights:
+            year, month, day = int(night[:4]), int(night[4:6]), int(night[6:])
+            lines = [f"{year} {month} {day} {hour} 0 0 {value}" for hour in range(18, 24)]
+            (root/'seeing'/s/f"{night}.{s}.dat").write_text("\n".join(lines)+"\n")
+    os.makedirs(root/'wx')
+    lines = [f"2010 5 {day} {hour} {minute} 5 90 2 30 600" for day in [3, 4, 5]
+             for hour in range(24) for minute in range(0, 60, 5)]
+    (root/'wx'/'cfht-wx.2010.dat').write_text("\n".join(lines)+"\n")
+
+    requested = []
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            super().do_GET()
+        def log_message(self, format, *args):
+            return
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                            functools.partial(Handler, directory=str(root)))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    url = f"http://127.0.0.1:{httpd.server_port}/"
+    monkeypatch.setattr(kdc, 'seeing_url', url+'seeing/')
+    monkeypatch.setattr(kdc, 'weather_url', url+'wx/')
+    monkeypatch.setattr(kdc, 'store_dir', str(tmp_path/'store')+'/')
+    monkeypatch.setattr(kdc, 'n_retries', 0)
+    monkeypatch.setattr(kdc, 'verbose', False)
+    monkeypatch.setattr(kdc, 'logstring', '')
+    yield requested
+    httpd.shutdown()
+    httpd.server_close()
+
+def empty_bad_data():
+    return {'nirc2': [], 'weather': [], 'seeing': [], 'telemetry': []}
+
+def test_fetch_urls(server):
+    urls = [kdc.seeing_file_url(night, 'mass') for night in nights]
+    texts = kdc.fetch_urls(urls+[kdc.seeing_file_url(nights[0], 'masspro')]+urls)
+    assert len(server) == 4 # Duplicates are only downloaded once
+    assert all(texts[url].startswith('2010 5') for url in urls)
+    assert texts[kdc.seeing_file_url(nights[0], 'masspro')] is None
+    assert 'Warning: Could not download' in kdc.logstring
+
+def test_fetch_missing(server):
+    bad_data = empty_bad_data()
+    failed = kdc.fetch_missing(nights, bad_data)
+    assert sorted(failed['seeing']) == sorted(f"masspro_{night}" for night in nights)
+    assert failed['weather'] == []
+    assert bad_data == empty_bad_data() # Left to the epochs that use them
+    for night in nights:
+        assert kdc.load_seeing(night, 'dimm').dimm.tolist() == pytest.approx([0.7]*6)
+        assert len(kdc.load_weather(night)) == 24*12
+    assert len(server) == 2*len(nights)+1+len(nights) # The weather file only once
+
+    ### Nothing is downloaded again
+    del server[:]
+    assert kdc.fetch_missing(nights, bad_data, failed) == failed
+    assert server == []
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_populate_df_warns(server, monkeypatch, prefetch):
+    """ An epoch warns about its failed downloads, even if they failed in update's prefetch """
+    mjds = kdc.hst_to_mjd_batch(2010, 5, 3, [20, 21, 22], 30) # UTC 20100504
+    nirc2_data = pd.DataFrame({'file': ['c0001.fits', 'c0002.fits', 'c0003.fits'], 'mjd': mjds})
+    monkeypatch.setattr(kdc, 'load_nirc2', lambda epoch: nirc2_data.copy())
+    monkeypatch.setattr(kdc, 'load_all_telem', lambda files, mjds, bad_data: pd.DataFrame(index=files.index))
+
+    bad_data = empty_bad_data()
+    failed = kdc.fetch_missing(kdc.obs_dates(mjds), bad_data) if prefetch else None
+    kdc.logstring = ''
+    del server[:]
+    data = kdc.populate_df('10maylgs', bad_data, failed)
+
+    assert 'Warning: Could not retrieve seeing' in kdc.logstring
+    assert 'Retrieved seeing data for all files' not in kdc.logstring
+    assert 'Retrieved weather data for all files' in kdc.logstring
+    assert sorted(bad_data['seeing']) == sorted(f"masspro_{night}" for night in nights)
+    if prefetch:
+        assert server == [] # Everything was prefetched, and failures aren't retried
+    assert data.dimm.tolist() == pytest.approx([0.7]*3)
+    assert data.mass.tolist() == pytest.approx([0.5]*3)
+    assert data.masspro.isna().all()
+    assert data.wind_speed.tolist() == [5]*3
+
+### Updating the datatable
+@pytest.mark.parametrize('export', [False, True])
+def test_update_export(tmp_path, monkeypatch, export):
+    """ The single-file table is only rewritten from the store when asked for """
+    root_dir = tmp_path/'lgs'
+    for epoch in ['10maylgs', '10junlgs']:
+        os.makedirs(root_dir/epoch)
+    monkeypatch.setattr(kdc, 'root_dir', f"{root_dir}/")
+    monkeypatch.setattr(kdc, 'telem_dir', f"{tmp_path}/telem/")
+    monkeypatch.setattr(kdc, 'catalog_file', str(tmp_path/'catalog.db'))
+    monkeypatch.setattr(kdc, 'verbose', False)
+    monkeypatch.setattr(kdc, 'logstring', '')
+    monkeypatch.setattr(kdc, 'load_strehl', lambda epoch: None)
+    monkeypatch.setattr(kdc, 'populate_df', lambda epoch, bad_data, failed=None:
+                        pd.DataFrame({'epoch': [epoch]*2, 'x': [1, 2]}))
+
+    savefile, table_dir = str(tmp_path/'table.dat'), f"{tmp_path}/table/"
+    kdc.update(savefile=savefile, logfile=str(tmp_path/'log'), bad_files=str(tmp_path/'bad.yaml'),
+               table_dir=table_dir, export=export)
+    assert sorted(kdc.store_util.read_manifest(table_dir)) == ['10junlgs', '10maylgs']
+    assert os.path.isfile(savefile) == export
+    if export:
+        assert pd.read_csv(savefile).equals(kdc.load_table(table_dir).reset_index(drop=True))
+
+### Telemetry lookup
+def test_telem_stale_catalog(tmp_path, monkeypatch):
+    """ Files added since the catalog was refreshed are still found, not marked as bad """
+    telem_dir = f"{tmp_path}/telem/"
+    monkeypatch.setattr(kdc, 'telem_dir', telem_dir)
+    monkeypatch.setattr(kdc, 'telem_store_dir', f"{tmp_path}/store/")
+    monkeypatch.setattr(kdc, 'catalog_file', f"{tmp_path}/catalog.db")
+    monkeypatch.setattr(kdc, 'verbose', False)
+    monkeypatch.setattr(kdc, 'logstring', '')
+    kdc.telem_catalog.refresh(kdc.catalog_file, telem_dir) # Empty catalog
+
+    mjd = 58973.5 # UTC 20200504
+    os.makedirs(f"{telem_dir}20200504/sub")
+    data = savwriter.write_telemetry(f"{telem_dir}20200504/sub/nc0042_a.sav", 10, mjd=mjd)
+    bad_data = empty_bad_data()
+    files = pd.Series(['c0042.fits', 'c0043.fits'])
+    telem = kdc.load_all_telem(files, pd.Series([mjd, mjd]), bad_data)
+
+    assert telem.telem_file[0] == f"{telem_dir}20200504/sub/nc0042_a.sav"
+    assert telem.telem_mjd[0] == pytest.approx(mjd)
+    assert telem.rms_mean[0] == pytest.approx(np.mean(data['a']['residualrms']))
+    assert telem.iloc[1].isna().all()
+    assert bad_data['telemetry'] == ['20200504_c0043.fits'] # Only the file that doesn't exist
+
+    ### The file is in the catalog now, with its MJD
+    conn = kdc.telem_catalog.connect(kdc.catalog_file)
+    assert kdc.telem_catalog.find_files(conn, '20200504', '0042') == [(telem.telem_file[0], mjd)]
+    conn.close()
+    assert kdc.telem_catalog.refresh(kdc.catalog_file, telem_dir) == (0, 0, 0)
+
+### NIRC2 headers
+def test_header_cards(tmp_path):
+    """ Header values match astropy's, including repeated keywords (the first card wins) """
+    header = fits.Header([('AIRMASS', 1.25, 'first'), ('ITIME', 2), ('FWINAME', "K'"),
+                          ('AOLBFWHM', True), ('DATE-OBS', '2010-05-04')])
+    header.append(('AIRMASS', 1.5, 'second'))
+    header.append(('FWINAME', 'H'))
+    filename = str(tmp_path/'c0001.fits')
+    fits.PrimaryHDU(np.zeros((10, 10), dtype=np.float32), header).writeto(filename)
+
+    fields = ['AIRMASS', 'ITIME', 'FWINAME', 'AOLBFWHM', 'DATE-OBS', 'COADDS']
+    values = kdc.read_header_cards(filename, fields)
+    ref = fits.getheader(filename)
+    assert values == {field: ref[field] for field in fields if field in ref}
+    assert values['AIRMASS'] == 1.25 and values['FWINAME'] == "K'"
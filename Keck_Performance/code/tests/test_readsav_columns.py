@@ -0,0 +1,73 @@
+### test_readsav_columns.py: Checks that readsav(columns=...) returns the same arrays as a full
+### read, while reading fewer bytes from the file
+### Author: Emily Ramey
+
+import io
+import numpy as np
+import pytest
+import readsav_copy
+import savwriter
+
+n_frames = 2000
+
+class CountingFile(io.FileIO):
+    """ File that counts the bytes read from it """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_read = 0
+
+    def read(self, n=-1):
+        data = super().read(n)
+        self.n_read += len(data)
+        return data
+
+@pytest.fixture
+def counted(monkeypatch):
+    """ Makes readsav_copy open files with CountingFile, returns the files it opened """
+    files = []
+    def counting_open(file_name, mode='rb'):
+        files.append(CountingFile(file_name, mode[0]))
+        return files[-1]
+    monkeypatch.setattr(readsav_copy, 'open', counting_open, raising=False)
+    return files
+
+@pytest.fixture(scope='module', params=[False, True], ids=['plain', 'compressed'])
+def telem_file(request, tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp('sav')/'telem.sav')
+    savwriter.write_telemetry(filename, n_frames, compress=request.param)
+    return filename, request.param
+
+def read_counted(files, filename, **kwargs):
+    """ Reads a file, returns the data and the number of bytes read """
+    del files[:]
+    data = readsav_copy.readsav(filename, python_dict=True, **kwargs)
+    return data, sum(f.n_read for f in files)
+
+@pytest.mark.parametrize('columns', [['header', 'tstamp_str_start'],
+                                     ['header', 'a.timestamp'],
+                                     ['header', 'a.residualrms'],
+                                     ['a.timestamp', 'a.residualrms']])
+def test_columns(counted, telem_file, columns):
+    telem_file, compressed = telem_file
+    full, full_bytes = read_counted(counted, telem_file)
+    part, part_bytes = read_counted(counted, telem_file, columns=columns)
+    assert full_bytes > 0
+
+    for column in columns:
+        names = column.split('.')
+        if len(names) == 1:
+            assert np.array_equal(part[names[0]], full[names[0]])
+        else:
+            assert np.array_equal(part[names[0]][names[1]][0], full[names[0]][names[1]][0])
+    assert set(part) == {column.split('.')[0] for column in columns}
+    fields = {column.split('.')[1].upper() for column in columns if '.' in column}
+    if fields:
+        assert set(part['a'].dtype.names) == fields
+
+    if compressed and 'a.residualrms' in columns:
+        # Compressed records are inflated up to the last selected field, here the last one
+        assert part_bytes <= full_bytes
+    elif fields: # Other fields are skipped
+        assert part_bytes < full_bytes/2
+    else: # The telemetry arrays aren't read (or decompressed) at all
+        assert part_bytes < full_bytes/10
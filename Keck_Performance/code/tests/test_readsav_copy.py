@@ -0,0 +1,195 @@
+### test_readsav_copy.py: Checks readsav_copy against scipy.io.readsav, for plain and compressed
+### files: full reads, memmap, columns, LazySav, read_slice, and iter_rows
+### (the timing comparison is in benchmark_readsav.py)
+### Author: Emily Ramey
+
+import os
+import glob
+import mmap
+import warnings
+import numpy as np
+import pytest
+import scipy.io
+import readsav_copy
+import savwriter
+
+scipy_files = sorted(glob.glob(os.path.join(os.path.dirname(scipy.io.__file__),
+                                            'tests', 'data', '*.sav')))
+
+def same(a, b):
+    """ Whether two values read from a .sav file are identical (types, shapes, and values) """
+    if isinstance(a, (np.ndarray, np.record)) or isinstance(b, (np.ndarray, np.record)):
+        a, b = np.asarray(a), np.asarray(b)
+        if a.dtype.names or b.dtype.names:
+            return a.dtype.names == b.dtype.names and a.shape == b.shape and \
+                   all(same(x, y) for name in a.dtype.names
+                       for x, y in zip(np.ravel(a[name]), np.ravel(b[name])))
+        if a.shape != b.shape or a.dtype != b.dtype:
+            return False
+        if a.dtype == object:
+            return all(same(x, y) for x, y in zip(a.ravel(), b.ravel()))
+        return np.array_equal(a, b, equal_nan=a.dtype.kind in 'fc')
+    if a is None or b is None:
+        return a is b
+    return type(a) == type(b) and (a == b or (a != a and b != b))
+
+def same_dict(new, ref):
+    return sorted(new.keys()) == sorted(ref.keys()) and all(same(new[k], ref[k]) for k in ref)
+
+def scipy_read(filename):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return scipy.io.readsav(filename)
+
+def copy_read(filename, **kwargs):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return readsav_copy.readsav(filename, **kwargs)
+
+@pytest.fixture(scope='module', params=[False, True], ids=['plain', 'compressed'])
+def telem_file(request, tmp_path_factory):
+    """ Synthetic telemetry, plus a structure and array with less common types """
+    filename = str(tmp_path_factory.mktemp('sav')/('compressed.sav' if request.param else 'plain.sav'))
+    data = savwriter.telemetry_data(3000)
+    data['b'] = {'name': 'hello', 'i2': np.arange(30, dtype=np.int16).reshape(5, 6),
+                 'by': np.arange(10, dtype=np.uint8), 'f': np.float64(3.5),
+                 'c': (np.arange(12)+1j).reshape(3, 4).astype(np.complex64)}
+    data['arr'] = np.arange(120, dtype=np.int16).reshape(4, 5, 6)
+    savwriter.write_sav(filename, data, request.param)
+    return filename
+
+def array_paths(ref):
+    """ Paths of the numeric arrays (and array fields of structures) in a file """
+    paths = []
+    for name, value in ref.items():
+        if not isinstance(value, np.ndarray):
+            continue
+        if value.dtype.names:
+            if value.ndim == 1 and len(value) == 1:
+                paths += [f"{name}.{field.lower()}" for field in value.dtype.names
+                          if isinstance(value[field][0], np.ndarray)
+                          and value[field][0].dtype.kind in 'iufc' and value[field][0].size]
+        elif value.dtype.kind in 'iufc' and value.size:
+            paths.append(name)
+    return paths
+
+def get_path(ref, path):
+    name, *field = path.split('.')
+    return ref[name][field[0]][0] if field else ref[name]
+
+def slice_keys(shape):
+    keys = [Ellipsis, 0, -1, slice(None, None, 2), (Ellipsis, 0)]
+    if len(shape) >= 2:
+        keys += [(slice(None), slice(1, 3)), (slice(1, None), [0, 2]), (range(0, 2), -1)]
+    return keys
+
+### scipy's test files
+@pytest.mark.skipif(not scipy_files, reason="scipy's test files aren't installed")
+@pytest.mark.parametrize('filename', scipy_files, ids=os.path.basename)
+@pytest.mark.parametrize('kwargs', [{}, {'memmap': True}], ids=['read', 'memmap'])
+def test_scipy_files(filename, kwargs):
+    assert same_dict(copy_read(filename, **kwargs), scipy_read(filename))
+
+@pytest.mark.skipif(not scipy_files, reason="scipy's test files aren't installed")
+@pytest.mark.parametrize('filename', scipy_files, ids=os.path.basename)
+def test_scipy_files_lazy(filename):
+    ref = scipy_read(filename)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with readsav_copy.LazySav(filename) as sav:
+            assert sorted(sav.keys()) == sorted(ref.keys())
+            for name in ref:
+                assert same(sav[name], ref[name]), name
+
+### Synthetic telemetry
+@pytest.mark.parametrize('kwargs', [{}, {'memmap': True}], ids=['read', 'memmap'])
+def test_full_read(telem_file, kwargs):
+    assert same_dict(copy_read(telem_file, **kwargs), scipy_read(telem_file))
+
+def is_mapped(array):
+    """ Whether an array is a view into a memory-mapped file """
+    while isinstance(array, np.ndarray):
+        array = array.base
+    return isinstance(getattr(array, 'obj', array), mmap.mmap)
+
+def test_memmap_views(telem_file):
+    data = copy_read(telem_file, memmap=True)
+    # Plain files give views of arrays into the map, memmap is ignored for compressed files
+    assert is_mapped(data['arr']) == (not telem_file.endswith('compressed.sav'))
+    assert not is_mapped(copy_read(telem_file)['arr'])
+
+@pytest.mark.parametrize('columns', [['header'], ['a.residualrms'], ['A.TIMESTAMP', 'b.i2', 'arr'],
+                                     ['a', 'b.name', 'b.c']])
+def test_columns(telem_file, columns):
+    ref = scipy_read(telem_file)
+    data = copy_read(telem_file, columns=columns)
+    assert sorted(data.keys()) == sorted({column.lower().split('.')[0] for column in columns})
+    for column in columns:
+        name, *field = column.lower().split('.')
+        if field:
+            assert field[0].upper() in data[name].dtype.names
+            assert same(data[name][field[0]], ref[name][field[0]])
+        else:
+            assert same(data[name], ref[name])
+
+def test_lazysav(telem_file):
+    ref = scipy_read(telem_file)
+    with readsav_copy.LazySav(telem_file) as sav:
+        assert sorted(sav.keys()) == sorted(ref.keys())
+        # Fields one at a time, then whole variables
+        for path in ['a.residualrms', 'b.name', 'b.f', 'a.timestamp']:
+            name, field = path.split('.')
+            assert same(getattr(sav, name)[field], ref[name][field])
+        for name in ref:
+            assert same(sav[name], ref[name]), name
+            assert same(sav(name.upper()), ref[name])
+
+@pytest.mark.parametrize('memmap', [False, True])
+def test_read_slice(telem_file, memmap):
+    ref = scipy_read(telem_file)
+    paths = array_paths(ref)
+    assert 'a.offsetcentroid' in paths and 'b.i2' in paths and 'arr' in paths
+    with readsav_copy.LazySav(telem_file, memmap=memmap) as sav:
+        for path in paths:
+            full = get_path(ref, path)
+            for key in slice_keys(full.shape):
+                try:
+                    expected = full[key]
+                except IndexError: # Key doesn't fit this shape
+                    continue
+                # (single elements come back as 0-d arrays)
+                assert same(sav.read_slice(path, key), np.asarray(expected, full.dtype)), (path, key)
+        # Slices mixed with normal access
+        assert same(sav.a.residualrms[0], ref['a'].residualrms[0])
+        assert np.array_equal(sav.read_slice('arr', (1, Ellipsis)), ref['arr'][1])
+    assert np.array_equal(readsav_copy.readsav_slice(telem_file, 'a.offsetcentroid',
+                                                     np.s_[:, 20:22]),
+                          ref['a'].offsetcentroid[0][:, 20:22])
+
+@pytest.mark.parametrize('path', ['b.name', 'b.f', 'a', 'header', 'a.nope', 'nope'])
+def test_read_slice_errors(telem_file, path):
+    with pytest.raises((ValueError, KeyError)):
+        readsav_copy.readsav_slice(telem_file, path)
+
+@pytest.mark.parametrize('n_rows', [1, 7, 1000, 5000])
+def test_iter_rows(telem_file, n_rows):
+    ref = scipy_read(telem_file)
+    with readsav_copy.LazySav(telem_file) as sav:
+        for path in array_paths(ref):
+            full = get_path(ref, path)
+            chunks = list(sav.iter_rows(path, n_rows))
+            assert len(chunks) == -(-len(full)//n_rows)
+            assert all(len(chunk) <= n_rows for chunk in chunks)
+            assert all(chunk.dtype == full.dtype for chunk in chunks)
+            assert np.array_equal(np.concatenate(chunks), full), path
+
+def test_iter_rows_interleaved(telem_file):
+    """ Iterating one array while reading others from the same file """
+    ref = scipy_read(telem_file)
+    with readsav_copy.LazySav(telem_file) as sav:
+        chunks = []
+        for chunk in sav.iter_rows('a.offsetcentroid', 1000):
+            chunks.append(chunk)
+            assert np.array_equal(sav.read_slice('a.residualrms', np.s_[0, :5]),
+                                  ref['a'].residualrms[0][0, :5])
+        assert np.array_equal(np.concatenate(chunks), ref['a'].offsetcentroid[0])
@@ -0,0 +1,71 @@
+### test_store_util.py: Checks the seeing/weather store: round trips, the partition cache,
+### locking, and malformed downloads
+### Author: Emily Ramey
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import store_util
+import keck_data_compiler as kdc
+
+def night(mjd, n=5):
+    return pd.DataFrame({'dimm': np.linspace(0.5, 1, n), 'mjd': mjd+np.arange(n)/100})
+
+def test_round_trip(tmp_path):
+    store_dir = f"{tmp_path}/"
+    store_util.write_nights(store_dir, 'dimm', {'20100503': night(55319.3), '20100504': night(55320.3),
+                                                '20100505': night(55321.3, 0)})
+    data = store_util.load_night(store_dir, 'dimm', '20100504')
+    assert list(data.columns) == ['dimm', 'mjd']
+    assert np.allclose(data.dimm, night(0).dimm) and np.array_equal(data.mjd, night(55320.3).mjd)
+    assert store_util.has_night(store_dir, 'dimm', '20100505')
+    assert store_util.load_night(store_dir, 'dimm', '20100505').empty
+    assert store_util.load_night(store_dir, 'dimm', '20100506') is None
+    # Replacing a night keeps the others
+    store_util.write_nights(store_dir, 'dimm', {'20100503': night(55319.3, 2)})
+    assert len(store_util.load_night(store_dir, 'dimm', '20100503')) == 2
+    assert len(store_util.load_night(store_dir, 'dimm', '20100504')) == 5
+
+def test_one_lock(tmp_path):
+    store_dir = f"{tmp_path}/"
+    for month in range(1, 13):
+        store_util.write_nights(store_dir, 'dimm', {f"2010{month:02d}01": night(55197.3+30*month)})
+    assert sorted(os.listdir(store_dir)) == ['dimm', store_util.lock_name]
+    assert len(os.listdir(store_dir+'dimm')) == 12
+    assert not any(name.endswith('.lock') for name in os.listdir(store_dir+'dimm'))
+
+def test_cache_bound(tmp_path, monkeypatch):
+    store_dir = f"{tmp_path}/"
+    monkeypatch.setattr(store_util, 'max_cached', 3)
+    monkeypatch.setattr(store_util, '_partitions', {})
+    months = [f"2010{month:02d}01" for month in range(1, 7)]
+    for obs_date in months:
+        store_util.write_nights(store_dir, 'dimm', {obs_date: night(55197.3)})
+        assert store_util.has_night(store_dir, 'dimm', obs_date)
+    assert len(store_util._partitions) == 3
+    # The most recently read partitions are the ones kept
+    store_util.load_night(store_dir, 'dimm', months[3])
+    store_util.load_night(store_dir, 'dimm', months[0])
+    cached = [os.path.basename(filename)[:6] for filename in store_util._partitions]
+    assert cached == [months[5][:6], months[3][:6], months[0][:6]]
+
+def test_non_numeric(tmp_path):
+    store_dir = f"{tmp_path}/"
+    bad = night(55319.3).assign(dimm=['<html>']*5)
+    with pytest.raises(ValueError):
+        store_util.write_nights(store_dir, 'dimm', {'20100504': night(55320.3), '20100503': bad})
+    assert store_util.load_night(store_dir, 'dimm', '20100504') is None
+
+@pytest.mark.parametrize('text', ['2010 5 3 20 0 0 0.7\n2010 5 3 20 1 0 <b>\n',
+                                  '<html><body>Not found</body></html>\n'])
+def test_malformed_download(tmp_path, monkeypatch, text):
+    monkeypatch.setattr(kdc, 'store_dir', f"{tmp_path}/")
+    monkeypatch.setattr(kdc, 'verbose', False)
+    monkeypatch.setattr(kdc, 'logstring', '')
+    assert kdc.save_seeing(text, '20100503', 'dimm') is None
+    assert 'Could not read dimm data for 20100503' in kdc.logstring
+    assert store_util.load_night(kdc.store_dir, 'dimm', '20100503') is None
+    weather = text.replace('0.7', ' '.join(['0.7']*5)).replace('<b>', ' '.join(['<b>']*5))
+    assert kdc.save_weather_year(weather, '2010') == {}
+    assert 'Could not read weather data for 2010' in kdc.logstring
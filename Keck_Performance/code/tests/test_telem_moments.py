@@ -0,0 +1,43 @@
+### test_telem_moments.py: Checks the streaming statistics against numpy
+### Author: Emily Ramey
+
+import numpy as np
+import pytest
+from telem_moments import Moments
+
+@pytest.fixture
+def data():
+    return np.random.default_rng(0).normal(3, 2, (1000, 8)).astype(np.float32)
+
+def test_chunks(data):
+    moments = Moments()
+    for i in range(0, len(data), 64):
+        moments.add(data[i:i+64])
+    assert moments.count == len(data)
+    assert np.allclose(moments.mean, data.mean(axis=0, dtype=np.float64))
+    assert np.allclose(moments.std(), data.std(axis=0, dtype=np.float64))
+    assert np.allclose(moments.variance(1), data.var(axis=0, ddof=1, dtype=np.float64))
+    assert np.array_equal(moments.min, data.min(axis=0))
+    assert np.array_equal(moments.max, data.max(axis=0))
+
+def test_merge(data):
+    merged = Moments().add(data[:300]).merge(Moments()).merge(Moments().add(data[300:]))
+    whole = Moments().add(data)
+    assert merged.count == whole.count
+    assert np.allclose(merged.mean, whole.mean) and np.allclose(merged.m2, whole.m2)
+
+def test_pooled(data):
+    pooled = Moments().add(data).pooled()
+    assert pooled.count == data.size
+    assert pooled.mean == pytest.approx(data.mean(dtype=np.float64))
+    assert pooled.std() == pytest.approx(data.std(dtype=np.float64))
+    assert pooled.min == data.min() and pooled.max == data.max()
+
+def test_pooled_empty(data):
+    pooled = Moments().pooled()
+    assert pooled.count == 0
+    for value in [pooled.mean, pooled.std(), pooled.min, pooled.max]:
+        assert np.isnan(value)
+    # Data added later replaces the NaNs
+    pooled.merge(Moments().add(data).pooled())
+    assert pooled.count == data.size and pooled.mean == pytest.approx(data.mean(dtype=np.float64))
@@ -0,0 +1,56 @@
+### test_telem_spectra.py: Checks the frame rates used for the telemetry power spectra
+### Author: Emily Ramey
+
+import numpy as np
+import pytest
+import savwriter
+import telem_spectra
+
+n_frames = 8192
+wfs_rate = 1000.
+
+def write_file(filename, header_rate=wfs_rate, dtt_step=2, dtt_timestamps=True):
+    """
+    Writes a file with a 100 Hz vibration in the WFS centroids, and a 40 Hz vibration in the
+    DTT centroids, which are recorded every dtt_step WFS frames
+    """
+    rng = np.random.default_rng(0)
+    data = savwriter.telemetry_data(n_frames)
+    header = [line for line in data['header'] if line != 'END']
+    if header_rate is not None:
+        header.append(f"{'WSFRRT':8}= {header_rate:>20.1f} / WFS frame rate")
+    data['header'] = np.array(header+['END'], dtype=object)
+    t = np.arange(n_frames)/wfs_rate
+    data['a']['offsetcentroid'] += np.sin(2*np.pi*100*t)[:, None].astype(np.float32)
+
+    n_dtt = n_frames//dtt_step
+    t_dtt = np.arange(n_dtt)*dtt_step/wfs_rate
+    dtt = np.column_stack([np.sin(2*np.pi*40*t_dtt), np.cos(2*np.pi*40*t_dtt)])
+    data['b'] = {'dttcentroids': (dtt+rng.normal(0, 0.1, dtt.shape)).astype(np.float32)}
+    if dtt_timestamps:
+        data['b']['timestamp'] = (np.arange(n_dtt)*dtt_step).astype(np.uint32)
+    savwriter.write_sav(filename, data)
+
+def peak_freq(spectra, name):
+    freqs, psd = spectra[name]
+    return freqs[np.argmax(psd.mean(axis=1)[1:])+1]
+
+@pytest.mark.parametrize('dtt_timestamps', [True, False])
+def test_dtt_rate(tmp_path, capsys, dtt_timestamps):
+    filename = str(tmp_path/'n0001_LGS_trs.sav')
+    write_file(filename, dtt_timestamps=dtt_timestamps)
+    mjd, rate, spectra = telem_spectra.file_spectra(filename, store_dir=None)
+    assert rate == wfs_rate
+    assert 'Warning' not in capsys.readouterr().out
+    # The DTT loop runs at half the WFS rate here, so its spectrum stops at 250 Hz
+    assert spectra['tiptilt_x'][0][-1] == pytest.approx(wfs_rate/4)
+    assert peak_freq(spectra, 'tiptilt_x') == pytest.approx(40, abs=1)
+    assert peak_freq(spectra, 'centroid') == pytest.approx(100, abs=1)
+
+def test_default_rate(tmp_path, capsys):
+    filename = str(tmp_path/'n0001_LGS_trs.sav')
+    write_file(filename, header_rate=None, dtt_step=1)
+    mjd, rate, spectra = telem_spectra.file_spectra(filename, store_dir=None)
+    assert rate == telem_spectra.default_rate
+    assert 'no WSFRRT' in capsys.readouterr().out
+    assert spectra['tiptilt_x'][0][-1] == pytest.approx(rate/2)
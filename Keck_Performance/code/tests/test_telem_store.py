@@ -0,0 +1,66 @@
+### test_telem_store.py: Checks that converted telemetry files read back like readsav's
+### Author: Emily Ramey
+
+import os
+import numpy as np
+import pytest
+import readsav_copy
+import savwriter
+import telem_store
+
+@pytest.fixture(scope='module')
+def converted(tmp_path_factory):
+    """ A synthetic telemetry file and its converted group in the store """
+    telem_dir = str(tmp_path_factory.mktemp('telem'))+'/'
+    store_dir = str(tmp_path_factory.mktemp('store'))+'/'
+    filename = telem_dir+'20200601/n0001_LGS_trs.sav'
+    os.makedirs(telem_dir+'20200601')
+    savwriter.write_telemetry(filename, 5000, mjd=59001.25)
+    group = telem_store.convert_file(filename, telem_dir, store_dir)
+    return filename, telem_store.open_telem(group)
+
+def test_attrs(converted):
+    filename, telem = converted
+    assert telem.attrs['mjd'] == 59001.25
+    assert telem.attrs['n_frames'] == 5000
+    assert telem_store.get_telem_mjd(telem) == 59001.25
+
+def test_values(converted):
+    filename, telem = converted
+    ref = readsav_copy.readsav(filename)
+    assert telem.tstamp_str_start == ref.tstamp_str_start
+    assert list(telem.header) == list(ref.header)
+
+def test_structure_access(converted):
+    filename, telem = converted
+    ref = readsav_copy.readsav(filename).a
+    for field in ['offsetcentroid', 'residualrms', 'timestamp']:
+        expected = ref[field][0]
+        assert np.array_equal(getattr(telem.a, field)[0][:], expected)
+        assert np.array_equal(telem.a[field][0][:], expected)
+        assert np.array_equal(telem['A'][field.upper()][0][:], expected)
+        assert np.array_equal(getattr(telem.a[0], field)[:], expected)
+        assert np.array_equal(telem.a[0][field][:], expected)
+        assert np.array_equal(telem.a[-1][field][:], expected)
+    assert np.array_equal(telem.a.offsetcentroid[0][100:200, 10:12],
+                          ref.offsetcentroid[0][100:200, 10:12])
+    assert len(telem.a) == 1 and len(telem.a[:]) == 1 and len(telem.a[1:]) == 0
+
+def test_structure_errors(converted):
+    filename, telem = converted
+    with pytest.raises(IndexError):
+        telem.a[1]
+    with pytest.raises(KeyError):
+        telem.a['nope']
+    with pytest.raises(AttributeError):
+        telem.a.nope
+    with pytest.raises(AttributeError):
+        telem.a[0].nope
+
+def test_iter_rows(converted):
+    filename, telem = converted
+    ref = readsav_copy.readsav(filename).a.offsetcentroid[0]
+    chunks = list(telem.iter_rows('a.offsetcentroid', 1500))
+    assert [len(chunk) for chunk in chunks] == [1500, 1500, 1500, 500]
+    assert np.array_equal(np.concatenate(chunks), ref)
+    assert np.array_equal(telem.read_slice('a.offsetcentroid', np.s_[:, 3]), ref[:, 3])
@@ -0,0 +1,74 @@
+### test_time_util.py: Checks the vectorized HST to MJD conversion against the old
+### pytz + astropy conversion it replaced
+### Author: Emily Ramey
+
+import os
+import glob
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import pytz
+import pytest
+from astropy.time import Time
+from time_util import hst_to_mjd_batch, hst_to_mjd
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data')
+tolerance = 1e-8 # Days (under a millisecond)
+
+def old_hst_to_mjd(daterow):
+    """ The conversion before hst_to_mjd_batch (pytz time zone, astropy Time) """
+    row = [int(num) for num in daterow]
+    if row[0] == 202013: # For that one stupid typo in 2013
+        row[0] = 2013
+    tz = pytz.timezone('US/Hawaii')
+    date = tz.normalize(tz.localize(datetime(*row))).astimezone(pytz.utc)
+    return Time(date).mjd
+
+def test_random_timestamps():
+    rng = np.random.default_rng(0)
+    n = 500
+    dates = np.column_stack([rng.integers(1996, 2021, n), rng.integers(1, 13, n),
+                             rng.integers(1, 29, n), rng.integers(0, 24, n),
+                             rng.integers(0, 60, n), rng.integers(0, 60, n)])
+    expected = [old_hst_to_mjd(row) for row in dates]
+    assert np.allclose(hst_to_mjd_batch(*dates.T), expected, rtol=0, atol=tolerance)
+
+@pytest.mark.parametrize('row', [
+    [2013, 7, 31, 23, 59, 59], # Crosses into the next UTC day and month
+    [2016, 2, 29, 14, 0, 0], # Leap day, crosses into March in UTC
+    [2006, 12, 31, 20, 30, 0], # Crosses into the next UTC year
+    [2015, 4, 1, 0, 0, 0],
+    [2017, 8, 25, 13, 30, 15], # 23:30 UTC, the same day
+])
+def test_boundaries(row):
+    assert hst_to_mjd(row) == pytest.approx(old_hst_to_mjd(row), abs=tolerance)
+
+def test_no_seconds():
+    row = [2017, 8, 9, 19, 45]
+    assert hst_to_mjd(row) == pytest.approx(old_hst_to_mjd(row+[0]), abs=tolerance)
+    dates = np.array([row, [2009, 5, 5, 6, 1]])
+    expected = [old_hst_to_mjd(list(r)+[0]) for r in dates]
+    assert np.allclose(hst_to_mjd_batch(*dates.T), expected, rtol=0, atol=tolerance)
+
+def test_year_typo():
+    row = [202013, 7, 31, 22, 15, 30]
+    assert hst_to_mjd(row) == pytest.approx(old_hst_to_mjd([2013]+row[1:]), abs=tolerance)
+    dates = np.array([row, [2013]+row[1:]])
+    mjds = hst_to_mjd_batch(*dates.T)
+    assert mjds[0] == mjds[1]
+
+def test_saved_tables():
+    """
+    The cached seeing and weather tables were converted with the old code: rebuilding each
+    row's HST time from its MJD and converting it again should give the same MJD
+    """
+    files = sorted(glob.glob(os.path.join(data_dir, 'weather_data', '*.dat')))[:5] + \
+            sorted(glob.glob(os.path.join(data_dir, 'seeing_data', '*', '*.mass.dat')))[:5]
+    if not files:
+        pytest.skip("No saved seeing or weather tables")
+    for file in files:
+        mjds = pd.read_csv(file)['mjd'].dropna().to_numpy()[:200]
+        hst = [Time(mjd, format='mjd').datetime-timedelta(hours=10) for mjd in mjds]
+        hst = [date+timedelta(microseconds=500000) for date in hst] # Round to the second
+        dates = np.array([[d.year, d.month, d.day, d.hour, d.minute, d.second] for d in hst])
+        assert np.allclose(hst_to_mjd_batch(*dates.T), mjds, rtol=0, atol=1e-7), file
@@ -0,0 +1,38 @@
+### time_util.py: HST to MJD conversion shared by the metadata compilers
+### (numpy only, so it can be imported without the rest of the compiler)
+### Author: Emily Ramey
+
+import numpy as np
+
+### Time zone offset
+hst_offset = 10 # Hours between HST and UTC (Hawaii has no DST)
+mjd_epoch = np.datetime64('1858-11-17T00:00:00', 's') # MJD zero point
+
+def hst_to_mjd_batch(year, month, day, hour, minute, second=0):
+    """
+    Converts arrays of HST dates and times into Modified Julian Dates in one pass
+    All inputs are integer arrays (or scalars) of the same length
+    Uses a fixed UTC-10 offset, since Hawaii does not observe daylight savings
+    Returns a float array of MJDs
+    """
+    year = np.asarray(year, dtype=np.int64)
+    # For that one stupid typo in 2013
+    year = np.where(year == 202013, 2013, year)
+
+    ### Build calendar dates, then add the time of day in seconds
+    dates = (year-1970).astype('M8[Y]') + (np.asarray(month, dtype=np.int64)-1).astype('m8[M]')
+    dates = dates.astype('M8[D]') + (np.asarray(day, dtype=np.int64)-1).astype('m8[D]')
+    seconds = (np.asarray(hour, dtype=np.int64)+hst_offset)*3600 + \
+              np.asarray(minute, dtype=np.int64)*60 + np.asarray(second, dtype=np.int64)
+    times = dates.astype('M8[s]') + seconds.astype('m8[s]')
+
+    ### Convert to days since the MJD zero point
+    return (times - mjd_epoch).astype(np.float64) / 86400
+
+def hst_to_mjd(daterow):
+    """
+    Returns the Modified Julian Date calculated from HST
+    daterow: year, month, day, hour, minute, and (optionally) second
+    """
+    row = [int(num) for num in daterow]
+    return float(hst_to_mjd_batch(*row))
@@ -3,7 +3,6 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 import datetime
-import pytz
 import time
 import glob
 import urllib
@@ -12,6 +11,11 @@ from astropy.time import Time, TimezoneInfo
 from astropy import units as u, constants as c
 from datetime import datetime, timezone
 from astropy.io import fits
+import sys
+
+# Shared HST -> MJD conversion (code/time_util.py, which only needs numpy)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'code'))
+from time_util import hst_to_mjd_batch
 
 
 root_directory = '/g/lu/data/gc/'
@@ -24,17 +28,13 @@ def vprint(string):
         print(string)
 
 # Functions for time and date conversions
-def convert_dates(df):
-    dates = []
-    for i, row in df.iterrows():
-        if int(row[3] + 10 < 23):
-            datestring = str(int(row[0])) + '-' + str(int(row[1])) + '-' + str(int(row[2])) + 'T' + str(int(row[3]) + 10) + ':' + str(int(row[4])) + ':' + str(int(row[5]))
-        else:
-            datestring = str(int(row[0])) + '-' + str(int(row[1])) + '-' + str(int(row[2]) + 1) + 'T' + str(int(row[3]) - 14) + ':' + str(int(row[4])) + ':' + str(int(row[5]))
-        dt = Time(datestring,format='isot')
-        dates.append(dt.mjd)
-
-    return dates
+def convert_dates(df, ncols=6):
+    '''
+    Converts the first ncols (HST year, month, day, hour, minute[, second])
+    columns of a dataframe into an array of MJDs
+    '''
+    dates = df.iloc[:, :ncols].to_numpy(dtype=np.int64)
+    return hst_to_mjd_batch(*dates.T)
 
 
 def month_number(month):
@@ -54,23 +54,6 @@ def month_number(month):
         return '09'
 
 
-def hst_to_utc(date):
-    tz = pytz.timezone('US/Hawaii')
-    
-    return tz.normalize(tz.localize(date)).astimezone(pytz.utc)
-
-
-def hst_to_mjd(daterow):
-    row = [int(num) for num in daterow]
-    if len(daterow) == 6:
-        dt = datetime(row[0], row[1], row[2], row[3], row[4], row[5])
-    else:
-        dt = datetime(row[0], row[1], row[2], row[3], row[4])
-    t = Time(hst_to_utc(dt))
-    
-    return t.mjd
-
-
 # Functions
 def find_nearest(array, value):
     i = (np.abs(array-value.value)).argmin()
@@ -240,23 +223,18 @@ def populate_df(datestring, verbose=False):
         # MASS
         for file in glob.glob(seeing_directory + yrmon + '/*.mass.dat'):
             df_mass = pd.read_csv(file, delim_whitespace = True, header=None) 
-            for i, row in df_mass.iterrows():
-                dt = hst_to_mjd(row[:6])
-                mass_dates.append(dt)
-                mass_vals.append(df_mass[6][i])
+            mass_dates.extend(convert_dates(df_mass))
+            mass_vals.extend(df_mass[6])
         # DIMM        
         for file in glob.glob(seeing_directory + yrmon + '/*.dimm.dat'):
             df_dimm = pd.read_csv(file, delim_whitespace = True, header=None) 
-            for i, row in df_dimm.iterrows():
-                dt = hst_to_mjd(row[:6])
-                dimm_dates.append(dt)
-                dimm_vals.append(df_dimm[6][i])
+            dimm_dates.extend(convert_dates(df_dimm))
+            dimm_vals.extend(df_dimm[6])
         # MASSPRO        
         for file in glob.glob(seeing_directory + yrmon + '/*.masspro.dat'):
             df_masspro = pd.read_csv(file, delim_whitespace = True, header=None) 
+            masspro_dates.extend(convert_dates(df_masspro))
             for i, row in df_masspro.iterrows():
-                dt = hst_to_mjd(row[:6])
-                masspro_dates.append(dt)
                 temp = row[6:12]
                 masspro_vals.append(temp)
                 masspro_int.append(row[12])
@@ -334,10 +312,7 @@ def populate_df(datestring, verbose=False):
     cfht_columns = 'year', 'month', 'day', 'hour', 'minute', 'wind_speed', 'wind_direction', 'temperature', 'relative_humidity', 'pressure'
     df_cfht = pd.read_csv(cfht_file, delim_whitespace = True, header=None)
 
-    cfht_mjds =[]
-    for i, row in df_cfht.iterrows():
-        dt = hst_to_mjd(row[:5])
-        cfht_mjds.append(dt)
+    cfht_mjds = convert_dates(df_cfht, ncols=5)
     df_cfht.columns = cfht_columns
     df_cfht['mjd'] = cfht_mjds
 